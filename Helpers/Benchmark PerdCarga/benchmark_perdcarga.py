@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de perdcarga_core fuera de Revit (CPython en Linux).
+
+Genera redes sinteticas (synthetic_network.py) de varios tamanos y mide por
+etapa el tiempo (mejor de N repeticiones) y el pico de memoria asignada
+(tracemalloc, en una pasada aparte para no distorsionar los tiempos).
+Al final muestra el escalado en microsegundos por tuberia.
+
+Uso:
+    python benchmark_perdcarga.py [--sizes 1000,10000,100000] [--repeat 3]
+                                  [--seed 0] [--loops 0.0] [--json salida.json]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+HELPER_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(HELPER_DIR)),
+    "WorkFlowCST.tab",
+    "07_Check_Out.panel",
+    "col1.stack",
+    "PerdCarga.pushbutton",
+)
+sys.path.insert(0, HELPER_DIR)
+sys.path.insert(0, CORE_DIR)
+
+import perdcarga_core as core
+from synthetic_network import generate_network
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def build_darcy_inputs(data):
+    """
+    Columnas SI de compute_darcy_pressure_drops a partir de la instantanea
+    sintetica (caudal en L/s, longitud en mm) con diametros fijos por sistema.
+    """
+    snapshot = data["snapshot"]
+    diameters = {u"A1+": 0.035, u"A1-": 0.028, u"L1": 0.016, u"L2": 0.012}
+    aspiration = (u"A1+", u"A1-")
+    return {
+        "flow": [flow * 0.001 for flow in snapshot["flow"]],
+        "diameter": [diameters[name] for name in snapshot["system_name"]],
+        "length": [length * 0.001 for length in snapshot["length"]],
+        "refrigerant": [u"R-744"] * data["pipe_count"],
+        "phase": [
+            core.PHASE_VAPOR if name in aspiration else core.PHASE_LIQUID
+            for name in snapshot["system_name"]
+        ],
+        "temperature": snapshot["temp_fluid"],
+    }
+
+
+def build_stages(data):
+    """
+    Devuelve [(nombre, funcion)] en el orden del script. Las etapas que
+    dependen de la red la leen de state, que rellena la primera etapa.
+    """
+    snapshot = data["snapshot"]
+    starts = data["start_indexes"]
+    state = {"network": core.build_network_from_links(
+        data["node_ids"], data["pipe_count"], data["fitting_links"]
+    )}
+
+    def stage_network():
+        return core.build_network_from_links(
+            data["node_ids"], data["pipe_count"], data["fitting_links"]
+        )
+
+    def stage_weights():
+        return (
+            core.read_pipe_weights(snapshot, "length", core.feet_to_millimeters),
+            core.read_pipe_weights(snapshot, "pressure", core.bar_to_pa),
+        )
+
+    state["weights"] = stage_weights()
+
+    def stage_pot():
+        return [
+            core.calculate_pot_frigorifica(
+                snapshot["flow"][index],
+                snapshot["density"][index],
+                snapshot["delta_h"][index],
+            )
+            for index, _ in core.iter_snapshot_pipes(snapshot)
+        ]
+
+    def stage_tramo():
+        return core.aggregate_tramo_totals(snapshot, use_numpy=False)
+
+    def stage_tramo_numpy():
+        return core.aggregate_tramo_totals(snapshot, use_numpy=True)
+
+    darcy_inputs = build_darcy_inputs(data)
+
+    def stage_darcy():
+        return core.compute_darcy_pressure_drops(darcy_inputs, 1.5e-6, use_numpy=False)
+
+    def stage_darcy_numpy():
+        return core.compute_darcy_pressure_drops(darcy_inputs, 1.5e-6, use_numpy=True)
+
+    def stage_first_visit():
+        return core.sweep_first_visit(state["network"], state["weights"][0], starts)
+
+    def stage_relaxation():
+        return core.sweep_max_relaxation(state["network"], state["weights"][1], starts)
+
+    def stage_fused():
+        return core.sweep_fused(
+            state["network"], state["weights"][0], state["weights"][1], starts
+        )
+
+    pipe_count = data["pipe_count"]
+    equivalent_lengths = [0.0] * pipe_count + [
+        300.0 if len(linked) > 2 else 150.0 for _, linked in data["fitting_links"]
+    ]
+    fitting_losses = core.compute_fitting_losses(state["network"], snapshot, equivalent_lengths)
+    fitting_weights = (
+        core.read_pipe_weights(fitting_losses, "length", core.feet_to_millimeters),
+        core.read_pipe_weights(fitting_losses, "pressure", core.bar_to_pa),
+    )
+
+    def stage_fused_fittings():
+        return core.sweep_fused(
+            state["network"],
+            state["weights"][0],
+            state["weights"][1],
+            starts,
+            fitting_weights[0],
+            fitting_weights[1],
+        )
+
+    def stage_dag():
+        return core.sweep_longest_path_dag(state["network"], state["weights"][1], starts)
+
+    stages = [
+        ("red CSR", stage_network),
+        ("conversion unidades", stage_weights),
+        ("Pot.Frigorifica", stage_pot),
+        ("agrupacion Tramo", stage_tramo),
+    ]
+    if core.numpy is not None:
+        stages.append(("agrupacion Tramo (numpy)", stage_tramo_numpy))
+    stages.append(("Darcy-Weisbach", stage_darcy))
+    if core.numpy is not None:
+        stages.append(("Darcy-Weisbach (numpy)", stage_darcy_numpy))
+    stages.extend([
+        ("longitud (primer acceso)", stage_first_visit),
+        ("pcarga (relajacion)", stage_relaxation),
+        ("recorrido fusionado", stage_fused),
+        ("fusionado + uniones", stage_fused_fittings),
+        ("pcarga (dag)", stage_dag),
+    ])
+    return stages
+
+
+def time_stage(action, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory_stage(action):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        action()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def get_max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # En Linux ru_maxrss viene en KB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_size(size, repeat, seed, loop_ratio):
+    data = generate_network(size, seed, loop_ratio)
+    results = []
+    for name, action in build_stages(data):
+        results.append({
+            "stage": name,
+            "seconds": time_stage(action, repeat),
+            "peak_bytes": peak_memory_stage(action),
+        })
+    return {
+        "size": size,
+        "pipes": data["pipe_count"],
+        "fittings": len(data["fitting_links"]),
+        "starts": len(data["start_indexes"]),
+        "stages": results,
+        "max_rss_mb": get_max_rss_mb(),
+    }
+
+
+def print_report(runs):
+    for run in runs:
+        print("")
+        print("Red: {} tuberias | {} uniones | {} iniciales | RSS max: {:.1f} MB".format(
+            run["pipes"], run["fittings"], run["starts"], run["max_rss_mb"] or 0.0
+        ))
+        print("  {:<26} {:>10} {:>10} {:>12}".format("etapa", "ms", "us/tub", "pico MB"))
+        for stage in run["stages"]:
+            print("  {:<26} {:>10.2f} {:>10.3f} {:>12.2f}".format(
+                stage["stage"],
+                stage["seconds"] * 1000.0,
+                stage["seconds"] * 1e6 / max(1, run["pipes"]),
+                stage["peak_bytes"] / (1024.0 * 1024.0),
+            ))
+
+    if len(runs) < 2:
+        return
+
+    print("")
+    print("Escalado (tiempo relativo al tamano menor / tuberias relativas)")
+    base = runs[0]
+    for index, stage in enumerate(base["stages"]):
+        cells = []
+        for run in runs[1:]:
+            ratio_time = run["stages"][index]["seconds"] / max(stage["seconds"], 1e-9)
+            ratio_size = float(run["pipes"]) / max(1, base["pipes"])
+            cells.append("x{:.1f}/x{:.0f}".format(ratio_time, ratio_size))
+        print("  {:<26} {}".format(stage["stage"], "  ".join(cells)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark de perdcarga_core")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="Tamanos de red en tuberias, separados por comas",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--loops",
+        type=float,
+        default=0.0,
+        help="Fraccion de finales de ramal unidos para cerrar lazos",
+    )
+    parser.add_argument("--json", default="", help="Guarda los resultados en un JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+    sizes = [int(item) for item in args.sizes.split(",") if item.strip()]
+    runs = [run_size(size, max(1, args.repeat), args.seed, args.loops) for size in sizes]
+    print_report(runs)
+
+    if args.json:
+        with open(args.json, "w") as output_file:
+            json.dump({"python": sys.version, "runs": runs}, output_file, indent=2)
+        print("\nResultados guardados en {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
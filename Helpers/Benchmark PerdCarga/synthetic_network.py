@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Generador de redes frigorificas sinteticas para perdcarga_core.
+
+Cada central (rack) tiene las cuatro lineas del Dynamo (A1+, A1-, L1, L2).
+Cada linea arranca en una tuberia inicial y sigue un colector principal de
+tuberias unidas por tes; de cada te sale un ramal (codos + tuberias) que
+termina en un evaporador, o un subcolector con sus propios ramales. Con
+loop_ratio > 0 se cierran lazos uniendo pares de finales de ramal con una
+union extra (redes malladas para el modo "dag").
+
+Devuelve registros planos, los mismos que script.py arma desde Revit:
+node_ids (tuberias primero), pipe_count, fitting_links, start_indexes y la
+instantanea en columnas.
+
+Uso:
+    python synthetic_network.py <tuberias> [semilla]
+"""
+import random
+import sys
+
+
+SYSTEMS = (u"A1+", u"A1-", u"L1", u"L2")
+SYSTEM_PROPERTIES = {
+    u"A1+": {"density": 18.5, "delta_h": 160.0, "temp_fluid": -8.0},
+    u"A1-": {"density": 9.8, "delta_h": 175.0, "temp_fluid": -30.0},
+    u"L1": {"density": 1050.0, "delta_h": 160.0, "temp_fluid": 35.0},
+    u"L2": {"density": 1100.0, "delta_h": 175.0, "temp_fluid": 35.0},
+}
+PIPES_PER_RACK = 5000
+PIPE_ID_BASE = 100000
+FITTING_ID_BASE = 5000000
+
+
+class _Builder(object):
+    def __init__(self, rng):
+        self.rng = rng
+        self.pipes = []
+        self.fittings = []
+        self.ends = []
+
+    def add_pipe(self, system, tramo):
+        self.pipes.append((system, tramo))
+        return len(self.pipes) - 1
+
+    def add_fitting(self, linked):
+        self.fittings.append(list(linked))
+        return len(self.fittings) - 1
+
+    def add_branch(self, system, from_pipe, tramo, budget):
+        """Ramal de 2-6 tuberias con codos; termina en un evaporador."""
+        count = min(budget, self.rng.randint(2, 6))
+        previous = from_pipe
+        for _ in range(count):
+            pipe = self.add_pipe(system, tramo)
+            self.add_fitting([previous, pipe])
+            previous = pipe
+        self.ends.append((system, previous))
+        return count
+
+    def add_header(self, system, start_pipe, tramo_prefix, budget, depth):
+        used = 0
+        previous = start_pipe
+        tee = 0
+        while used < budget:
+            header_pipe = self.add_pipe(system, u"{}C".format(tramo_prefix))
+            used += 1
+            branch_first = self.add_pipe(system, u"{}R{}".format(tramo_prefix, tee))
+            used += 1
+            self.add_fitting([previous, header_pipe, branch_first])
+            remaining = budget - used
+            if remaining <= 0:
+                break
+            if depth < 2 and self.rng.random() < 0.1:
+                sub_budget = min(remaining, self.rng.randint(20, 80))
+                used += self.add_header(
+                    system,
+                    branch_first,
+                    u"{}S{}".format(tramo_prefix, tee),
+                    sub_budget,
+                    depth + 1,
+                )
+            else:
+                used += self.add_branch(
+                    system,
+                    branch_first,
+                    u"{}R{}".format(tramo_prefix, tee),
+                    remaining,
+                )
+            previous = header_pipe
+            tee += 1
+        return used
+
+
+def generate_network(pipe_target, seed=0, loop_ratio=0.0):
+    rng = random.Random(seed)
+    builder = _Builder(rng)
+    racks = max(1, int(round(float(pipe_target) / PIPES_PER_RACK)))
+    per_line = max(2, pipe_target // (racks * len(SYSTEMS)))
+
+    start_pipes = []
+    for rack in range(racks):
+        for system in SYSTEMS:
+            start = builder.add_pipe(system, u"K{}_INI".format(rack))
+            start_pipes.append(start)
+            builder.add_header(system, start, u"K{}_{}_".format(rack, system), per_line - 1, 0)
+
+    if loop_ratio > 0:
+        by_system = {}
+        for system, pipe in builder.ends:
+            by_system.setdefault(system, []).append(pipe)
+        for ends in by_system.values():
+            rng.shuffle(ends)
+            pairs = int(len(ends) * loop_ratio) // 2
+            for pair in range(pairs):
+                builder.add_fitting([ends[2 * pair], ends[2 * pair + 1]])
+
+    pipe_count = len(builder.pipes)
+    node_ids = [PIPE_ID_BASE + index for index in range(pipe_count)]
+    node_ids.extend(FITTING_ID_BASE + index for index in range(len(builder.fittings)))
+    fitting_links = [
+        (pipe_count + index, linked) for index, linked in enumerate(builder.fittings)
+    ]
+
+    snapshot = {
+        "pipe": [],
+        "system_name": [],
+        "group_key": [],
+        "flow": [],
+        "density": [],
+        "delta_h": [],
+        "temp_fluid": [],
+        "length": [],
+        "pressure": [],
+        "pressure_acum": [None] * pipe_count,
+    }
+    for index, (system, tramo) in enumerate(builder.pipes):
+        properties = SYSTEM_PROPERTIES[system]
+        snapshot["pipe"].append(node_ids[index])
+        snapshot["system_name"].append(system)
+        snapshot["group_key"].append(u"{}_{}".format(tramo, system))
+        snapshot["flow"].append(rng.uniform(0.01, 2.0))
+        snapshot["density"].append(properties["density"])
+        snapshot["delta_h"].append(properties["delta_h"])
+        snapshot["temp_fluid"].append(properties["temp_fluid"])
+        snapshot["length"].append(rng.uniform(0.5, 20.0))
+        snapshot["pressure"].append(rng.uniform(0.0, 0.02))
+
+    return {
+        "node_ids": node_ids,
+        "pipe_count": pipe_count,
+        "fitting_links": fitting_links,
+        "start_indexes": start_pipes,
+        "snapshot": snapshot,
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: synthetic_network.py <tuberias> [semilla]")
+        sys.exit(1)
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    data = generate_network(int(sys.argv[1]), seed)
+    print("Tuberias: {} | uniones: {} | iniciales: {}".format(
+        data["pipe_count"],
+        len(data["fitting_links"]),
+        len(data["start_indexes"]),
+    ))
+
+
+if __name__ == "__main__":
+    main()
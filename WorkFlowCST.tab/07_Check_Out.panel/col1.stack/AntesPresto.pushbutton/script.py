@@ -22,7 +22,15 @@ Implemented blocks:
 _____________________________________________________________________
 Author: Juan Manuel Achenbach Anguita & OpenAI"""
 
+import codecs
+import hashlib
+import json
+import os
+import time
+
 import clr
+import re
+from bisect import bisect_left
 from collections import defaultdict
 
 clr.AddReference("RevitAPI")
@@ -42,6 +50,7 @@ from Autodesk.Revit.DB import (  # noqa: E401
     StorageType,
     Transaction,
     TransactionGroup,
+    TransactionStatus,
     WallSide,
     WallSweep,
     WallSweepInfo,
@@ -65,6 +74,26 @@ PIPE_BAR_LENGTH_MM = 4000.0
 PIPE_BAR_LENGTH_M = 4.0
 PIPE_DIAMETER_TOL_MM = 0.5
 
+# Duct fitting face areas are cached by size signature (family type + the
+# non-built-in parameters that drive the geometry). With the persisted
+# cache enabled the areas are also kept in "<model>_antespresto_areas.json"
+# keyed by element id + signature, so unchanged fittings are not measured.
+DUCT_AREA_PERSISTED_CACHE = False
+DUCT_AREA_CACHE_SUFFIX = u"antespresto_areas"
+DUCT_AREA_CACHE_VERSION = 2
+
+# Block scheduling (see PRESTO_BLOCKS). SELECTED_BLOCKS lists block keys to
+# run, empty runs all; their dependencies and dependents are added. With
+# SKIP_UNCHANGED_BLOCKS a block is skipped when the fingerprint of what it
+# reads and writes matches "<model>_antespresto_bloques.json" and nothing it
+# depends on ran. The written values are part of the fingerprint so an undo,
+# a model closed without saving or a value edited by hand runs the block
+# again. Bump BLOCK_STATE_VERSION when the block logic or tables change.
+SELECTED_BLOCKS = []
+SKIP_UNCHANGED_BLOCKS = False
+BLOCK_STATE_SUFFIX = u"antespresto_bloques"
+BLOCK_STATE_VERSION = 2
+
 PARAM_PARTIDAS = u"Partidas_PRESTO"
 PARAM_CODIGO_PRESTO = u"Codigo_Presto"
 PARAM_COMENTARIOS = u"Comentarios"
@@ -237,6 +266,19 @@ PIPE_TYPE_RULES = [
     {"name": u"drc_co2", "filter_mode": "contains", "filter_field": "system_type_name", "terms": DRC_CO2_TYPE_CONTAINS, "type_match": "exact", "target_type": u"Cu_K65 130 bar", "presto_map": PRESTO_MM_MAP_DRC_130},
 ]
 
+# Per-run catalog of element types: built once from a single collector and
+# indexed by id and category. Names are resolved lazily and memoized, the
+# exact/contains indexes per category are built on first use.
+TYPE_CATALOG = {}
+
+# PRESTO_MM_MAP_* tables compiled to sorted diameters for bisect, and the
+# (map, diameter) -> code memo. Models only use a dozen distinct diameters.
+COMPILED_MM_MAPS = {}
+MM_CODE_CACHE = {}
+
+# Per-run duct fitting area cache, see get_cached_face_area_sqft.
+DUCT_AREA_CACHE = {}
+
 
 class AutoClosePopup(Form):
     def __init__(self, message, duration_ms=3000):
@@ -407,9 +449,108 @@ def get_element_type(elem):
         type_id = ElementId.InvalidElementId
     if not type_id or type_id == ElementId.InvalidElementId:
         return None
+    elem_type = get_type_catalog()["by_id"].get(type_id.IntegerValue)
+    if elem_type is not None:
+        return elem_type
     return doc.GetElement(type_id)
 
 
+def reset_type_catalog():
+    TYPE_CATALOG.clear()
+
+
+def get_type_catalog():
+    if TYPE_CATALOG:
+        return TYPE_CATALOG
+    by_id = {}
+    by_category = defaultdict(list)
+    all_types = []
+    for elem_type in FilteredElementCollector(doc).WhereElementIsElementType():
+        by_id[elem_type.Id.IntegerValue] = elem_type
+        all_types.append(elem_type)
+        try:
+            category = elem_type.Category
+            category_key = category.Id.IntegerValue if category is not None else None
+        except Exception:
+            category_key = None
+        by_category[category_key].append(elem_type)
+    TYPE_CATALOG.update({
+        "by_id": by_id,
+        "by_category": by_category,
+        "all": all_types,
+        "names": {},
+        "params": {},
+        "exact": {},
+        "named": {},
+    })
+    return TYPE_CATALOG
+
+
+def get_type_name(elem_type):
+    if elem_type is None:
+        return u""
+    names = get_type_catalog()["names"]
+    type_key = elem_type.Id.IntegerValue
+    if type_key not in names:
+        names[type_key] = get_element_name(elem_type)
+    return names[type_key]
+
+
+def get_element_type_name(elem):
+    return get_type_name(get_element_type(elem))
+
+
+def get_type_param_text(elem_type, param_name):
+    if elem_type is None:
+        return u""
+    params = get_type_catalog()["params"]
+    key = (elem_type.Id.IntegerValue, param_name)
+    if key not in params:
+        params[key] = get_param_text(elem_type, [param_name], default=u"")
+    return params[key]
+
+
+def get_catalog_named_types(category=None):
+    # [(name, lowercase name, type)] in collector order; category=None is every type.
+    catalog = get_type_catalog()
+    category_key = int(category) if category is not None else None
+    named = catalog["named"].get(category_key)
+    if named is None:
+        types = catalog["all"] if category is None else catalog["by_category"].get(category_key, [])
+        named = []
+        for elem_type in types:
+            name = get_type_name(elem_type)
+            named.append((name, name.lower(), elem_type))
+        catalog["named"][category_key] = named
+    return named
+
+
+def find_type_by_exact_name(type_name, category=None):
+    catalog = get_type_catalog()
+    category_key = int(category) if category is not None else None
+    exact = catalog["exact"].get(category_key)
+    if exact is None:
+        exact = {}
+        for name, _, elem_type in get_catalog_named_types(category):
+            exact.setdefault(name, elem_type)
+        catalog["exact"][category_key] = exact
+    return exact.get(type_name)
+
+
+def find_type_by_contains(text, category=None, ignore_case=False):
+    text = safe_text(text)
+    if ignore_case:
+        text = text.lower()
+        for _, lower_name, elem_type in get_catalog_named_types(category):
+            if text in lower_name:
+                return elem_type
+        return None
+    for name, _, elem_type in get_catalog_named_types(category):
+        if text in name:
+            return elem_type
+    return None
+
+
 def set_param_safe(elem, param_name, value):
     param = get_parameter(elem, [param_name])
     if not param or param.IsReadOnly:
@@ -456,42 +597,208 @@ def collect_pipe_insulations():
     )
 
 
-def collect_pipe_types():
-    return list(
-        FilteredElementCollector(doc)
-        .OfCategory(BuiltInCategory.OST_PipeCurves)
-        .WhereElementIsElementType()
-        .ToElements()
-    )
-
-
 def find_pipe_type_by_exact_name(type_name):
-    for pipe_type in collect_pipe_types():
-        if get_element_name(pipe_type) == type_name:
-            return pipe_type
-    return None
+    return find_type_by_exact_name(type_name, BuiltInCategory.OST_PipeCurves)
 
 
 def find_pipe_type_by_contains(text):
-    text = safe_text(text)
-    for pipe_type in collect_pipe_types():
-        if text in get_element_name(pipe_type):
-            return pipe_type
-    return None
+    return find_type_by_contains(text, BuiltInCategory.OST_PipeCurves)
+
+
+def new_write_plan():
+    # Blocks only read the model and record what they would change. Writes to
+    # the same element parameter collapse into the last value (block order),
+    # and every summary key that asked for it is counted if the write succeeds.
+    # "block" is the key of the block being planned; every entry keeps it so
+    # a failed write can be traced back to the blocks that asked for it.
+    # "incomplete" holds the blocks that could not plan everything they
+    # should (a missing type); like a failed write, they are run again.
+    return {
+        "block": None,
+        "incomplete": set(),
+        "deletes": [],
+        "type_changes": [],
+        "creates": [],
+        "params": {},
+        "param_order": [],
+    }
+
+
+def plan_delete(plan, summary_key, element_ids):
+    plan["deletes"].append((plan["block"], summary_key, list(element_ids)))
+
+
+def plan_type_change(plan, summary_key, elem, type_id):
+    plan["type_changes"].append((plan["block"], summary_key, elem, type_id))
+
+
+def plan_create(plan, summary_key, factory, params, params_summary_key):
+    plan["creates"].append((plan["block"], summary_key, factory, params, params_summary_key))
+
 
+def plan_param(plan, summary_key, elem, param_name, value):
+    elem_id = elem.Id.IntegerValue
+    entry = plan["params"].get(elem_id)
+    if entry is None:
+        entry = {"element": elem, "values": {}, "names": []}
+        plan["params"][elem_id] = entry
+        plan["param_order"].append(elem_id)
+    if param_name not in entry["values"]:
+        entry["values"][param_name] = [None, [], set()]
+        entry["names"].append(param_name)
+    entry["values"][param_name][0] = value
+    entry["values"][param_name][1].append(summary_key)
+    entry["values"][param_name][2].add(plan["block"])
 
-def run_block(name, action, errors):
+
+def plan_incomplete(plan):
+    plan["incomplete"].add(plan["block"])
+
+
+def get_plan_param_blocks(plan):
+    blocks = set()
+    for entry in plan["params"].values():
+        for _, _, block_keys in entry["values"].values():
+            blocks.update(block_keys)
+    return blocks
+
+
+def plan_block(name, action, errors, timings):
+    started = time.time()
+    try:
+        return action()
+    except Exception as err:
+        errors.append(u"{}: {}".format(name, safe_text(err)))
+        return None
+    finally:
+        timings.append((name, time.time() - started))
+
+
+def apply_deletes(plan, summary, errors, failed):
+    deleted = set()
+    for block_key, summary_key, element_ids in plan["deletes"]:
+        ids = [elem_id for elem_id in element_ids if elem_id and elem_id != ElementId.InvalidElementId]
+        if not ids:
+            continue
+        try:
+            removed = doc.Delete(System.Collections.Generic.List[ElementId](ids))
+        except Exception as err:
+            errors.append(u"{}: {}".format(summary_key, safe_text(err)))
+            failed.add(block_key)
+            continue
+        summary[summary_key] += len(removed)
+        deleted.update(elem_id.IntegerValue for elem_id in removed)
+    return deleted
+
+
+def apply_type_changes(plan, summary, deleted, failed):
+    for block_key, summary_key, elem, type_id in plan["type_changes"]:
+        if elem.Id.IntegerValue in deleted:
+            continue
+        try:
+            param = elem.get_Parameter(BuiltInParameter.ELEM_TYPE_PARAM)
+            if param and not param.IsReadOnly:
+                param.Set(type_id)
+                summary[summary_key] += 1
+                continue
+        except Exception:
+            pass
+        failed.add(block_key)
+
+
+def apply_creates(plan, summary, errors, failed):
+    for block_key, summary_key, factory, params, params_summary_key in plan["creates"]:
+        try:
+            created = factory()
+        except Exception as err:
+            errors.append(u"{}: {}".format(summary_key, safe_text(err)))
+            failed.add(block_key)
+            continue
+        summary[summary_key] += 1
+        results = [set_param_safe(created, param_name, value) for param_name, value in params]
+        if any(results):
+            summary[params_summary_key] += 1
+        if not all(results):
+            failed.add(block_key)
+
+
+def apply_params(plan, summary, deleted, failed):
+    # A parameter that is missing (shared parameter not bound) or read-only
+    # fails its blocks, so they are not skipped once it is fixed.
+    for elem_id in plan["param_order"]:
+        if elem_id in deleted:
+            continue
+        entry = plan["params"][elem_id]
+        for param_name in entry["names"]:
+            value, summary_keys, block_keys = entry["values"][param_name]
+            if set_param_safe(entry["element"], param_name, value):
+                for summary_key in summary_keys:
+                    summary[summary_key] += 1
+            else:
+                failed.update(block_keys)
+
+
+def run_transaction(name, action, summary, errors, timings):
+    # Counts only reach the summary once the transaction is committed.
+    # Returns True if it was.
+    counts = defaultdict(int)
     tx = Transaction(doc, name)
+    started = time.time()
     try:
         tx.Start()
-        result = action()
-        tx.Commit()
-        return result
+        action(counts)
+        if tx.Commit() != TransactionStatus.Committed:
+            errors.append(u"{}: transacción no confirmada".format(name))
+            return False
     except Exception as err:
-        if tx.HasStarted():
+        if tx.HasStarted() and not tx.HasEnded():
             tx.RollBack()
         errors.append(u"{}: {}".format(name, safe_text(err)))
-        return None
+        return False
+    finally:
+        timings.append((name, time.time() - started))
+    for summary_key, count in counts.items():
+        summary[summary_key] += count
+    return True
+
+
+def apply_write_plan(name, plan, summary, errors, timings):
+    # Deletions and new elements, type changes and parameter values each go
+    # in their own transaction inside the caller's group, so a failure rolls
+    # back only the blocks that wrote to that step. Deletions go first so
+    # later writes skip the removed elements.
+    # Returns the keys of the blocks whose writes did not reach the model.
+    failed = set(plan["incomplete"])
+    deleted = set()
+
+    def apply_structure(counts):
+        deleted.update(apply_deletes(plan, counts, errors, failed))
+        apply_creates(plan, counts, errors, failed)
+
+    if plan["deletes"] or plan["creates"]:
+        if not run_transaction(name + u" - borrados/creados", apply_structure, summary, errors, timings):
+            deleted.clear()
+            failed.update(entry[0] for entry in plan["deletes"])
+            failed.update(entry[0] for entry in plan["creates"])
+    if plan["type_changes"]:
+        if not run_transaction(
+            name + u" - tipos",
+            lambda counts: apply_type_changes(plan, counts, deleted, failed),
+            summary,
+            errors,
+            timings,
+        ):
+            failed.update(entry[0] for entry in plan["type_changes"])
+    if plan["param_order"]:
+        if not run_transaction(
+            name + u" - parámetros",
+            lambda counts: apply_params(plan, counts, deleted, failed),
+            summary,
+            errors,
+            timings,
+        ):
+            failed.update(get_plan_param_blocks(plan))
+    return failed
 
 
 def get_pipe_length_ft(pipe):
@@ -618,24 +925,53 @@ def contains_any(text, terms):
     return any(term in text for term in terms)
 
 
-def equals_any(text, terms):
-    text = safe_text(text)
-    return any(term == text for term in terms)
+def compile_mm_map(mm_map):
+    # Sorted unique diameters with the first code and table position of each,
+    # so ties resolve to the entry the linear scan would have kept.
+    first_by_mm = {}
+    for position, (target_mm, code) in enumerate(mm_map):
+        if target_mm not in first_by_mm:
+            first_by_mm[target_mm] = (position, code)
+    targets = sorted(first_by_mm)
+    return {
+        "targets": targets,
+        "positions": [first_by_mm[target_mm][0] for target_mm in targets],
+        "codes": [first_by_mm[target_mm][1] for target_mm in targets],
+    }
+
+
+def get_compiled_mm_map(mm_map):
+    compiled = COMPILED_MM_MAPS.get(id(mm_map))
+    if compiled is None:
+        compiled = compile_mm_map(mm_map)
+        COMPILED_MM_MAPS[id(mm_map)] = compiled
+    return compiled
 
 
 def find_mm_code(diameter_mm, mm_map):
     if diameter_mm is None:
         return None
-    best_code = None
-    best_diff = None
-    for target_mm, code in mm_map:
-        diff = abs(diameter_mm - target_mm)
-        if best_diff is None or diff < best_diff:
-            best_diff = diff
-            best_code = code
-    if best_diff is not None and best_diff <= PIPE_DIAMETER_TOL_MM:
-        return best_code
-    return None
+    key = (id(mm_map), round(diameter_mm, 6))
+    if key in MM_CODE_CACHE:
+        return MM_CODE_CACHE[key]
+
+    compiled = get_compiled_mm_map(mm_map)
+    targets = compiled["targets"]
+    best = None
+    index = bisect_left(targets, diameter_mm)
+    for candidate in (index - 1, index):
+        if candidate < 0 or candidate >= len(targets):
+            continue
+        diff = abs(diameter_mm - targets[candidate])
+        rank = (diff, compiled["positions"][candidate])
+        if best is None or rank < best[0]:
+            best = (rank, candidate)
+
+    code = None
+    if best is not None and best[0][0] <= PIPE_DIAMETER_TOL_MM:
+        code = compiled["codes"][best[1]]
+    MM_CODE_CACHE[key] = code
+    return code
 
 
 def get_total_face_area_sqft(element):
@@ -661,12 +997,155 @@ def get_total_face_area_sqft(element):
     return total
 
 
-def delete_elements_by_ids(element_ids):
-    ids = [elem_id for elem_id in element_ids if elem_id and elem_id != ElementId.InvalidElementId]
-    if not ids:
-        return 0
-    deleted = doc.Delete(System.Collections.Generic.List[ElementId](ids))
-    return len(deleted)
+def get_model_sidecar_path(suffix, extension=u".json"):
+    try:
+        path = doc.PathName
+    except Exception:
+        path = u""
+    if not path or not path.strip():
+        return u""
+    return u"{}_{}{}".format(os.path.splitext(path)[0], suffix, extension)
+
+
+def load_json_sidecar(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with codecs.open(path, "r", "utf-8") as sidecar_file:
+            return json.load(sidecar_file)
+    except Exception:
+        return None
+
+
+def save_json_sidecar(path, data):
+    if not path:
+        return False
+    try:
+        with codecs.open(path, "w", "utf-8") as sidecar_file:
+            sidecar_file.write(json.dumps(data, ensure_ascii=False, indent=2))
+        return True
+    except Exception:
+        return False
+
+
+def reset_duct_area_cache():
+    DUCT_AREA_CACHE.clear()
+    DUCT_AREA_CACHE.update({
+        "by_signature": {},
+        "symbols": {},
+        "persisted": {},
+        "current": {},
+        "seconds_per_fitting": None,
+        "measured": 0,
+        "measured_seconds": 0.0,
+        "hits_element": 0,
+        "hits_size": 0,
+    })
+
+
+def load_duct_area_cache():
+    reset_duct_area_cache()
+    if not DUCT_AREA_PERSISTED_CACHE:
+        return DUCT_AREA_CACHE
+    data = load_json_sidecar(get_model_sidecar_path(DUCT_AREA_CACHE_SUFFIX))
+    if not isinstance(data, dict) or data.get("version") != DUCT_AREA_CACHE_VERSION:
+        return DUCT_AREA_CACHE
+    for elem_key, entry in (data.get("areas") or {}).items():
+        try:
+            signature = entry["signature"]
+            area = float(entry["area"])
+        except Exception:
+            continue
+        DUCT_AREA_CACHE["persisted"][elem_key] = (signature, area)
+        DUCT_AREA_CACHE["by_signature"][signature] = area
+    DUCT_AREA_CACHE["seconds_per_fitting"] = data.get("seconds_per_fitting")
+    return DUCT_AREA_CACHE
+
+
+def save_duct_area_cache():
+    if not DUCT_AREA_PERSISTED_CACHE or not DUCT_AREA_CACHE.get("current"):
+        return False
+    areas = {}
+    for elem_key, (signature, area) in DUCT_AREA_CACHE["current"].items():
+        areas[elem_key] = {"signature": signature, "area": area}
+    return save_json_sidecar(
+        get_model_sidecar_path(DUCT_AREA_CACHE_SUFFIX),
+        {
+            "version": DUCT_AREA_CACHE_VERSION,
+            "seconds_per_fitting": get_duct_area_seconds_per_fitting(),
+            "areas": areas,
+        },
+    )
+
+
+def get_size_param_values(elem):
+    # Non-built-in numeric parameters are the family's own dimensions
+    # (widths, heights, radius, angle...), shared or not. Only the area this
+    # script writes is left out, so its own output never changes the key.
+    values = []
+    for param in elem.Parameters:
+        try:
+            definition = param.Definition
+            if getattr(definition, "BuiltInParameter", None) != BuiltInParameter.INVALID:
+                continue
+            if definition.Name == PARAM_DUCT_FITTING_AREA:
+                continue
+            if param.StorageType == StorageType.Double:
+                value = u"{:.6f}".format(param.AsDouble())
+            elif param.StorageType == StorageType.Integer:
+                value = u"{}".format(param.AsInteger())
+            else:
+                continue
+        except Exception:
+            continue
+        values.append(u"{}={}".format(definition.Name, value))
+    values.sort()
+    return u";".join(values)
+
+
+def get_duct_fitting_signature(fitting):
+    symbol = getattr(fitting, "Symbol", None)
+    if symbol is None:
+        return None
+    symbols = DUCT_AREA_CACHE["symbols"]
+    symbol_key = symbol.Id.IntegerValue
+    if symbol_key not in symbols:
+        symbols[symbol_key] = u"{}|{}".format(symbol.UniqueId, get_size_param_values(symbol))
+    return u"{}|{}".format(symbols[symbol_key], get_size_param_values(fitting))
+
+
+def get_cached_face_area_sqft(fitting):
+    try:
+        signature = get_duct_fitting_signature(fitting)
+    except Exception:
+        signature = None
+    if signature is None:
+        return get_total_face_area_sqft(fitting)
+
+    elem_key = str(fitting.Id.IntegerValue)
+    persisted = DUCT_AREA_CACHE["persisted"].get(elem_key)
+    by_signature = DUCT_AREA_CACHE["by_signature"]
+    if persisted is not None and persisted[0] == signature:
+        area = persisted[1]
+        DUCT_AREA_CACHE["hits_element"] += 1
+    elif signature in by_signature:
+        area = by_signature[signature]
+        DUCT_AREA_CACHE["hits_size"] += 1
+    else:
+        started = time.time()
+        area = get_total_face_area_sqft(fitting)
+        DUCT_AREA_CACHE["measured_seconds"] += time.time() - started
+        DUCT_AREA_CACHE["measured"] += 1
+    by_signature[signature] = area
+    DUCT_AREA_CACHE["current"][elem_key] = (signature, area)
+    return area
+
+
+def get_duct_area_seconds_per_fitting():
+    measured = DUCT_AREA_CACHE.get("measured", 0)
+    if measured:
+        return DUCT_AREA_CACHE["measured_seconds"] / measured
+    return DUCT_AREA_CACHE.get("seconds_per_fitting")
 
 
 def get_hosted_pipe_insulations_by_pipe():
@@ -680,11 +1159,11 @@ def get_hosted_pipe_insulations_by_pipe():
 
 
 def get_insulation_type_name(insulation):
-    return get_element_name(get_element_type(insulation))
+    return get_element_type_name(insulation)
 
 
 def get_duct_type_name(duct):
-    return get_element_name(get_element_type(duct))
+    return get_element_type_name(duct)
 
 
 def get_revit_round(value):
@@ -699,85 +1178,78 @@ def get_revit_ceiling(value):
     return float(System.Math.Ceiling(float(value)))
 
 
-def delete_orphan_rooms(summary):
-    rooms = collect_elements(BuiltInCategory.OST_Rooms)
+def split_orphan_rooms():
     orphan_ids = []
     valid_rooms = []
-    for room in rooms:
+    for room in collect_elements(BuiltInCategory.OST_Rooms):
         perimeter = get_room_perimeter_ft(room)
         if perimeter is None or perimeter <= 0:
             orphan_ids.append(room.Id)
         else:
             valid_rooms.append(room)
-    summary["rooms_deleted"] += delete_elements_by_ids(orphan_ids)
-    summary["rooms_valid"] = len(valid_rooms)
-    return valid_rooms
+    return valid_rooms, orphan_ids
+
+
+def delete_orphan_rooms(plan, orphan_ids):
+    plan_delete(plan, "rooms_deleted", orphan_ids)
+
+
+def get_room_name(room):
+    room_name = get_param_text(room, ROOM_NAME_PARAM_NAMES, default=u"")
+    if not room_name:
+        room_name = get_element_name(room)
+    return room_name
 
 
 def build_room_volume_map(valid_rooms):
     room_map = {}
     for room in valid_rooms:
-        room_name = get_param_text(room, ROOM_NAME_PARAM_NAMES, default=u"")
-        if not room_name:
-            room_name = get_element_name(room)
+        room_name = get_room_name(room)
         if room_name:
             room_map[room_name] = get_room_volume_cuft(room)
     return room_map
 
 
-def transfer_room_volume_to_equipment(summary, room_volume_map):
-    changed = 0
+def transfer_room_volume_to_equipment(plan, room_volume_map):
     for equipment in collect_elements(BuiltInCategory.OST_MechanicalEquipment):
         room_name = get_param_text(equipment, [PARAM_UBICACION], default=u"")
         volume_cuft = room_volume_map.get(room_name)
         if volume_cuft is None:
             continue
-        if set_param_safe(equipment, PARAM_VOL_CAMARA, volume_cuft):
-            changed += 1
-    summary["vol_camara"] += changed
+        plan_param(plan, "vol_camara", equipment, PARAM_VOL_CAMARA, volume_cuft)
 
 
-def set_comments_for_electrical_devices(summary):
+def set_comments_for_electrical_devices(plan):
     electrical = collect_elements(BuiltInCategory.OST_ElectricalFixtures)
     if not electrical:
         try:
             electrical = collect_elements(BuiltInCategory.OST_ElectricalEquipment)
         except Exception:
             electrical = []
-    changed = 0
     for elem in electrical:
         ubicacion = get_param_text(elem, [PARAM_UBICACION], default=u"")
         comentarios2 = get_param_text(elem, [PARAM_COMENTARIOS2], default=u"")
         value = u"{}{}{}".format(ubicacion, u"_", comentarios2)
-        if set_param_safe(elem, PARAM_COMENTARIOS, value):
-            changed += 1
-    summary["comentarios_electrico"] += changed
+        plan_param(plan, "comentarios_electrico", elem, PARAM_COMENTARIOS, value)
 
 
-def set_comments_from_location(summary, elements, summary_key):
-    changed = 0
+def set_comments_from_location(plan, elements, summary_key):
     for elem in elements:
         ubicacion = get_param_text(elem, [PARAM_UBICACION], default=u"")
-        if set_param_safe(elem, PARAM_COMENTARIOS, ubicacion):
-            changed += 1
-    summary[summary_key] += changed
+        plan_param(plan, summary_key, elem, PARAM_COMENTARIOS, ubicacion)
 
 
-def set_door_comments(summary):
-    changed = 0
+def set_door_comments(plan):
     for door in collect_elements(BuiltInCategory.OST_Doors):
         ubicacion = get_param_text(door, [PARAM_UBICACION], default=u"")
         if not ubicacion:
             continue
         comentarios2 = get_param_text(door, [PARAM_COMENTARIOS2], default=u"")
         value = u"{}{}{}".format(ubicacion, u"_", comentarios2)
-        if set_param_safe(door, PARAM_COMENTARIOS, value):
-            changed += 1
-    summary["comentarios_puertas"] += changed
+        plan_param(plan, "comentarios_puertas", door, PARAM_COMENTARIOS, value)
 
 
-def assign_partidas_by_category(summary):
-    changed = 0
+def assign_partidas_by_category(plan):
     category_map = [
         (BuiltInCategory.OST_PipeCurves, u"04"),
         (BuiltInCategory.OST_PipeInsulations, u"04"),
@@ -790,17 +1262,31 @@ def assign_partidas_by_category(summary):
     ]
     for category, value in category_map:
         for elem in collect_elements(category):
-            if set_param_safe(elem, PARAM_PARTIDAS, value):
-                changed += 1
-    summary["partidas_base"] += changed
+            plan_param(plan, "partidas_base", elem, PARAM_PARTIDAS, value)
 
 
-def get_sala_maquinas_pipes(all_pipes):
+def read_pipe_system_fields(all_pipes):
+    # System type name and abbreviation read once per pipe for every block
+    # that filters pipes by system (rules, sala de maquinas).
+    fields = {}
+    for pipe in all_pipes:
+        pipe_id = pipe.Id.IntegerValue
+        if pipe_id in fields:
+            continue
+        fields[pipe_id] = {
+            "system_type_name": safe_text(get_pipe_system_type_name(pipe)),
+            "system_abbreviation": safe_text(get_pipe_system_abbreviation(pipe)),
+        }
+    return fields
+
+
+def get_sala_maquinas_pipes(all_pipes, pipe_fields):
     result = []
     seen = set()
     for pipe in all_pipes:
-        system_type_name = get_pipe_system_type_name(pipe)
-        abbreviation = get_pipe_system_abbreviation(pipe)
+        fields = pipe_fields[pipe.Id.IntegerValue]
+        system_type_name = fields["system_type_name"]
+        abbreviation = fields["system_abbreviation"]
         matches = contains_any(system_type_name, [u"DRC", u"Conducción"]) or contains_any(abbreviation, [u"DESR"])
         if matches and pipe.Id.IntegerValue not in seen:
             seen.add(pipe.Id.IntegerValue)
@@ -808,34 +1294,26 @@ def get_sala_maquinas_pipes(all_pipes):
     return result
 
 
-def assign_sala_maquinas_partidas(summary, pipes):
-    changed = 0
+def assign_sala_maquinas_partidas(plan, pipes):
     for pipe in pipes:
-        if set_param_safe(pipe, PARAM_PARTIDAS, u"01.07"):
-            changed += 1
-    summary["partidas_sala_maquinas"] += changed
+        plan_param(plan, "partidas_sala_maquinas", pipe, PARAM_PARTIDAS, u"01.07")
 
 
-def assign_panel_gross_area(summary):
-    changed = 0
+def assign_panel_gross_area(plan):
     for wall in collect_elements(BuiltInCategory.OST_Walls):
         length_ft = get_wall_length_ft(wall)
         height_ft = get_wall_unconnected_height_ft(wall)
         if length_ft is None or height_ft is None:
             continue
-        if set_param_safe(wall, PARAM_SUP_BRUTA_PANEL, length_ft * height_ft * GROSS_FACTOR):
-            changed += 1
+        plan_param(plan, "sup_bruta_panel", wall, PARAM_SUP_BRUTA_PANEL, length_ft * height_ft * GROSS_FACTOR)
     for floor in collect_elements(BuiltInCategory.OST_Floors):
         area_sqft = get_floor_area_sqft(floor)
         if area_sqft is None:
             continue
-        if set_param_safe(floor, PARAM_SUP_BRUTA_PANEL, area_sqft * GROSS_FACTOR):
-            changed += 1
-    summary["sup_bruta_panel"] += changed
+        plan_param(plan, "sup_bruta_panel", floor, PARAM_SUP_BRUTA_PANEL, area_sqft * GROSS_FACTOR)
 
 
-def assign_duct_areas(summary):
-    changed = 0
+def assign_duct_areas(summary, plan):
     for duct in collect_elements(BuiltInCategory.OST_DuctCurves):
         width_ft = get_param_double(duct, [u"Anchura"])
         height_ft = get_param_double(duct, [u"Altura"])
@@ -843,15 +1321,19 @@ def assign_duct_areas(summary):
         if width_ft is None or height_ft is None or length_ft is None:
             continue
         gross_area_sqft = 2.0 * (width_ft + height_ft) * length_ft * GROSS_FACTOR
-        if set_param_safe(duct, PARAM_DUCT_FITTING_AREA, gross_area_sqft):
-            changed += 1
+        plan_param(plan, "duct_areas", duct, PARAM_DUCT_FITTING_AREA, gross_area_sqft)
+    load_duct_area_cache()
     for fitting in collect_elements(BuiltInCategory.OST_DuctFitting):
-        total_face_area_sqft = get_total_face_area_sqft(fitting)
+        total_face_area_sqft = get_cached_face_area_sqft(fitting)
         connection_area_sqft = get_param_double(fitting, [PARAM_DUCT_CONNECTION_AREA], default=0.0) or 0.0
         gross_area_sqft = max(total_face_area_sqft - connection_area_sqft, 0.0) * GROSS_FACTOR
-        if set_param_safe(fitting, PARAM_DUCT_FITTING_AREA, gross_area_sqft):
-            changed += 1
-    summary["duct_areas"] += changed
+        plan_param(plan, "duct_areas", fitting, PARAM_DUCT_FITTING_AREA, gross_area_sqft)
+    save_duct_area_cache()
+
+    hits = DUCT_AREA_CACHE["hits_element"] + DUCT_AREA_CACHE["hits_size"]
+    summary["duct_area_measured"] += DUCT_AREA_CACHE["measured"]
+    summary["duct_area_cache_hits"] += hits
+    summary["duct_area_saved_s"] += hits * (get_duct_area_seconds_per_fitting() or 0.0)
 
 
 def get_target_pipe_type(rule):
@@ -860,71 +1342,79 @@ def get_target_pipe_type(rule):
     return find_pipe_type_by_contains(rule["target_type"])
 
 
-def get_rule_pipe_subset(all_pipes, rule):
-    subset = []
+def compile_term_matcher(filter_mode, terms):
+    terms = [safe_text(term) for term in terms]
+    if filter_mode == "contains":
+        # One alternation per rule: same result as contains_any, one scan.
+        if not terms:
+            return lambda text: False
+        pattern = re.compile(u"|".join(re.escape(term) for term in terms))
+        return lambda text: pattern.search(text) is not None
+    term_set = frozenset(terms)
+    return lambda text: text in term_set
+
+
+def compile_pipe_type_rules(rules):
+    return [
+        (rule["name"], rule["filter_field"], compile_term_matcher(rule["filter_mode"], rule["terms"]))
+        for rule in rules
+    ]
+
+
+def classify_pipes_by_rule(all_pipes, compiled_rules, pipe_fields):
+    # Single pass over the pipes. A pipe joins every rule it matches, in
+    # pipe order, like one get_rule_pipe_subset pass per rule did; the rule
+    # order (later rules win on overlap) is kept by the callers.
+    subsets = dict((name, []) for name, _, _ in compiled_rules)
     seen = set()
     for pipe in all_pipes:
-        if rule["filter_field"] == "system_abbreviation":
-            field_value = get_pipe_system_abbreviation(pipe)
-        else:
-            field_value = get_pipe_system_type_name(pipe)
-        if rule["filter_mode"] == "contains":
-            matched = contains_any(field_value, rule["terms"])
-        else:
-            matched = equals_any(field_value, rule["terms"])
-        if matched and pipe.Id.IntegerValue not in seen:
-            seen.add(pipe.Id.IntegerValue)
-            subset.append(pipe)
-    return subset
+        pipe_id = pipe.Id.IntegerValue
+        if pipe_id in seen:
+            continue
+        seen.add(pipe_id)
+        fields = pipe_fields[pipe_id]
+        for name, field, matcher in compiled_rules:
+            if matcher(fields[field]):
+                subsets[name].append(pipe)
+    return subsets
 
 
-def change_pipe_types(summary, all_pipes):
-    changed_groups = {}
+def change_pipe_types(summary, plan, changed_groups):
     for rule in PIPE_TYPE_RULES:
-        subset = get_rule_pipe_subset(all_pipes, rule)
-        changed_groups[rule["name"]] = subset
+        subset = changed_groups[rule["name"]]
         target_type = get_target_pipe_type(rule)
         if not target_type:
             summary["pipe_type_missing_" + rule["name"]] += len(subset)
+            if subset:
+                plan_incomplete(plan)
             continue
-        changed = 0
         for pipe in subset:
-            try:
-                param = pipe.get_Parameter(BuiltInParameter.ELEM_TYPE_PARAM)
-                if param and not param.IsReadOnly:
-                    param.Set(target_type.Id)
-                    changed += 1
-            except Exception:
-                continue
-        summary["pipe_type_changed_" + rule["name"]] += changed
-    return changed_groups
+            plan_type_change(plan, "pipe_type_changed_" + rule["name"], pipe, target_type.Id)
 
 
-def assign_pipe_presto_codes(summary, changed_groups):
-    changed = 0
+def assign_pipe_presto_codes(plan, changed_groups):
+    diameters_mm = {}
     for rule in PIPE_TYPE_RULES:
         for pipe in changed_groups.get(rule["name"], []):
-            diameter_ft = get_pipe_diameter_ft(pipe)
-            code = find_mm_code(ft_to_mm(diameter_ft), rule["presto_map"])
-            if code and set_param_safe(pipe, PARAM_CODIGO_PRESTO, code):
-                changed += 1
-    summary["codigo_presto_tuberias"] += changed
+            pipe_id = pipe.Id.IntegerValue
+            if pipe_id not in diameters_mm:
+                diameters_mm[pipe_id] = ft_to_mm(get_pipe_diameter_ft(pipe))
+            code = find_mm_code(diameters_mm[pipe_id], rule["presto_map"])
+            if code:
+                plan_param(plan, "codigo_presto_tuberias", pipe, PARAM_CODIGO_PRESTO, code)
 
 
-def assign_wall_floor_presto_codes(summary):
-    changed = 0
+def assign_wall_floor_presto_codes(plan):
     all_elements = []
     all_elements.extend(collect_elements(BuiltInCategory.OST_Walls))
     all_elements.extend(collect_elements(BuiltInCategory.OST_Floors))
     for elem in all_elements:
-        code = get_param_text(get_element_type(elem), [PARAM_CODIGO_MONTAJE], default=u"")
-        if code and set_param_safe(elem, PARAM_CODIGO_PRESTO, code):
-            changed += 1
-    summary["codigo_presto_cerramientos"] += changed
+        code = get_type_param_text(get_element_type(elem), PARAM_CODIGO_MONTAJE)
+        if code:
+            plan_param(plan, "codigo_presto_cerramientos", elem, PARAM_CODIGO_PRESTO, code)
 
 
-def assign_duct_presto_codes(summary):
-    changed = 0
+def assign_duct_presto_codes(plan):
     for duct in collect_elements(BuiltInCategory.OST_DuctCurves):
         code = u"SIN ETIQUETA"
         try:
@@ -935,19 +1425,15 @@ def assign_duct_presto_codes(summary):
                     break
         except Exception as err:
             code = u"Error: {}".format(safe_text(err))
-        if set_param_safe(duct, PARAM_CODIGO_PRESTO, code):
-            changed += 1
-    summary["codigo_presto_conductos"] += changed
+        plan_param(plan, "codigo_presto_conductos", duct, PARAM_CODIGO_PRESTO, code)
 
 
-def assign_insulation_presto_codes(summary):
-    changed = 0
+def assign_insulation_presto_codes(plan):
     for insulation in collect_pipe_insulations():
         type_name = get_insulation_type_name(insulation)
         code = INSULATION_CODE_BY_TYPE_NAME.get(type_name)
-        if code and set_param_safe(insulation, PARAM_CODIGO_PRESTO, code):
-            changed += 1
-    summary["codigo_presto_aislamientos"] += changed
+        if code:
+            plan_param(plan, "codigo_presto_aislamientos", insulation, PARAM_CODIGO_PRESTO, code)
 
 
 def get_gross_total_pipe_length_m(total_net_m):
@@ -956,7 +1442,7 @@ def get_gross_total_pipe_length_m(total_net_m):
     return gross_bars * PIPE_WASTE_ADD_M
 
 
-def assign_pipe_gross_lengths(summary, all_pipes, sala_maquinas_pipes):
+def assign_pipe_gross_lengths(plan, all_pipes, sala_maquinas_pipes):
     sala_ids = set(pipe.Id.IntegerValue for pipe in sala_maquinas_pipes)
     non_sala = [pipe for pipe in all_pipes if pipe.Id.IntegerValue not in sala_ids]
 
@@ -967,9 +1453,6 @@ def assign_pipe_gross_lengths(summary, all_pipes, sala_maquinas_pipes):
             length_ft = get_pipe_length_ft(pipe)
             if length_ft is not None and length_ft > 0:
                 groups[size_key].append((pipe, length_ft))
-        if not groups:
-            return
-        changed_local = 0
         for _, items in groups.items():
             total_net_m = sum(ft_to_m(length_ft) for _, length_ft in items)
             if total_net_m <= 0:
@@ -977,15 +1460,13 @@ def assign_pipe_gross_lengths(summary, all_pipes, sala_maquinas_pipes):
             gross_total_m = get_gross_total_pipe_length_m(total_net_m)
             for pipe, length_ft in items:
                 gross_length_m = ft_to_m(length_ft) * gross_total_m / total_net_m
-                if set_param_safe(pipe, PARAM_LONG_BRUTA_TUB, m_to_ft(gross_length_m)):
-                    changed_local += 1
-        summary[summary_key] += changed_local
+                plan_param(plan, summary_key, pipe, PARAM_LONG_BRUTA_TUB, m_to_ft(gross_length_m))
 
     write_group(sala_maquinas_pipes, "long_bruta_tub_sala_maquinas")
     write_group(non_sala, "long_bruta_tub_resto")
 
 
-def assign_pipe_insulation_gross_lengths(summary):
+def assign_pipe_insulation_gross_lengths(plan):
     # Dynamo builds the gross-length groups from every pipe with a filled
     # "Tipo de aislamiento", then writes only to the insulation elements that
     # actually exist on those pipes. That means pipes with an insulation type
@@ -1003,7 +1484,6 @@ def assign_pipe_insulation_gross_lengths(summary):
             (length_ft, insulations_by_pipe.get(pipe.Id.IntegerValue, []))
         )
 
-    changed = 0
     for _, items in groups.items():
         total_length_mm = sum(ft_to_mm(length_ft) for length_ft, _ in items)
         if total_length_mm <= 0:
@@ -1015,13 +1495,10 @@ def assign_pipe_insulation_gross_lengths(summary):
         for length_ft, insulations in items:
             gross_length_m = gross_total_m * ft_to_mm(length_ft) / divisor
             for insulation in insulations:
-                if set_param_safe(insulation, PARAM_LONG_BRUTA_TUB, m_to_ft(gross_length_m)):
-                    changed += 1
-    summary["long_bruta_tub_aislamientos"] += changed
+                plan_param(plan, "long_bruta_tub_aislamientos", insulation, PARAM_LONG_BRUTA_TUB, m_to_ft(gross_length_m))
 
 
-def assign_refrigerant_labels(summary, all_pipes):
-    changed = 0
+def assign_refrigerant_labels(plan, all_pipes):
     for pipe in all_pipes:
         classification = get_pipe_system_classification(pipe)
         if u"Sanitario" in safe_text(classification):
@@ -1036,17 +1513,16 @@ def assign_refrigerant_labels(summary, all_pipes):
             label = u"R-448A"
         elif u"R-134" in fluid_type_name:
             label = u"R-134a"
-        if label and set_param_safe(pipe, PARAM_LEE_REFRIGERANTE, label):
-            changed += 1
-    summary["lee_refrigerante"] += changed
+        if label:
+            plan_param(plan, "lee_refrigerante", pipe, PARAM_LEE_REFRIGERANTE, label)
 
 
-def delete_existing_wall_sweeps(summary):
+def delete_existing_wall_sweeps(plan):
     wall_sweeps = list(FilteredElementCollector(doc).OfClass(WallSweep).ToElements())
-    summary["zocalos_borrados"] += delete_elements_by_ids([ws.Id for ws in wall_sweeps])
+    plan_delete(plan, "zocalos_borrados", [ws.Id for ws in wall_sweeps])
 
 
-def delete_non_pipe_hosted_insulations(summary):
+def delete_non_pipe_hosted_insulations(plan):
     ids_to_delete = []
     for insulation in collect_pipe_insulations():
         host_id = getattr(insulation, "HostElementId", None)
@@ -1058,55 +1534,553 @@ def delete_non_pipe_hosted_insulations(summary):
         host_category_id = host_category.Id.IntegerValue if host_category else None
         if host_category_id != int(BuiltInCategory.OST_PipeCurves):
             ids_to_delete.append(insulation.Id)
-    summary["aislamientos_fittings_borrados"] += delete_elements_by_ids(ids_to_delete)
+    plan_delete(plan, "aislamientos_fittings_borrados", ids_to_delete)
 
 
 def find_wall_sweep_type(type_name):
-    for sweep_type in FilteredElementCollector(doc).WhereElementIsElementType():
-        if get_element_name(sweep_type) == type_name:
-            return sweep_type
-    return None
+    return find_type_by_exact_name(type_name)
 
 
-def create_zocalos(summary):
+def make_wall_sweep_factory(wall, sweep_type_id, wall_side):
+    def create():
+        info = WallSweepInfo(WallSweepType.Sweep, False)
+        info.Distance = 0.0
+        if wall_side is not None:
+            info.WallSide = wall_side
+        return WallSweep.Create(wall, sweep_type_id, info)
+    return create
+
+
+def create_zocalos(summary, plan):
     sweep_type = find_wall_sweep_type(u"CST_Zocalo")
     if sweep_type is None:
         summary["zocalos_sin_tipo"] += 1
+        plan_incomplete(plan)
         return
 
-    created = []
+    sides = []
     for wall in collect_elements(BuiltInCategory.OST_Walls):
-        wall_type_name = get_element_name(get_element_type(wall))
+        wall_type_name = get_element_type_name(wall)
         if not wall_type_name:
             continue
         if u"zocalo 2 lados" in wall_type_name:
-            ext_info = WallSweepInfo(WallSweepType.Sweep, False)
-            ext_info.Distance = 0.0
-            ext_info.WallSide = WallSide.Exterior
-            created.append(WallSweep.Create(wall, sweep_type.Id, ext_info))
+            sides.append((wall, WallSide.Exterior))
+            sides.append((wall, WallSide.Interior))
+        if u"zocalo 1 lado" in wall_type_name:
+            sides.append((wall, None))
+
+    params = [(PARAM_PARTIDAS, u"09"), (PARAM_CODIGO_PRESTO, u"ZOC.PP500.300")]
+    for wall, wall_side in sides:
+        plan_create(
+            plan,
+            "zocalos_creados",
+            make_wall_sweep_factory(wall, sweep_type.Id, wall_side),
+            params,
+            "zocalos_parametrizados",
+        )
 
-            int_info = WallSweepInfo(WallSweepType.Sweep, False)
-            int_info.Distance = 0.0
-            int_info.WallSide = WallSide.Interior
-            created.append(WallSweep.Create(wall, sweep_type.Id, int_info))
 
-        if u"zocalo 1 lado" in wall_type_name:
-            one_side = WallSweepInfo(WallSweepType.Sweep, False)
-            one_side.Distance = 0.0
-            created.append(WallSweep.Create(wall, sweep_type.Id, one_side))
+# Blocks in Dynamo order. "reads"/"writes" are (category, parameter) pairs;
+# "@..." entries stand for values that are not a plain parameter (see
+# read_fingerprint_value) and "@ids" for the set of elements, which every
+# read category includes implicitly. A block depends on every earlier block
+# that writes something it reads or writes. Blocks writing the same pair are
+# fingerprinted together (see get_fingerprint_tokens). Phase 2 blocks are
+# planned after the phase 1 plan (with the pipe type changes) is applied.
+PRESTO_BLOCKS = [
+    {
+        "key": "habitaciones",
+        "name": u"Dynamo - Borrar habitaciones huerfanas",
+        "phase": 1,
+        "reads": [("OST_Rooms", "@perimeter")],
+        "writes": [("OST_Rooms", "@ids")],
+        "run": lambda ctx: delete_orphan_rooms(ctx["plan"], ctx["orphan_room_ids"]),
+    },
+    {
+        "key": "vol_camara",
+        "name": u"Dynamo - Vol.Cámara en equipos",
+        "phase": 1,
+        "reads": [
+            ("OST_Rooms", "@perimeter"),
+            ("OST_Rooms", "@volume"),
+            ("OST_Rooms", "@room_name"),
+            ("OST_MechanicalEquipment", PARAM_UBICACION),
+        ],
+        "writes": [("OST_MechanicalEquipment", PARAM_VOL_CAMARA)],
+        "run": lambda ctx: transfer_room_volume_to_equipment(ctx["plan"], ctx["room_volume_map"]),
+    },
+    {
+        "key": "comentarios_electricos",
+        "name": u"Dynamo - Comentarios eléctricos",
+        "phase": 1,
+        "reads": [
+            ("OST_ElectricalFixtures", PARAM_UBICACION),
+            ("OST_ElectricalFixtures", PARAM_COMENTARIOS2),
+            ("OST_ElectricalEquipment", PARAM_UBICACION),
+            ("OST_ElectricalEquipment", PARAM_COMENTARIOS2),
+        ],
+        "writes": [
+            ("OST_ElectricalFixtures", PARAM_COMENTARIOS),
+            ("OST_ElectricalEquipment", PARAM_COMENTARIOS),
+        ],
+        "run": lambda ctx: set_comments_for_electrical_devices(ctx["plan"]),
+    },
+    {
+        "key": "comentarios_auxiliares",
+        "name": u"Dynamo - Comentarios auxiliares",
+        "phase": 1,
+        "reads": [
+            ("OST_PipeAccessory", PARAM_UBICACION),
+            ("OST_GenericModel", PARAM_UBICACION),
+            ("OST_FurnitureSystems", PARAM_UBICACION),
+        ],
+        "writes": [
+            ("OST_PipeAccessory", PARAM_COMENTARIOS),
+            ("OST_GenericModel", PARAM_COMENTARIOS),
+            ("OST_FurnitureSystems", PARAM_COMENTARIOS),
+        ],
+        "run": lambda ctx: (
+            set_comments_from_location(ctx["plan"], ctx["pipe_accessories"], "comentarios_pipe_accessories"),
+            set_comments_from_location(ctx["plan"], ctx["generic_models"], "comentarios_generic_models"),
+            set_comments_from_location(ctx["plan"], ctx["furniture_systems"], "comentarios_furniture_systems"),
+        ),
+    },
+    {
+        "key": "comentarios_puertas",
+        "name": u"Dynamo - Comentarios puertas",
+        "phase": 1,
+        "reads": [("OST_Doors", PARAM_UBICACION), ("OST_Doors", PARAM_COMENTARIOS2)],
+        "writes": [("OST_Doors", PARAM_COMENTARIOS)],
+        "run": lambda ctx: set_door_comments(ctx["plan"]),
+    },
+    {
+        "key": "partidas_base",
+        "name": u"Dynamo - Partidas PRESTO base",
+        "phase": 1,
+        "reads": [
+            ("OST_PipeCurves", "@ids"),
+            ("OST_PipeInsulations", "@ids"),
+            ("OST_Walls", "@ids"),
+            ("OST_Floors", "@ids"),
+            ("OST_DuctCurves", "@ids"),
+            ("OST_DuctTerminal", "@ids"),
+            ("OST_DuctFitting", "@ids"),
+            ("OST_DuctAccessory", "@ids"),
+        ],
+        "writes": [
+            ("OST_PipeCurves", PARAM_PARTIDAS),
+            ("OST_PipeInsulations", PARAM_PARTIDAS),
+            ("OST_Walls", PARAM_PARTIDAS),
+            ("OST_Floors", PARAM_PARTIDAS),
+            ("OST_DuctCurves", PARAM_PARTIDAS),
+            ("OST_DuctTerminal", PARAM_PARTIDAS),
+            ("OST_DuctFitting", PARAM_PARTIDAS),
+            ("OST_DuctAccessory", PARAM_PARTIDAS),
+        ],
+        "run": lambda ctx: assign_partidas_by_category(ctx["plan"]),
+    },
+    {
+        "key": "partidas_sala_maquinas",
+        "name": u"Dynamo - Partidas sala de máquinas",
+        "phase": 1,
+        "reads": [("OST_PipeCurves", "@system")],
+        "writes": [("OST_PipeCurves", PARAM_PARTIDAS)],
+        "run": lambda ctx: assign_sala_maquinas_partidas(ctx["plan"], ctx["sala_maquinas_pipes"]),
+    },
+    {
+        "key": "sup_bruta_panel",
+        "name": u"Dynamo - sup.bruta.panel",
+        "phase": 1,
+        "reads": [("OST_Walls", "@length"), ("OST_Walls", "@height"), ("OST_Floors", "@area")],
+        "writes": [("OST_Walls", PARAM_SUP_BRUTA_PANEL), ("OST_Floors", PARAM_SUP_BRUTA_PANEL)],
+        "run": lambda ctx: assign_panel_gross_area(ctx["plan"]),
+    },
+    {
+        "key": "areas_conductos",
+        "name": u"Dynamo - Áreas conductos",
+        "phase": 1,
+        "reads": [
+            ("OST_DuctCurves", u"Anchura"),
+            ("OST_DuctCurves", u"Altura"),
+            ("OST_DuctCurves", u"Longitud"),
+            ("OST_DuctFitting", "@geometry"),
+            ("OST_DuctFitting", PARAM_DUCT_CONNECTION_AREA),
+        ],
+        "writes": [
+            ("OST_DuctCurves", PARAM_DUCT_FITTING_AREA),
+            ("OST_DuctFitting", PARAM_DUCT_FITTING_AREA),
+        ],
+        "run": lambda ctx: assign_duct_areas(ctx["summary"], ctx["plan"]),
+    },
+    {
+        "key": "tipos_tuberias",
+        "name": u"Dynamo - Cambio de tipo de tuberías",
+        "phase": 1,
+        "reads": [("OST_PipeCurves", "@system")],
+        # New pipe types may change sizes and lengths and recreate the
+        # fittings (and the insulations hosted on them).
+        "writes": [
+            ("OST_PipeCurves", "@type"),
+            ("OST_PipeCurves", "@diameter"),
+            ("OST_PipeCurves", "@length"),
+            ("OST_PipeCurves", u"Tamaño"),
+            ("OST_PipeInsulations", "@ids"),
+        ],
+        "run": lambda ctx: change_pipe_types(ctx["summary"], ctx["plan"], ctx["changed_groups"]),
+    },
+    {
+        "key": "codigo_cerramientos",
+        "name": u"Dynamo - Codigo_Presto cerramientos",
+        "phase": 1,
+        "reads": [("OST_Walls", "type:" + PARAM_CODIGO_MONTAJE), ("OST_Floors", "type:" + PARAM_CODIGO_MONTAJE)],
+        "writes": [("OST_Walls", PARAM_CODIGO_PRESTO), ("OST_Floors", PARAM_CODIGO_PRESTO)],
+        "run": lambda ctx: assign_wall_floor_presto_codes(ctx["plan"]),
+    },
+    {
+        "key": "codigo_conductos",
+        "name": u"Dynamo - Codigo_Presto conductos",
+        "phase": 1,
+        "reads": [("OST_DuctCurves", "@type_name")],
+        "writes": [("OST_DuctCurves", PARAM_CODIGO_PRESTO)],
+        "run": lambda ctx: assign_duct_presto_codes(ctx["plan"]),
+    },
+    {
+        "key": "lee_refrigerante",
+        "name": u"Dynamo - Lee_Refrigerante",
+        "phase": 1,
+        "reads": [("OST_PipeCurves", "@system")],
+        "writes": [("OST_PipeCurves", PARAM_LEE_REFRIGERANTE)],
+        "run": lambda ctx: assign_refrigerant_labels(ctx["plan"], ctx["all_pipes"]),
+    },
+    {
+        "key": "borrar_barridos",
+        "name": u"Dynamo - Borrar barridos de muro",
+        "phase": 1,
+        "reads": [("OST_Cornices", "@ids")],
+        "writes": [("OST_Cornices", "@ids")],
+        "run": lambda ctx: delete_existing_wall_sweeps(ctx["plan"]),
+    },
+    {
+        "key": "crear_zocalos",
+        "name": u"Dynamo - Crear zócalos",
+        "phase": 1,
+        "reads": [("OST_Cornices", "@ids"), ("OST_Walls", "@type_name")],
+        "writes": [
+            ("OST_Cornices", "@ids"),
+            ("OST_Cornices", PARAM_PARTIDAS),
+            ("OST_Cornices", PARAM_CODIGO_PRESTO),
+        ],
+        "run": lambda ctx: create_zocalos(ctx["summary"], ctx["plan"]),
+    },
+    {
+        "key": "codigo_tuberias",
+        "name": u"Dynamo - Codigo_Presto tuberías",
+        "phase": 2,
+        "reads": [("OST_PipeCurves", "@system"), ("OST_PipeCurves", "@diameter")],
+        "writes": [("OST_PipeCurves", PARAM_CODIGO_PRESTO)],
+        "run": lambda ctx: assign_pipe_presto_codes(ctx["plan"], ctx["changed_groups"]),
+    },
+    {
+        "key": "codigo_aislamientos",
+        "name": u"Dynamo - Codigo_Presto aislamientos",
+        "phase": 2,
+        "reads": [("OST_PipeInsulations", "@type_name")],
+        "writes": [("OST_PipeInsulations", PARAM_CODIGO_PRESTO)],
+        "run": lambda ctx: assign_insulation_presto_codes(ctx["plan"]),
+    },
+    {
+        "key": "long_bruta_tuberias",
+        "name": u"Dynamo - long.bruta.tub tuberías",
+        "phase": 2,
+        "reads": [
+            ("OST_PipeCurves", "@system"),
+            ("OST_PipeCurves", "@length"),
+            ("OST_PipeCurves", u"Tamaño"),
+        ],
+        "writes": [("OST_PipeCurves", PARAM_LONG_BRUTA_TUB)],
+        "run": lambda ctx: assign_pipe_gross_lengths(ctx["plan"], ctx["all_pipes"], ctx["sala_maquinas_pipes"]),
+    },
+    {
+        "key": "borrar_aislamientos_fittings",
+        "name": u"Dynamo - Borrar aislamientos fittings",
+        "phase": 2,
+        "reads": [("OST_PipeInsulations", "@host")],
+        "writes": [("OST_PipeInsulations", "@ids")],
+        "run": lambda ctx: delete_non_pipe_hosted_insulations(ctx["plan"]),
+    },
+    {
+        "key": "long_bruta_aislamientos",
+        "name": u"Dynamo - long.bruta.tub aislamientos",
+        "phase": 2,
+        "reads": [
+            ("OST_PipeCurves", u"Tipo de aislamiento"),
+            ("OST_PipeCurves", "@length"),
+            ("OST_PipeInsulations", "@host"),
+        ],
+        "writes": [("OST_PipeInsulations", PARAM_LONG_BRUTA_TUB)],
+        "run": lambda ctx: assign_pipe_insulation_gross_lengths(ctx["plan"]),
+    },
+]
+
+
+def get_block_read_tokens(block):
+    tokens = set(block["reads"])
+    tokens.update((category_name, "@ids") for category_name, _ in block["reads"])
+    return tokens
+
+
+def get_block_dependencies(blocks):
+    dependencies = {}
+    for index, block in enumerate(blocks):
+        touched = get_block_read_tokens(block) | set(block["writes"])
+        dependencies[block["key"]] = [
+            earlier["key"] for earlier in blocks[:index] if touched & set(earlier["writes"])
+        ]
+    return dependencies
+
+
+def get_fingerprint_tokens(blocks):
+    # A block is fingerprinted with what it reads and what it writes; the
+    # saved fingerprint is taken after the plan is applied, so it only
+    # matches while the outputs are still in the model.
+    # Blocks that write the same (category, parameter) form one unit: each
+    # one is fingerprinted with the tokens of the whole unit, so when any of
+    # them has to run they all do, in block order. Otherwise an earlier
+    # writer (base partidas) would be skipped while a later one (sala de
+    # maquinas) stops overriding some elements, leaving stale values; and
+    # wall sweeps would be created without deleting the previous ones.
+    unit_of = dict((block["key"], block["key"]) for block in blocks)
+
+    def find(key):
+        while unit_of[key] != key:
+            key = unit_of[key]
+        return key
+
+    writers = defaultdict(list)
+    for block in blocks:
+        for token in block["writes"]:
+            writers[token].append(block["key"])
+    for keys in writers.values():
+        for key in keys[1:]:
+            unit_of[find(key)] = find(keys[0])
+
+    unit_tokens = defaultdict(set)
+    for block in blocks:
+        unit_tokens[find(block["key"])].update(get_block_read_tokens(block))
+        unit_tokens[find(block["key"])].update(block["writes"])
+    return dict((block["key"], unit_tokens[find(block["key"])]) for block in blocks)
+
+
+def get_scheduled_blocks(blocks, dependencies, selected_keys):
+    if not selected_keys:
+        return set(block["key"] for block in blocks)
+    dependents = defaultdict(list)
+    for key, upstream in dependencies.items():
+        for upstream_key in upstream:
+            dependents[upstream_key].append(key)
+
+    def walk(start_keys, edges):
+        seen = set()
+        pending = list(start_keys)
+        while pending:
+            key = pending.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            pending.extend(edges.get(key, []))
+        return seen
 
-    parametrized = 0
-    for sweep in created:
-        ok_partida = set_param_safe(sweep, PARAM_PARTIDAS, u"09")
-        ok_codigo = set_param_safe(sweep, PARAM_CODIGO_PRESTO, u"ZOC.PP500.300")
-        if ok_partida or ok_codigo:
-            parametrized += 1
+    known = set(block["key"] for block in blocks)
+    selected = [key for key in selected_keys if key in known]
+    return walk(selected, dependencies) | walk(selected, dependents)
 
-    summary["zocalos_creados"] += len(created)
-    summary["zocalos_parametrizados"] += parametrized
+
+def format_fingerprint_value(value):
+    if isinstance(value, float):
+        return u"{:.6f}".format(value)
+    if isinstance(value, Element):
+        return u"{}".format(value.Id.IntegerValue)
+    return safe_text(value)
+
+
+def read_builtin_value(elem, built_in_param):
+    try:
+        param = elem.get_Parameter(built_in_param)
+    except Exception:
+        param = None
+    return get_parameter_value(param) if param else None
 
 
-def print_summary(summary, errors):
+def read_fingerprint_value(elem, token):
+    if token == "@ids":
+        return u""
+    if token == "@type":
+        return elem.GetTypeId().IntegerValue
+    if token == "@type_name":
+        return get_element_type_name(elem)
+    if token.startswith("type:"):
+        return get_type_param_text(get_element_type(elem), token[len("type:"):])
+    if token == "@system":
+        return u"|".join([
+            safe_text(get_pipe_system_type_name(elem)),
+            safe_text(get_pipe_system_abbreviation(elem)),
+            safe_text(get_pipe_system_classification(elem)),
+            safe_text(get_pipe_fluid_type_name(elem)),
+        ])
+    if token == "@diameter":
+        return get_pipe_diameter_ft(elem)
+    if token == "@length":
+        return read_builtin_value(elem, BuiltInParameter.CURVE_ELEM_LENGTH)
+    if token == "@height":
+        return read_builtin_value(elem, BuiltInParameter.WALL_USER_HEIGHT_PARAM)
+    if token == "@area":
+        return read_builtin_value(elem, BuiltInParameter.HOST_AREA_COMPUTED)
+    if token == "@perimeter":
+        return read_builtin_value(elem, BuiltInParameter.ROOM_PERIMETER)
+    if token == "@volume":
+        return read_builtin_value(elem, BuiltInParameter.ROOM_VOLUME)
+    if token == "@room_name":
+        return get_room_name(elem)
+    if token == "@host":
+        host_id = getattr(elem, "HostElementId", None)
+        host = doc.GetElement(host_id) if host_id and host_id != ElementId.InvalidElementId else None
+        host_category = getattr(host, "Category", None) if host is not None else None
+        return u"{}:{}".format(
+            host_id.IntegerValue if host is not None else u"",
+            host_category.Id.IntegerValue if host_category else u"",
+        )
+    if token == "@geometry":
+        return get_duct_fitting_signature(elem)
+    return get_parameter_value(get_parameter(elem, [token]))
+
+
+def get_read_digest(category_name, token, digests):
+    # digests memoizes per fingerprint pass: the element lists per category
+    # and the digest per (category, token), shared by all blocks.
+    key = (category_name, token)
+    if key in digests:
+        return digests[key]
+    elements = digests.get(category_name)
+    if elements is None:
+        try:
+            elements = collect_elements(getattr(BuiltInCategory, category_name))
+        except Exception:
+            elements = []
+        elements = sorted(elements, key=lambda elem: elem.Id.IntegerValue)
+        digests[category_name] = elements
+    digest = hashlib.md5()
+    for elem in elements:
+        try:
+            value = format_fingerprint_value(read_fingerprint_value(elem, token))
+        except Exception as err:
+            value = u"!{}".format(safe_text(err))
+        digest.update(u"{}={};".format(elem.Id.IntegerValue, value).encode("utf-8"))
+    digests[key] = digest.hexdigest()
+    return digests[key]
+
+
+def get_block_fingerprint(block, fingerprint_tokens, digests):
+    digest = hashlib.md5()
+    digest.update(u"{}|{}".format(BLOCK_STATE_VERSION, block["key"]).encode("utf-8"))
+    for category_name, token in sorted(fingerprint_tokens[block["key"]]):
+        digest.update(u"|{}:{}={}".format(
+            category_name, token, get_read_digest(category_name, token, digests)
+        ).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_block_state():
+    data = load_json_sidecar(get_model_sidecar_path(BLOCK_STATE_SUFFIX))
+    if not isinstance(data, dict) or data.get("version") != BLOCK_STATE_VERSION:
+        return {}
+    return dict(data.get("fingerprints") or {})
+
+
+def save_block_state(fingerprints):
+    return save_json_sidecar(
+        get_model_sidecar_path(BLOCK_STATE_SUFFIX),
+        {"version": BLOCK_STATE_VERSION, "fingerprints": fingerprints},
+    )
+
+
+def get_block_skip_reason(block, dependencies, scheduled, ran, saved_fingerprints, fingerprint_tokens, digests):
+    # None means the block has to run.
+    if any(key in ran for key in dependencies[block["key"]]):
+        return None
+    if block["key"] not in scheduled:
+        return u"no seleccionado"
+    if not SKIP_UNCHANGED_BLOCKS:
+        return None
+    saved = saved_fingerprints.get(block["key"])
+    if saved and saved == get_block_fingerprint(block, fingerprint_tokens, digests):
+        return u"sin cambios"
+    return None
+
+
+def run_presto_blocks(ctx, errors, timings, block_rows):
+    # Returns the fingerprints to save once the transaction group is kept,
+    # or None when SKIP_UNCHANGED_BLOCKS is off.
+    dependencies = get_block_dependencies(PRESTO_BLOCKS)
+    scheduled = get_scheduled_blocks(PRESTO_BLOCKS, dependencies, SELECTED_BLOCKS)
+    fingerprint_tokens = get_fingerprint_tokens(PRESTO_BLOCKS)
+    saved_fingerprints = load_block_state() if SKIP_UNCHANGED_BLOCKS else {}
+    block_phases = dict((block["key"], block["phase"]) for block in PRESTO_BLOCKS)
+    ran = set()
+    failed = set()
+    omitted = set()
+
+    phases = (
+        (1, u"Dynamo - Aplicar modelo"),
+        (2, u"Dynamo - Aplicar tras cambio de tipo"),
+    )
+    for phase, apply_name in phases:
+        # Fingerprints are read per phase: phase 2 reads the model after the
+        # phase 1 plan has been applied.
+        digests = {}
+        ctx["plan"] = new_write_plan()
+        phase_ran = False
+        for block in PRESTO_BLOCKS:
+            if block["phase"] != phase:
+                continue
+            if any(
+                key in omitted or (key in failed and block_phases[key] < phase)
+                for key in dependencies[block["key"]]
+            ):
+                # It would read a model an earlier phase failed to change.
+                failed.add(block["key"])
+                omitted.add(block["key"])
+                block_rows.append([block["name"], u"omitido: dependencia no aplicada"])
+                continue
+            reason = get_block_skip_reason(
+                block, dependencies, scheduled, ran, saved_fingerprints, fingerprint_tokens, digests
+            )
+            if reason is not None:
+                block_rows.append([block["name"], reason])
+                continue
+            error_count = len(errors)
+            ctx["plan"]["block"] = block["key"]
+            plan_block(block["name"], lambda block=block: block["run"](ctx), errors, timings)
+            if len(errors) > error_count:
+                failed.add(block["key"])
+            ran.add(block["key"])
+            phase_ran = True
+            block_rows.append([block["name"], u"ejecutado"])
+        if phase_ran:
+            failed.update(apply_write_plan(apply_name, ctx["plan"], ctx["summary"], errors, timings))
+
+    if not SKIP_UNCHANGED_BLOCKS:
+        return None
+    digests = {}
+    for block in PRESTO_BLOCKS:
+        key = block["key"]
+        if key in failed:
+            saved_fingerprints.pop(key, None)
+        elif key in ran:
+            saved_fingerprints[key] = get_block_fingerprint(block, fingerprint_tokens, digests)
+    return saved_fingerprints
+
+
+def print_summary(summary, errors, timings, block_rows):
     rows = [
         [u"Habitaciones borradas", summary.get("rooms_deleted", 0)],
         [u"Vol.Cámara en equipos", summary.get("vol_camara", 0)],
@@ -1119,6 +2093,9 @@ def print_summary(summary, errors):
         [u"Partidas sala máquinas", summary.get("partidas_sala_maquinas", 0)],
         [u"sup.bruta.panel", summary.get("sup_bruta_panel", 0)],
         [u"Áreas conductos/uniones", summary.get("duct_areas", 0)],
+        [u"Áreas uniones medidas", summary.get("duct_area_measured", 0)],
+        [u"Áreas uniones desde caché", summary.get("duct_area_cache_hits", 0)],
+        [u"Tiempo ahorrado caché áreas (s)", u"{:.1f}".format(summary.get("duct_area_saved_s", 0.0))],
         [u"Código PRESTO tuberías", summary.get("codigo_presto_tuberias", 0)],
         [u"Código PRESTO conductos", summary.get("codigo_presto_conductos", 0)],
         [u"Código PRESTO cerramientos", summary.get("codigo_presto_cerramientos", 0)],
@@ -1142,6 +2119,27 @@ def print_summary(summary, errors):
         for row in rows:
             output.print_md("| {} | {} |".format(row[0], row[1]))
 
+    if block_rows:
+        output.print_md("## Bloques")
+        if hasattr(output, "print_table"):
+            output.print_table(table_data=block_rows, columns=[u"Bloque", u"Estado"])
+        else:
+            output.print_md("| Bloque | Estado |")
+            output.print_md("|---|---|")
+            for row in block_rows:
+                output.print_md("| {} | {} |".format(row[0], row[1]))
+
+    if timings:
+        output.print_md("## Tiempos")
+        timing_rows = [[name, u"{:.2f}".format(seconds)] for name, seconds in timings]
+        if hasattr(output, "print_table"):
+            output.print_table(table_data=timing_rows, columns=[u"Bloque", u"s"])
+        else:
+            output.print_md("| Bloque | s |")
+            output.print_md("|---|---|")
+            for row in timing_rows:
+                output.print_md("| {} | {} |".format(row[0], row[1]))
+
     if errors:
         output.print_md("## Incidencias")
         for err in errors:
@@ -1151,63 +2149,42 @@ def print_summary(summary, errors):
 def main():
     summary = defaultdict(int)
     errors = []
+    timings = []
+    block_rows = []
+    reset_type_catalog()
+    reset_duct_area_cache()
 
     all_pipes = collect_elements(BuiltInCategory.OST_PipeCurves)
-    pipe_accessories = collect_elements(BuiltInCategory.OST_PipeAccessory)
-    generic_models = collect_elements(BuiltInCategory.OST_GenericModel)
-    furniture_systems = collect_elements(BuiltInCategory.OST_FurnitureSystems)
+    pipe_fields = read_pipe_system_fields(all_pipes)
+    valid_rooms, orphan_room_ids = split_orphan_rooms()
+    summary["rooms_valid"] = len(valid_rooms)
+    ctx = {
+        "summary": summary,
+        "all_pipes": all_pipes,
+        "pipe_accessories": collect_elements(BuiltInCategory.OST_PipeAccessory),
+        "generic_models": collect_elements(BuiltInCategory.OST_GenericModel),
+        "furniture_systems": collect_elements(BuiltInCategory.OST_FurnitureSystems),
+        "orphan_room_ids": orphan_room_ids,
+        "room_volume_map": build_room_volume_map(valid_rooms),
+        "sala_maquinas_pipes": get_sala_maquinas_pipes(all_pipes, pipe_fields),
+        "changed_groups": classify_pipes_by_rule(
+            all_pipes, compile_pipe_type_rules(PIPE_TYPE_RULES), pipe_fields
+        ),
+    }
 
     tx_group = TransactionGroup(doc, u"Antes de mandar a PRESTO (Dynamo)")
     tx_group.Start()
 
     try:
-        valid_rooms = run_block(
-            u"Dynamo - Borrar habitaciones huerfanas",
-            lambda: delete_orphan_rooms(summary),
-            errors,
-        ) or []
-        room_volume_map = build_room_volume_map(valid_rooms)
-
-        run_block(u"Dynamo - Vol.Cámara en equipos", lambda: transfer_room_volume_to_equipment(summary, room_volume_map), errors)
-        run_block(u"Dynamo - Comentarios eléctricos", lambda: set_comments_for_electrical_devices(summary), errors)
-        run_block(
-            u"Dynamo - Comentarios auxiliares",
-            lambda: (
-                set_comments_from_location(summary, pipe_accessories, "comentarios_pipe_accessories"),
-                set_comments_from_location(summary, generic_models, "comentarios_generic_models"),
-                set_comments_from_location(summary, furniture_systems, "comentarios_furniture_systems"),
-            ),
-            errors,
-        )
-        run_block(u"Dynamo - Comentarios puertas", lambda: set_door_comments(summary), errors)
-        run_block(u"Dynamo - Partidas PRESTO base", lambda: assign_partidas_by_category(summary), errors)
-
-        sala_maquinas_pipes = get_sala_maquinas_pipes(all_pipes)
-        run_block(u"Dynamo - Partidas sala de máquinas", lambda: assign_sala_maquinas_partidas(summary, sala_maquinas_pipes), errors)
-        run_block(u"Dynamo - sup.bruta.panel", lambda: assign_panel_gross_area(summary), errors)
-        run_block(u"Dynamo - Áreas conductos", lambda: assign_duct_areas(summary), errors)
-
-        changed_groups = run_block(u"Dynamo - Cambio de tipo de tuberías", lambda: change_pipe_types(summary, all_pipes), errors) or {}
-
-        run_block(u"Dynamo - Codigo_Presto tuberías", lambda: assign_pipe_presto_codes(summary, changed_groups), errors)
-        run_block(u"Dynamo - Codigo_Presto cerramientos", lambda: assign_wall_floor_presto_codes(summary), errors)
-        run_block(u"Dynamo - Codigo_Presto conductos", lambda: assign_duct_presto_codes(summary), errors)
-        run_block(u"Dynamo - Codigo_Presto aislamientos", lambda: assign_insulation_presto_codes(summary), errors)
-
-        run_block(u"Dynamo - long.bruta.tub tuberías", lambda: assign_pipe_gross_lengths(summary, all_pipes, sala_maquinas_pipes), errors)
-        run_block(u"Dynamo - Borrar aislamientos fittings", lambda: delete_non_pipe_hosted_insulations(summary), errors)
-        run_block(u"Dynamo - long.bruta.tub aislamientos", lambda: assign_pipe_insulation_gross_lengths(summary), errors)
-        run_block(u"Dynamo - Lee_Refrigerante", lambda: assign_refrigerant_labels(summary, all_pipes), errors)
-
-        run_block(u"Dynamo - Borrar barridos de muro", lambda: delete_existing_wall_sweeps(summary), errors)
-        run_block(u"Dynamo - Crear zócalos", lambda: create_zocalos(summary), errors)
-
+        fingerprints = run_presto_blocks(ctx, errors, timings, block_rows)
         tx_group.Assimilate()
+        if fingerprints is not None:
+            save_block_state(fingerprints)
     except Exception as fatal_error:
         tx_group.RollBack()
         errors.append(u"FATAL: {}".format(safe_text(fatal_error)))
 
-    print_summary(summary, errors)
+    print_summary(summary, errors, timings, block_rows)
 
     message = (
         u"ANTES DE MANDAR A PRESTO\n\n"
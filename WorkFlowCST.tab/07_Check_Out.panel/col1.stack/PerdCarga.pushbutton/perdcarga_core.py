@@ -0,0 +1,1127 @@
+# -*- coding: utf-8 -*-
+"""
+Nucleo hidraulico de PERDIDA CARGA POR TRAMO sin dependencias de Revit.
+
+Trabaja sobre registros planos: la red CSR (indices densos, tuberias
+primero y uniones despues) y la instantanea de parametros en columnas
+paralelas por indice de tuberia. Lo importa script.py dentro de pyRevit y
+tambien se puede cargar con CPython fuera de Revit (ver
+Helpers/Benchmark PerdCarga).
+
+Compatible con IronPython 2.7 y CPython 3.
+"""
+
+import hashlib
+import math
+from array import array
+from collections import deque
+
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+# NumPy es opcional: no existe en IronPython, si en CPython.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PARENT_ROOT = -1
+PARENT_UNREACHED = -2
+SWEEP_LENGTH = 1
+SWEEP_PRESSURE = 2
+SWEEP_BOTH = SWEEP_LENGTH | SWEEP_PRESSURE
+
+# Por debajo de este numero de tuberias la version pura es mas rapida.
+NUMPY_MIN_ROWS = 20000
+
+
+# ---------------------------------------------------------------------------
+# Conversiones
+# ---------------------------------------------------------------------------
+
+def safe_float(value, default=0.0):
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = None
+    try:
+        text = unicode(value)
+    except Exception:
+        try:
+            text = str(value)
+        except Exception:
+            return default
+    if text is None:
+        return default
+    text = text.strip().replace(",", ".")
+    if not text:
+        return default
+    try:
+        return float(text)
+    except Exception:
+        return default
+
+
+def safe_int(value, default=0):
+    try:
+        return int(round(safe_float(value, default)))
+    except Exception:
+        return default
+
+
+def mm_to_internal_feet(value_mm):
+    return safe_float(value_mm, 0.0) / 304.8
+
+
+def internal_feet_to_mm(value_ft):
+    return safe_float(value_ft, 0.0) * 304.8
+
+
+def feet_to_millimeters(length_in_feet):
+    return safe_float(length_in_feet) / 304.8
+
+
+def bar_to_pa(bar_value):
+    return safe_float(bar_value) * 30480.0
+
+
+def pa_to_bar(pa_value):
+    """Inversa de bar_to_pa: de unidades internas al valor del Dynamo."""
+    return safe_float(pa_value) / 30480.0
+
+
+def calculate_pot_frigorifica(flow, density, delta_h):
+    flow_value = safe_float(flow)
+    density_value = safe_float(density)
+    delta_h_value = safe_float(delta_h)
+
+    flow_m3_s = flow_value * 0.001
+    delta_h_j_kg = delta_h_value * 1000.0
+    watts = flow_m3_s * density_value * delta_h_j_kg
+    return watts / 3.600
+
+
+# ---------------------------------------------------------------------------
+# Instantanea y agrupacion por Tramo
+# ---------------------------------------------------------------------------
+
+def iter_snapshot_pipes(snapshot):
+    for pipe_index, pipe in enumerate(snapshot["pipe"]):
+        if pipe is not None:
+            yield pipe_index, pipe
+
+
+def aggregate_tramo_totals(snapshot, use_numpy=None):
+    """
+    Agrupa las tuberias por la clave Tramo + Nombre de tipo de la instantanea
+    en una sola pasada sobre las columnas, sin volver a leer Revit.
+    Devuelve (counts_by_key, pressure_by_key, length_by_key) con el numero de
+    tuberias y las sumas de "pressure" y "length" por clave.
+
+    Las claves se factorizan a codigos enteros en orden de aparicion y las
+    sumas se acumulan por codigo (numpy.bincount si NumPy esta disponible y
+    hay al menos NUMPY_MIN_ROWS tuberias). Cada grupo se suma en orden de
+    indice de tuberia, el mismo orden que el Dynamo.
+    """
+    group_keys = snapshot["group_key"]
+    pressure_column = snapshot["pressure"]
+    length_column = snapshot["length"]
+    codes = {}
+    unique_keys = []
+    rows = []
+    pressures = []
+    lengths = []
+    for pipe_index, pipe in enumerate(snapshot["pipe"]):
+        if pipe is None:
+            continue
+        key = group_keys[pipe_index]
+        code = codes.get(key)
+        if code is None:
+            code = len(unique_keys)
+            codes[key] = code
+            unique_keys.append(key)
+        rows.append(code)
+        value = pressure_column[pipe_index]
+        pressures.append(value if type(value) is float else safe_float(value, 0.0))
+        value = length_column[pipe_index]
+        lengths.append(value if type(value) is float else safe_float(value, 0.0))
+
+    if use_numpy is None:
+        use_numpy = len(rows) >= NUMPY_MIN_ROWS
+    if use_numpy and numpy is not None and rows:
+        return sum_groups_numpy(unique_keys, rows, pressures, lengths)
+    return sum_groups(unique_keys, rows, pressures, lengths)
+
+
+def sum_groups(unique_keys, rows, pressures, lengths):
+    size = len(unique_keys)
+    counts = [0] * size
+    pressure_sums = [0.0] * size
+    length_sums = [0.0] * size
+    for position, code in enumerate(rows):
+        counts[code] += 1
+        pressure_sums[code] += pressures[position]
+        length_sums[code] += lengths[position]
+
+    return (
+        dict(zip(unique_keys, counts)),
+        dict(zip(unique_keys, pressure_sums)),
+        dict(zip(unique_keys, length_sums)),
+    )
+
+
+def sum_groups_numpy(unique_keys, rows, pressures, lengths):
+    size = len(unique_keys)
+    codes = numpy.array(rows, dtype=numpy.intp)
+    counts = numpy.bincount(codes, minlength=size)
+    pressure_sums = numpy.bincount(
+        codes, weights=numpy.array(pressures, dtype=float), minlength=size
+    )
+    length_sums = numpy.bincount(
+        codes, weights=numpy.array(lengths, dtype=float), minlength=size
+    )
+    return (
+        dict(zip(unique_keys, counts.tolist())),
+        dict(zip(unique_keys, pressure_sums.tolist())),
+        dict(zip(unique_keys, length_sums.tolist())),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Perdida de carga por Darcy-Weisbach
+# ---------------------------------------------------------------------------
+
+# Propiedades de saturacion aproximadas (densidad kg/m3, viscosidad
+# dinamica uPa.s) por temperatura en C. La fase vapor se usa en aspiracion
+# y la liquida en las lineas de liquido. Fuera de rango se toma el extremo.
+REFRIGERANT_TABLES = {
+    u"R-744": {
+        "temperature": (-50.0, -40.0, -30.0, -20.0, -10.0, 0.0, 10.0, 20.0, 30.0),
+        "liquid": {
+            "density": (1155.0, 1118.0, 1077.0, 1032.0, 983.0, 928.0, 861.0, 773.0, 598.0),
+            "viscosity": (200.0, 172.0, 150.0, 132.0, 115.0, 100.0, 85.0, 70.0, 48.0),
+        },
+        "vapor": {
+            "density": (17.9, 26.1, 37.8, 51.7, 71.1, 97.6, 135.0, 194.0, 346.0),
+            "viscosity": (11.0, 11.6, 12.2, 12.9, 13.6, 14.6, 15.9, 17.9, 23.0),
+        },
+    },
+    u"R-448A": {
+        "temperature": (-40.0, -30.0, -20.0, -10.0, 0.0, 10.0, 20.0, 30.0, 40.0, 50.0),
+        "liquid": {
+            "density": (1350.0, 1320.0, 1288.0, 1255.0, 1220.0, 1183.0, 1144.0, 1102.0, 1057.0, 1006.0),
+            "viscosity": (400.0, 345.0, 300.0, 262.0, 230.0, 202.0, 178.0, 157.0, 138.0, 121.0),
+        },
+        "vapor": {
+            "density": (6.0, 9.0, 13.0, 18.3, 25.0, 33.6, 44.5, 58.3, 76.0, 99.0),
+            "viscosity": (9.8, 10.2, 10.6, 11.0, 11.4, 11.8, 12.3, 12.8, 13.4, 14.1),
+        },
+    },
+    u"R-134a": {
+        "temperature": (-40.0, -30.0, -20.0, -10.0, 0.0, 10.0, 20.0, 30.0, 40.0, 50.0),
+        "liquid": {
+            "density": (1414.0, 1385.0, 1358.0, 1327.0, 1295.0, 1261.0, 1225.0, 1187.0, 1147.0, 1102.0),
+            "viscosity": (489.0, 420.0, 365.0, 319.0, 281.0, 249.0, 221.0, 197.0, 175.0, 156.0),
+        },
+        "vapor": {
+            "density": (2.77, 4.43, 6.79, 10.0, 14.4, 20.2, 27.8, 37.5, 50.1, 66.3),
+            "viscosity": (9.5, 9.9, 10.3, 10.7, 11.0, 11.4, 11.8, 12.2, 12.7, 13.2),
+        },
+    },
+}
+PHASE_LIQUID = "liquid"
+PHASE_VAPOR = "vapor"
+LAMINAR_REYNOLDS = 2300.0
+
+# (refrigerante, fase, temperatura redondeada) -> (densidad, viscosidad Pa.s).
+# Los sistemas comparten temperatura, asi que hay muy pocas claves.
+FLUID_PROPERTY_CACHE = {}
+
+
+def interpolate_table(xs, ys, x):
+    if x <= xs[0]:
+        return ys[0]
+    if x >= xs[-1]:
+        return ys[-1]
+    for position in xrange(1, len(xs)):
+        if x <= xs[position]:
+            x0 = xs[position - 1]
+            y0 = ys[position - 1]
+            ratio = (x - x0) / (xs[position] - x0)
+            return y0 + ratio * (ys[position] - y0)
+    return ys[-1]
+
+
+def get_fluid_properties(refrigerant, phase, temperature_c):
+    """
+    Devuelve (densidad kg/m3, viscosidad dinamica Pa.s) interpolados en la
+    tabla del refrigerante, o None si el refrigerante no esta tabulado.
+    """
+    key = (refrigerant, phase, round(temperature_c, 2))
+    if key in FLUID_PROPERTY_CACHE:
+        return FLUID_PROPERTY_CACHE[key]
+
+    table = REFRIGERANT_TABLES.get(refrigerant)
+    properties = None
+    if table is not None and phase in table:
+        temperatures = table["temperature"]
+        properties = (
+            interpolate_table(temperatures, table[phase]["density"], temperature_c),
+            interpolate_table(temperatures, table[phase]["viscosity"], temperature_c) * 1e-6,
+        )
+    FLUID_PROPERTY_CACHE[key] = properties
+    return properties
+
+
+def churchill_friction_factor(reynolds, relative_roughness):
+    """Factor de friccion de Darcy (Churchill 1977; 64/Re en laminar)."""
+    if reynolds < LAMINAR_REYNOLDS:
+        return 64.0 / reynolds
+    a = (2.457 * math.log(1.0 / ((7.0 / reynolds) ** 0.9 + 0.27 * relative_roughness))) ** 16
+    b = (37530.0 / reynolds) ** 16
+    return 8.0 * ((8.0 / reynolds) ** 12 + (a + b) ** -1.5) ** (1.0 / 12.0)
+
+
+def compute_darcy_pressure_drops(inputs, roughness_m, use_numpy=None):
+    """
+    Perdida de carga por friccion (Pa) de todas las tuberias en una pasada.
+
+    inputs son columnas por indice de tuberia en unidades SI: "flow" (m3/s),
+    "diameter" (m, interior), "length" (m), "refrigerant", "phase" y
+    "temperature" (C). Devuelve una lista con None en las tuberias sin datos
+    validos (sin diametro o refrigerante no tabulado); caudal nulo da 0.0.
+    """
+    flows = inputs["flow"]
+    diameters = inputs["diameter"]
+    lengths = inputs["length"]
+    refrigerants = inputs["refrigerant"]
+    phases = inputs["phase"]
+    temperatures = inputs["temperature"]
+    fluids = {}
+    rows = []
+    row_flows = []
+    row_diameters = []
+    row_lengths = []
+    row_densities = []
+    row_viscosities = []
+    for pipe_index in xrange(len(flows)):
+        flow = flows[pipe_index]
+        diameter = diameters[pipe_index]
+        if flow is None or not diameter or diameter <= 0.0:
+            continue
+        fluid_key = (refrigerants[pipe_index], phases[pipe_index], temperatures[pipe_index])
+        properties = fluids.get(fluid_key, False)
+        if properties is False:
+            temperature = fluid_key[2]
+            properties = get_fluid_properties(
+                fluid_key[0], fluid_key[1], 0.0 if temperature is None else temperature
+            )
+            fluids[fluid_key] = properties
+        if properties is None:
+            continue
+        rows.append(pipe_index)
+        row_flows.append(abs(flow))
+        row_diameters.append(diameter)
+        row_lengths.append(lengths[pipe_index] or 0.0)
+        row_densities.append(properties[0])
+        row_viscosities.append(properties[1])
+
+    result = [None] * len(flows)
+    if not rows:
+        return result
+
+    if use_numpy is None:
+        use_numpy = len(rows) >= NUMPY_MIN_ROWS
+    if use_numpy and numpy is not None:
+        drops = darcy_drops_numpy(
+            row_flows, row_diameters, row_lengths, row_densities, row_viscosities, roughness_m
+        )
+    else:
+        drops = darcy_drops(
+            row_flows, row_diameters, row_lengths, row_densities, row_viscosities, roughness_m
+        )
+    for position, pipe_index in enumerate(rows):
+        result[pipe_index] = drops[position]
+    return result
+
+
+def darcy_drops(flows, diameters, lengths, densities, viscosities, roughness_m):
+    drops = []
+    for position in xrange(len(flows)):
+        flow = flows[position]
+        if flow <= 0.0:
+            drops.append(0.0)
+            continue
+        diameter = diameters[position]
+        density = densities[position]
+        velocity = flow / (math.pi * diameter * diameter / 4.0)
+        reynolds = density * velocity * diameter / viscosities[position]
+        friction = churchill_friction_factor(reynolds, roughness_m / diameter)
+        drops.append(
+            friction * lengths[position] / diameter * density * velocity * velocity / 2.0
+        )
+    return drops
+
+
+def darcy_drops_numpy(flows, diameters, lengths, densities, viscosities, roughness_m):
+    flow = numpy.array(flows, dtype=float)
+    diameter = numpy.array(diameters, dtype=float)
+    density = numpy.array(densities, dtype=float)
+    velocity = flow / (numpy.pi * diameter * diameter / 4.0)
+    reynolds = density * velocity * diameter / numpy.array(viscosities, dtype=float)
+
+    friction = numpy.zeros(len(flows))
+    laminar = (reynolds > 0.0) & (reynolds < LAMINAR_REYNOLDS)
+    friction[laminar] = 64.0 / reynolds[laminar]
+    turbulent = reynolds >= LAMINAR_REYNOLDS
+    re_t = reynolds[turbulent]
+    a = (2.457 * numpy.log(
+        1.0 / ((7.0 / re_t) ** 0.9 + 0.27 * roughness_m / diameter[turbulent])
+    )) ** 16
+    b = (37530.0 / re_t) ** 16
+    friction[turbulent] = 8.0 * ((8.0 / re_t) ** 12 + (a + b) ** -1.5) ** (1.0 / 12.0)
+
+    drops = friction * numpy.array(lengths, dtype=float) / diameter * density * velocity * velocity / 2.0
+    return drops.tolist()
+
+
+# ---------------------------------------------------------------------------
+# Red y recorridos
+# ---------------------------------------------------------------------------
+
+def build_network_from_links(node_ids, pipe_count, fitting_links):
+    """
+    Construye la red CSR a partir de los ids de nodo (tuberias primero) y de
+    la lista [(indice_union, [indices_tuberia])]. Los vecinos del nodo i son
+    targets[offsets[i]:offsets[i + 1]], en el orden de fitting_links.
+    """
+    node_count = len(node_ids)
+    degrees = [0] * node_count
+    for fitting_index, linked in fitting_links:
+        degrees[fitting_index] += len(linked)
+        for pipe_index in linked:
+            degrees[pipe_index] += 1
+
+    offsets = array("i", [0] * (node_count + 1))
+    running = 0
+    for node in xrange(node_count):
+        offsets[node] = running
+        running += degrees[node]
+    offsets[node_count] = running
+
+    targets = array("i", [0] * running)
+    cursor = array("i", offsets[:node_count])
+    for fitting_index, linked in fitting_links:
+        for pipe_index in linked:
+            targets[cursor[fitting_index]] = pipe_index
+            cursor[fitting_index] += 1
+            targets[cursor[pipe_index]] = fitting_index
+            cursor[pipe_index] += 1
+
+    return {
+        "node_ids": node_ids,
+        "index": dict((node_id, node) for node, node_id in enumerate(node_ids)),
+        "pipe_count": pipe_count,
+        "offsets": offsets,
+        "targets": targets,
+    }
+
+
+def get_pipe_path_indexes(parents, pipe_index):
+    """
+    Indices de tuberia de la ruta desde la inicial hasta pipe_index,
+    siguiendo los punteros al padre (vacia si pipe_index no se alcanzo).
+    """
+    path = []
+    if parents[pipe_index] == PARENT_UNREACHED:
+        return path
+    cursor = pipe_index
+    steps = 0
+    while cursor >= 0 and steps <= len(parents):
+        path.append(cursor)
+        cursor = parents[cursor]
+        steps += 1
+    path.reverse()
+    return path
+
+
+def count_reached_pipes(parents):
+    return sum(1 for parent in parents if parent != PARENT_UNREACHED)
+
+
+def get_fitting_weights(network, fitting_weights):
+    """Pesos por nodo de las uniones; sin pesos, ceros (acc + 0.0 == acc)."""
+    if fitting_weights is None:
+        return [0.0] * len(network["node_ids"])
+    return fitting_weights
+
+
+def sweep_first_visit(network, pipe_weights, start_indexes, fitting_weights=None):
+    """
+    BFS con visitados globales: cada nodo se acumula la primera vez que se
+    alcanza. Replica el recorrido de longitud acumulada del Dynamo con cola
+    O(1) y punteros al padre en lugar de copiar la ruta en cada salto.
+
+    fitting_weights (por indice de nodo) se suma al pasar por cada union.
+    """
+    pipe_count = network["pipe_count"]
+    offsets = network["offsets"]
+    targets = network["targets"]
+    fitting_weights = get_fitting_weights(network, fitting_weights)
+
+    cumulative = [0.0] * pipe_count
+    parents = array("i", [PARENT_UNREACHED] * pipe_count)
+    visited = bytearray(len(network["node_ids"]))
+
+    for start in start_indexes:
+        if start >= pipe_count or visited[start]:
+            continue
+
+        start_value = pipe_weights[start]
+        visited[start] = 1
+        cumulative[start] = start_value
+        parents[start] = PARENT_ROOT
+        queue = deque([(start, start_value, start)])
+
+        while queue:
+            current, acc, last_pipe = queue.popleft()
+            for slot in xrange(offsets[current], offsets[current + 1]):
+                neighbor = targets[slot]
+                if visited[neighbor]:
+                    continue
+                visited[neighbor] = 1
+                if neighbor < pipe_count:
+                    value = acc + pipe_weights[neighbor]
+                    cumulative[neighbor] = value
+                    parents[neighbor] = last_pipe
+                    queue.append((neighbor, value, neighbor))
+                else:
+                    queue.append((neighbor, acc + fitting_weights[neighbor], last_pipe))
+
+    return cumulative, parents
+
+
+def sweep_max_relaxation(network, pipe_weights, start_indexes, fitting_weights=None):
+    """
+    BFS por tuberia inicial con visitados locales: una tuberia se reencola si
+    se alcanza con un acumulado mayor al ya registrado. Las demas tuberias
+    iniciales actuan como barrera. Replica el recorrido de perdida de carga
+    acumulada del Dynamo.
+
+    Ademas devuelve cuantas veces se comparo una tuberia ya alcanzada desde
+    otro recorrido ("disputas"). Con cero disputas el arbol de padres no
+    depende de los pesos y se puede recalcular por subarboles.
+    """
+    pipe_count = network["pipe_count"]
+    offsets = network["offsets"]
+    targets = network["targets"]
+    node_count = len(network["node_ids"])
+    fitting_weights = get_fitting_weights(network, fitting_weights)
+
+    is_start = bytearray(node_count)
+    for start in start_indexes:
+        is_start[start] = 1
+
+    cumulative = [0.0] * pipe_count
+    parents = array("i", [PARENT_UNREACHED] * pipe_count)
+    contested = 0
+
+    for start in start_indexes:
+        if start >= pipe_count:
+            continue
+
+        start_value = pipe_weights[start]
+        cumulative[start] = start_value
+        parents[start] = PARENT_ROOT
+        queue = deque([(start, start_value, start)])
+        visited_fittings = bytearray(node_count)
+        visited_pipes = bytearray(pipe_count)
+        visited_pipes[start] = 1
+
+        while queue:
+            current, acc, last_pipe = queue.popleft()
+            if current >= pipe_count:
+                if visited_fittings[current]:
+                    continue
+                visited_fittings[current] = 1
+
+            for slot in xrange(offsets[current], offsets[current + 1]):
+                neighbor = targets[slot]
+                if is_start[neighbor] and neighbor != start:
+                    continue
+                if neighbor < pipe_count:
+                    if visited_pipes[neighbor]:
+                        continue
+                    value = acc + pipe_weights[neighbor]
+                    reached = parents[neighbor] != PARENT_UNREACHED
+                    if reached:
+                        contested += 1
+                    if not reached or value > cumulative[neighbor]:
+                        cumulative[neighbor] = value
+                        parents[neighbor] = last_pipe
+                        queue.append((neighbor, value, neighbor))
+                        visited_pipes[neighbor] = 1
+                elif not visited_fittings[neighbor]:
+                    queue.append((neighbor, acc + fitting_weights[neighbor], last_pipe))
+
+    return cumulative, parents, contested
+
+
+def sweep_fused(
+    network,
+    length_weights,
+    pressure_weights,
+    start_indexes,
+    length_fitting_weights=None,
+    pressure_fitting_weights=None,
+):
+    """
+    Recorrido unico que produce a la vez la longitud acumulada
+    (sweep_first_visit) y la perdida de carga acumulada
+    (sweep_max_relaxation).
+
+    Ambos recorridos comparten una sola cola FIFO. Cada elemento lleva una
+    mascara con los recorridos a los que pertenece, de modo que el orden
+    relativo de cada uno es identico al de su version separada y los
+    resultados coinciden exactamente. Cada nodo se desencola y se leen sus
+    vecinos una sola vez para los dos acumulados. Las disputas se cuentan
+    igual que en sweep_max_relaxation.
+    """
+    pipe_count = network["pipe_count"]
+    offsets = network["offsets"]
+    targets = network["targets"]
+    node_count = len(network["node_ids"])
+    length_fitting_weights = get_fitting_weights(network, length_fitting_weights)
+    pressure_fitting_weights = get_fitting_weights(network, pressure_fitting_weights)
+
+    is_start = bytearray(node_count)
+    for start in start_indexes:
+        is_start[start] = 1
+
+    length_cumulative = [0.0] * pipe_count
+    length_parents = array("i", [PARENT_UNREACHED] * pipe_count)
+    length_visited = bytearray(node_count)
+    pressure_cumulative = [0.0] * pipe_count
+    pressure_parents = array("i", [PARENT_UNREACHED] * pipe_count)
+    contested = 0
+
+    for start in start_indexes:
+        if start >= pipe_count:
+            continue
+
+        flags = SWEEP_PRESSURE
+        start_length = length_weights[start]
+        start_pressure = pressure_weights[start]
+        if not length_visited[start]:
+            flags = SWEEP_BOTH
+            length_visited[start] = 1
+            length_cumulative[start] = start_length
+            length_parents[start] = PARENT_ROOT
+
+        pressure_cumulative[start] = start_pressure
+        pressure_parents[start] = PARENT_ROOT
+        visited_fittings = bytearray(node_count)
+        visited_pipes = bytearray(pipe_count)
+        visited_pipes[start] = 1
+        queue = deque([(start, flags, start_length, start_pressure, start)])
+        popleft = queue.popleft
+        push = queue.append
+
+        while queue:
+            current, flags, length_acc, pressure_acc, last_pipe = popleft()
+            if current >= pipe_count and flags & SWEEP_PRESSURE:
+                if visited_fittings[current]:
+                    flags &= SWEEP_LENGTH
+                    if not flags:
+                        continue
+                else:
+                    visited_fittings[current] = 1
+
+            for slot in xrange(offsets[current], offsets[current + 1]):
+                neighbor = targets[slot]
+                out_flags = 0
+                if neighbor < pipe_count:
+                    next_length = length_acc
+                    next_pressure = pressure_acc
+                    if flags & SWEEP_LENGTH and not length_visited[neighbor]:
+                        length_visited[neighbor] = 1
+                        next_length = length_acc + length_weights[neighbor]
+                        length_cumulative[neighbor] = next_length
+                        length_parents[neighbor] = last_pipe
+                        out_flags = SWEEP_LENGTH
+                    if (
+                        flags & SWEEP_PRESSURE
+                        and not visited_pipes[neighbor]
+                        and not (is_start[neighbor] and neighbor != start)
+                    ):
+                        value = pressure_acc + pressure_weights[neighbor]
+                        reached = pressure_parents[neighbor] != PARENT_UNREACHED
+                        if reached:
+                            contested += 1
+                        if not reached or value > pressure_cumulative[neighbor]:
+                            pressure_cumulative[neighbor] = value
+                            pressure_parents[neighbor] = last_pipe
+                            visited_pipes[neighbor] = 1
+                            next_pressure = value
+                            out_flags |= SWEEP_PRESSURE
+                    if out_flags:
+                        push((neighbor, out_flags, next_length, next_pressure, neighbor))
+                else:
+                    if flags & SWEEP_LENGTH and not length_visited[neighbor]:
+                        length_visited[neighbor] = 1
+                        out_flags = SWEEP_LENGTH
+                    if flags & SWEEP_PRESSURE and not visited_fittings[neighbor]:
+                        out_flags |= SWEEP_PRESSURE
+                    if out_flags:
+                        push((
+                            neighbor,
+                            out_flags,
+                            length_acc + length_fitting_weights[neighbor],
+                            pressure_acc + pressure_fitting_weights[neighbor],
+                            last_pipe,
+                        ))
+
+    return (
+        length_cumulative,
+        length_parents,
+        pressure_cumulative,
+        pressure_parents,
+        contested,
+    )
+
+
+def sweep_longest_path_dag(network, pipe_weights, start_indexes, fitting_weights=None):
+    """
+    Perdida de carga acumulada maxima en tiempo lineal para redes malladas.
+
+    La red se orienta con un DFS desde cada tuberia inicial por separado (las
+    demas iniciales actuan como barrera): los enlaces del arbol van hacia
+    abajo y los que cierran un lazo vuelven hacia un ancestro. Asi cada lazo
+    queda dentro de una componente fuertemente conexa (Tarjan iterativo) que
+    se colapsa en un solo nodo; el resto es un DAG que se resuelve en orden
+    topologico con el maximo de los predecesores.
+
+    Cada inicial solo recorre la zona que alcanza. Con lineas independientes
+    el coste sigue siendo lineal; donde varias iniciales comparten zona se
+    repite el recorrido. Al combinar, una inicial posterior solo se queda
+    una tuberia ya alcanzada si la mejora y tambien se quedo la tuberia
+    anterior de su ruta; la primera vez que se alcanza una tuberia se toma
+    sin mas. Al final se rehacen las que cuelgan de una tuberia retomada.
+    Asi cada acumulado es la suma de su ruta de padres y no hay ciclos.
+    El maximo por tuberia entre iniciales no sirve: la ruta mas larga a una
+    tuberia puede venir de una inicial pasando por otra tuberia cuya ruta
+    mas larga viene de la otra inicial pasando por la primera.
+
+    En arboles da los mismos valores y padres que sweep_max_relaxation.
+
+    Dentro de un lazo colapsado se recorre un arbol DFS desde el miembro que
+    conecta con el mejor predecesor: cada tuberia recibe el acumulado de
+    ese camino simple y su padre es la tuberia anterior en el, asi que la
+    ruta por padres atraviesa el lazo y suma lo mismo. En un anillo el DFS
+    da la vuelta entera y el ultimo miembro recibe el camino simple mas
+    largo; los demas pueden quedar por debajo de su maximo, porque el camino
+    mas largo a cada uno puede ir en sentido contrario y esos caminos no
+    caben en un unico arbol de padres. Son cotas inferiores (la exportacion
+    de rutas lo marca). Las uniones suman fitting_weights igual que las
+    tuberias suman su peso.
+
+    Devuelve (acumulados, parents, disputas, lazos). disputas cuenta las
+    confluencias (nodos con mas de un predecesor), los lazos y las tuberias
+    alcanzadas desde mas de una inicial; lazos es la lista de componentes
+    colapsadas (indices de nodo).
+    """
+    pipe_count = network["pipe_count"]
+    offsets = network["offsets"]
+    targets = network["targets"]
+    node_count = len(network["node_ids"])
+    fitting_weights = get_fitting_weights(network, fitting_weights)
+
+    is_start = bytearray(node_count)
+    for start in start_indexes:
+        is_start[start] = 1
+
+    # Estado por inicial; solo se limpian los nodos que la inicial visito.
+    discovery = array("i", [-1] * node_count)
+    low = array("i", [0] * node_count)
+    on_stack = bytearray(node_count)
+    position = array("i", [-1] * node_count)
+    values = [0.0] * node_count
+    last_pipe = array("i", [PARENT_UNREACHED] * node_count)
+
+    cumulative = [0.0] * pipe_count
+    parents = array("i", [PARENT_UNREACHED] * pipe_count)
+    # Por tuberia: lo que suma sobre su padre, la inicial que la fijo y el
+    # orden en que se fijo (para rehacer las que cuelgan de una retomada).
+    increments = [0.0] * pipe_count
+    owner = array("i", [-1] * pipe_count)
+    adopted_at = array("i", [-1] * pipe_count)
+    adoptions = 0
+    contested = 0
+    loops = []
+    loop_keys = set()
+    solved_starts = set()
+
+    for start in start_indexes:
+        if start >= pipe_count or start in solved_starts:
+            continue
+        pass_index = len(solved_starts)
+        solved_starts.add(start)
+
+        visited = [start]
+        stack = [start]
+        components = []
+        counter = 1
+        discovery[start] = low[start] = 0
+        on_stack[start] = 1
+        work = [[start, PARENT_ROOT, offsets[start]]]
+
+        while work:
+            frame = work[-1]
+            node = frame[0]
+            end = offsets[node + 1]
+            descended = False
+            while frame[2] < end:
+                neighbor = targets[frame[2]]
+                frame[2] += 1
+                if neighbor == frame[1] or (is_start[neighbor] and neighbor != start):
+                    continue
+                if discovery[neighbor] < 0:
+                    discovery[neighbor] = low[neighbor] = counter
+                    counter += 1
+                    visited.append(neighbor)
+                    stack.append(neighbor)
+                    on_stack[neighbor] = 1
+                    work.append([neighbor, node, offsets[neighbor]])
+                    descended = True
+                    break
+                if on_stack[neighbor] and discovery[neighbor] < low[node]:
+                    low[node] = discovery[neighbor]
+            if descended:
+                continue
+
+            work.pop()
+            if work and low[node] < low[work[-1][0]]:
+                low[work[-1][0]] = low[node]
+            if low[node] == discovery[node]:
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    members.append(member)
+                    if member == node:
+                        break
+                members.reverse()
+                components.append(members)
+
+        # Tarjan entrega las componentes en orden topologico inverso.
+        components.reverse()
+        for order, members in enumerate(components):
+            for member in members:
+                position[member] = order
+
+        for order, members in enumerate(components):
+            entry_value = 0.0
+            entry_pipe = PARENT_ROOT
+            entry_member = start
+            predecessors = 0
+            if start not in members:
+                for member in members:
+                    for slot in xrange(offsets[member], offsets[member + 1]):
+                        neighbor = targets[slot]
+                        neighbor_order = position[neighbor]
+                        if neighbor_order < 0 or neighbor_order >= order:
+                            continue
+                        predecessors += 1
+                        if predecessors == 1 or values[neighbor] > entry_value:
+                            entry_value = values[neighbor]
+                            entry_pipe = last_pipe[neighbor]
+                            entry_member = member
+            if predecessors > 1:
+                contested += 1
+
+            if entry_member < pipe_count:
+                values[entry_member] = entry_value + pipe_weights[entry_member]
+                last_pipe[entry_member] = entry_member
+            else:
+                values[entry_member] = entry_value + fitting_weights[entry_member]
+                last_pipe[entry_member] = entry_pipe
+            solved = [(entry_member, entry_pipe)]
+
+            if len(members) > 1:
+                # Arbol DFS dentro del lazo desde la entrada: cada miembro
+                # suma sobre el anterior del camino y su padre es la ultima
+                # tuberia de ese camino.
+                contested += 1
+                loop_key = tuple(sorted(members))
+                if loop_key not in loop_keys:
+                    loop_keys.add(loop_key)
+                    loops.append(members)
+                reached = set([entry_member])
+                loop_work = [[entry_member, offsets[entry_member]]]
+                while loop_work:
+                    loop_frame = loop_work[-1]
+                    node = loop_frame[0]
+                    end = offsets[node + 1]
+                    while loop_frame[1] < end:
+                        neighbor = targets[loop_frame[1]]
+                        loop_frame[1] += 1
+                        if position[neighbor] != order or neighbor in reached:
+                            continue
+                        reached.add(neighbor)
+                        if neighbor < pipe_count:
+                            values[neighbor] = values[node] + pipe_weights[neighbor]
+                            last_pipe[neighbor] = neighbor
+                        else:
+                            values[neighbor] = values[node] + fitting_weights[neighbor]
+                            last_pipe[neighbor] = last_pipe[node]
+                        solved.append((neighbor, last_pipe[node]))
+                        loop_work.append([neighbor, offsets[neighbor]])
+                        break
+                    else:
+                        loop_work.pop()
+
+            for member, member_parent in solved:
+                if member >= pipe_count:
+                    continue
+                # Se encadena sobre el acumulado ya combinado del padre; si el
+                # padre sigue con el valor de esta inicial es el mismo valor.
+                if member_parent < 0 or cumulative[member_parent] == values[member_parent]:
+                    candidate = values[member]
+                else:
+                    candidate = cumulative[member_parent] + (values[member] - values[member_parent])
+                if parents[member] != PARENT_UNREACHED:
+                    contested += 1
+                    # Solo se toma si su ruta tambien es de esta inicial; si
+                    # no, la ruta del padre podria pasar por esta tuberia.
+                    if candidate <= cumulative[member]:
+                        continue
+                    if member_parent >= 0 and owner[member_parent] != pass_index:
+                        continue
+                cumulative[member] = candidate
+                parents[member] = member_parent
+                increments[member] = candidate - (cumulative[member_parent] if member_parent >= 0 else 0.0)
+                owner[member] = pass_index
+                adopted_at[member] = adoptions
+                adoptions += 1
+
+        for node in visited:
+            discovery[node] = -1
+            position[node] = -1
+
+    # Las tuberias fijadas antes que su padre (retomado por una inicial
+    # posterior) se rehacen sobre el padre para que la ruta sume lo mismo.
+    done = bytearray(pipe_count)
+    refreshed = bytearray(pipe_count)
+    for pipe_index in xrange(pipe_count):
+        if done[pipe_index] or parents[pipe_index] == PARENT_UNREACHED:
+            continue
+        chain = []
+        cursor = pipe_index
+        while cursor >= 0 and not done[cursor]:
+            chain.append(cursor)
+            cursor = parents[cursor]
+        for node in reversed(chain):
+            parent = parents[node]
+            if parent >= 0 and (refreshed[parent] or adopted_at[parent] > adopted_at[node]):
+                cumulative[node] = cumulative[parent] + increments[node]
+                refreshed[node] = 1
+            done[node] = 1
+
+    return cumulative, parents, contested, loops
+
+
+def compute_fitting_losses(network, snapshot, equivalent_lengths):
+    """
+    Perdidas de las uniones por indice de nodo a partir de su longitud
+    equivalente (mismas unidades que la columna "length"). La perdida de
+    carga de cada union es su longitud equivalente por el mayor gradiente
+    pressure/length de las tuberias que conecta (criterio conservador, como
+    el maximo del recorrido de perdida de carga).
+    """
+    pipe_count = network["pipe_count"]
+    offsets = network["offsets"]
+    targets = network["targets"]
+    node_count = len(network["node_ids"])
+    lengths = [0.0] * node_count
+    pressures = [0.0] * node_count
+    length_column = snapshot["length"]
+    pressure_column = snapshot["pressure"]
+
+    for node in xrange(pipe_count, node_count):
+        equivalent = equivalent_lengths[node]
+        if not equivalent:
+            continue
+        gradient = 0.0
+        for slot in xrange(offsets[node], offsets[node + 1]):
+            pipe_index = targets[slot]
+            pipe_length = safe_float(length_column[pipe_index], 0.0)
+            if pipe_length <= 0.0:
+                continue
+            pipe_gradient = safe_float(pressure_column[pipe_index], 0.0) / pipe_length
+            if pipe_gradient > gradient:
+                gradient = pipe_gradient
+        lengths[node] = equivalent
+        pressures[node] = equivalent * gradient
+
+    return {"length": lengths, "pressure": pressures}
+
+
+def read_pipe_weights(snapshot, column, converter):
+    return [converter(value) for value in snapshot[column]]
+
+
+def compute_cumulative_sweeps(network, snapshot, start_indexes, mode, fitting_losses=None):
+    """
+    Calcula longitud y perdida de carga acumuladas segun el modo:
+    - "fusionado": un unico recorrido con los dos acumulados.
+    - "separado": los dos recorridos originales, uno tras otro.
+    - "verificacion": ejecuta ambos y cuenta las tuberias que difieren.
+    - "dag": longitud por primer acceso y perdida de carga por camino mas
+      largo sobre la red orientada, con los lazos colapsados
+      (sweep_longest_path_dag). En arboles coincide con el relajado; en los
+      lazos sigue un arbol DFS y los valores son cotas inferiores.
+
+    fitting_losses ({"length": [...], "pressure": [...]} por indice de nodo,
+    en las mismas unidades que la instantanea; ver compute_fitting_losses)
+    suma la perdida de carga de las uniones. La longitud acumulada es la
+    fisica de la ruta: la longitud equivalente solo pesa en la perdida de
+    carga. Sin el, las uniones no pesan.
+
+    Los acumulados se devuelven como listas por indice de tuberia de la red.
+    """
+    length_weights = read_pipe_weights(snapshot, "length", feet_to_millimeters)
+    pressure_weights = read_pipe_weights(snapshot, "pressure", bar_to_pa)
+    pressure_fitting_weights = None
+    if fitting_losses is not None:
+        pressure_fitting_weights = read_pipe_weights(fitting_losses, "pressure", bar_to_pa)
+    result = {
+        "mode": mode,
+        "mismatches": None,
+        "loops": [],
+    }
+
+    if mode == "dag":
+        result["lengths"], result["length_parents"] = sweep_first_visit(
+            network, length_weights, start_indexes
+        )
+        (
+            result["pressure"],
+            result["pressure_parents"],
+            result["contested"],
+            result["loops"],
+        ) = sweep_longest_path_dag(
+            network, pressure_weights, start_indexes, pressure_fitting_weights
+        )
+        return result
+
+    if mode == "separado":
+        result["lengths"], result["length_parents"] = sweep_first_visit(
+            network, length_weights, start_indexes
+        )
+        (
+            result["pressure"],
+            result["pressure_parents"],
+            result["contested"],
+        ) = sweep_max_relaxation(
+            network, pressure_weights, start_indexes, pressure_fitting_weights
+        )
+        return result
+
+    (
+        result["lengths"],
+        result["length_parents"],
+        result["pressure"],
+        result["pressure_parents"],
+        result["contested"],
+    ) = sweep_fused(
+        network,
+        length_weights,
+        pressure_weights,
+        start_indexes,
+        None,
+        pressure_fitting_weights,
+    )
+
+    if mode == "verificacion":
+        separate_lengths, _ = sweep_first_visit(
+            network, length_weights, start_indexes
+        )
+        separate_pressure, _, _ = sweep_max_relaxation(
+            network, pressure_weights, start_indexes, pressure_fitting_weights
+        )
+        mismatches = 0
+        for pipe_index in xrange(network["pipe_count"]):
+            if result["lengths"][pipe_index] != separate_lengths[pipe_index]:
+                mismatches += 1
+            elif result["pressure"][pipe_index] != separate_pressure[pipe_index]:
+                mismatches += 1
+        result["mismatches"] = mismatches
+
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Recalculo incremental
+# ---------------------------------------------------------------------------
+
+def get_network_signature(network, start_indexes):
+    """
+    Huella de la topologia (nodos, enlaces CSR y tuberias iniciales). Si
+    cambia, los arboles de padres guardados ya no sirven.
+    """
+    digest = hashlib.md5()
+    for values in (
+        network["node_ids"],
+        network["offsets"],
+        network["targets"],
+        [network["pipe_count"]],
+        start_indexes,
+    ):
+        digest.update(",".join(str(value) for value in values).encode("utf-8"))
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def recompute_subtrees(parents, values, weights, roots):
+    """
+    Recalcula en el lugar los acumulados de las raices indicadas y de todos
+    sus descendientes en el arbol de padres: valor = peso + valor del padre
+    (el mismo orden de suma que el recorrido). Devuelve los indices tocados.
+    """
+    children = {}
+    for child, parent in enumerate(parents):
+        if parent >= 0:
+            children.setdefault(parent, []).append(child)
+
+    affected = set()
+    pending = [root for root in roots if parents[root] != PARENT_UNREACHED]
+    while pending:
+        node = pending.pop()
+        if node in affected:
+            continue
+        affected.add(node)
+        pending.extend(children.get(node, ()))
+
+    queue = deque(node for node in affected if parents[node] not in affected)
+    while queue:
+        node = queue.popleft()
+        parent = parents[node]
+        if parent == PARENT_ROOT:
+            values[node] = weights[node]
+        else:
+            values[node] = values[parent] + weights[node]
+        queue.extend(children.get(node, ()))
+
+    return affected
@@ -11,8 +11,13 @@ Bloques cubiertos:
 
 """
 
+import codecs
+import json
+import math
 import os
+import time
 import traceback
+from array import array
 
 import clr
 
@@ -29,6 +34,30 @@ TypeBinding = DB.TypeBinding
 
 from pyrevit import revit, script
 
+from perdcarga_core import (
+    PHASE_LIQUID,
+    PHASE_VAPOR,
+    aggregate_tramo_totals,
+    bar_to_pa,
+    build_network_from_links,
+    calculate_pot_frigorifica,
+    compute_cumulative_sweeps,
+    compute_darcy_pressure_drops,
+    compute_fitting_losses,
+    count_reached_pipes,
+    feet_to_millimeters,
+    get_network_signature,
+    get_pipe_path_indexes,
+    internal_feet_to_mm,
+    iter_snapshot_pipes,
+    mm_to_internal_feet,
+    pa_to_bar,
+    read_pipe_weights,
+    recompute_subtrees,
+    safe_float,
+    safe_int,
+)
+
 try:
     clr.AddReference("RevitNodes")
     import Revit
@@ -48,6 +77,16 @@ try:
 except NameError:
     unicode = str
 
+try:
+    xrange
+except NameError:
+    xrange = range
+
+try:
+    long
+except NameError:
+    long = int
+
 
 doc = revit.doc
 uidoc = revit.uidoc
@@ -131,6 +170,14 @@ SOURCE_EQUIPMENT_NAME_HINTS = (
     u"booster",
 )
 
+# Registro de tuberias iniciales por proyecto ("<modelo>_perdcarga_origenes.json",
+# claves por GUID de proyecto). "usar": se valida y reutiliza;
+# "regenerar": se ignora, la seleccion actual tiene prioridad y se reescribe;
+# "desactivado": no se lee ni se escribe.
+SOURCE_REGISTRY_MODE = "usar"
+SOURCE_REGISTRY_SUFFIX = u"perdcarga_origenes"
+SOURCE_REGISTRY_VERSION = 1
+
 FILTER_FAMILY_KEYWORDS = (u"evap", u"mueble")
 ASPIRATION_SYSTEM_NAMES = set([
     u"A1+",
@@ -142,6 +189,11 @@ ASPIRATION_SYSTEM_NAMES = set([
 DIRECT_ASP_SYSTEM_NAMES = set([u"A1+", u"A1-"])
 DIRECT_LIQ_SYSTEM_NAMES = set([u"L1", u"L2"])
 
+# Tipos de propietario en el indice conector-propietario de la red.
+OWNER_PIPE = 0
+OWNER_FITTING = 1
+OWNER_OTHER = 2
+
 PARAM_POT_FRIGO = u"Pot.Frigorifica"
 PARAM_LONG_ACUM = u"longitud_acumulada"
 PARAM_PCARGA_ACUM = u"P.Carga_Acumulada"
@@ -162,6 +214,166 @@ PARAM_CATEGORY = u"Categoría"
 PARAM_DIF_PRES_EVAP = u"Dif_Pres_Evap"
 PARAM_DIF_PRES_LIQ = u"Dif_Pres_Liq"
 
+# "fusionado" | "separado" | "verificacion" | "dag" (ver compute_cumulative_sweeps)
+CUMULATIVE_SWEEP_MODE = "fusionado"
+MAX_REPORTED_LOOPS = 10
+
+# Origen de la perdida de carga por tuberia:
+# "revit": parametro "Pérdida de carga" calculado por Revit (Dynamo).
+# "darcy": Darcy-Weisbach con las tablas de perdcarga_core; sustituye a la
+#          de Revit en P.Carga_Tramo y en el acumulado.
+# "comparar": calcula Darcy-Weisbach, informa las diferencias y sigue con Revit.
+PRESSURE_DROP_SOURCE = "revit"
+DARCY_DEFAULT_REFRIGERANT = u"R-744"
+# Refrigerante por nombre de sistema, p.ej. {u"L2": u"R-134a"}.
+DARCY_REFRIGERANT_BY_SYSTEM = {}
+DARCY_ROUGHNESS_MM = 0.0015
+DARCY_COMPARE_TOLERANCE = 0.10
+DARCY_MAX_REPORTED = 20
+# Unidades internas de Revit: presion en kg/(ft.s2), caudal en ft3/s.
+INTERNAL_PRESSURE_PER_PA = 0.3048
+CUBIC_FEET_TO_M3 = 0.028316846592
+
+# Perdidas en uniones: longitud equivalente L/D por PartType por el diametro
+# nominal de la union, cuya perdida de carga se suma en el recorrido
+# acumulado [7]. Long_Acumulada [6] sigue siendo la longitud fisica. Se
+# calcula una vez por tipo de union y tamano (FITTING_LOSS_CACHE).
+FITTING_LOSSES_ENABLED = False
+FITTING_EQUIVALENT_DIAMETERS = {
+    u"Elbow": 30.0,
+    u"Tee": 60.0,
+    u"Cross": 60.0,
+    u"Wye": 30.0,
+    u"Transition": 10.0,
+    u"Union": 0.0,
+    u"Cap": 0.0,
+}
+FITTING_LOSS_CACHE = {
+    "by_key": {},
+    "hits": 0,
+    "misses": 0,
+}
+
+# Cache por ejecucion de get_pipe_system_type / get_system_type_info.
+SYSTEM_TYPE_CACHE = {
+    "pipe_types": {},
+    "type_info": {},
+    "hits": 0,
+    "misses": 0,
+}
+
+# Acceso a parametros:
+# - "dynamo": GetParameterValueByName/SetParameterByName via RevitNodes (como el Dynamo).
+# - "nativo": directamente sobre DB.Parameter (conversion por unit token y
+#   desreferencia de ElementId), sin envolver cada elemento.
+# - "verificacion": compara ambos en una muestra de tuberias y sigue en "dynamo".
+PARAM_ACCESS_MODE = "dynamo"
+PARAM_ACCESS = {"native": False}
+PARITY_SAMPLE_SIZE = 50
+PARITY_TOLERANCE = 1e-9
+PARITY_MAX_REPORTED = 20
+PARITY_PIPE_PARAMS = (
+    PARAM_TRAMO,
+    PARAM_FLOW,
+    PARAM_LONGITUD,
+    PARAM_PCARGA,
+    PARAM_PCARGA_ACUM,
+    PARAM_SYSTEM_TYPE,
+)
+PARITY_TYPE_PARAMS = (
+    PARAM_TYPE_NAME,
+    PARAM_DENSITY,
+    PARAM_DIF_ENTALPIA,
+    PARAM_TEMP_FLUID,
+)
+
+# Cache por ejecucion de get_param_unit_token, por definicion de parametro.
+UNIT_TOKEN_CACHE = {
+    "tokens": {},
+    "hits": 0,
+    "misses": 0,
+}
+
+# Escritura solo si cambia: se compara el valor interno actual con el nuevo
+# (tolerancia relativa) antes de llamar a Set.
+WRITE_ONLY_CHANGED = True
+WRITE_TOLERANCE = 1e-9
+WRITE_STATS = {}
+
+# Instrumentacion por etapa: tiempo y llamadas a la API de Revit/Dynamo.
+METRIC_COUNTERS = ("lookup_parameter", "to_ds_type", "all_refs")
+RUN_METRICS = {
+    "stage": None,
+    "stage_started": None,
+    "order": [],
+    "stages": {},
+    "peaks": {},
+}
+# Registro JSON de ejecuciones junto al modelo ("<modelo>_perdcarga_ejecuciones.json").
+WRITE_RUN_RECORD = False
+RUN_RECORD_SUFFIX = u"perdcarga_ejecuciones"
+RUN_RECORD_MAX_RUNS = 50
+
+PIPE_SNAPSHOT_COLUMNS = (
+    "pipe",
+    "system_type",
+    "system_name",
+    "group_key",
+    "flow",
+    "density",
+    "delta_h",
+    "temp_fluid",
+    "length",
+    "pressure",
+    "pressure_acum",
+    "tramo",
+)
+
+# Exportacion de la ruta critica de cada evaporador (asp/liq) desde el arbol
+# de padres de la perdida de carga: "" (desactivada) | "csv" | "json".
+# Se escribe junto al modelo como "<modelo>_perdcarga_rutas.csv/.json".
+# Longitudes en mm y perdidas de carga en bar (unidades del Dynamo): en cada
+# ruta, la suma de pcarga_bar + pcarga_uniones_bar da pcarga_acumulada_bar.
+# cota_lazo es 1 desde la primera tuberia de la ruta que esta en un lazo
+# colapsado (modo "dag"): el acumulado es el de la ruta exportada, que puede
+# quedar por debajo del camino mas largo.
+CRITICAL_PATH_EXPORT = ""
+CRITICAL_PATH_SUFFIX = u"perdcarga_rutas"
+CRITICAL_PATH_CSV_DELIMITER = u";"
+CRITICAL_PATH_COLUMNS = (
+    "equipo_id",
+    "equipo",
+    "linea",
+    "orden",
+    "tuberia_id",
+    "tramo",
+    "sistema",
+    "longitud_mm",
+    "longitud_ruta_mm",
+    "pcarga_bar",
+    "pcarga_uniones_bar",
+    "pcarga_acumulada_bar",
+    "cota_lazo",
+)
+
+# Recalculo incremental: reutiliza el estado de la ejecucion anterior
+# (archivo "<modelo>_perdcarga_estado.json" junto al .rvt) y solo reescribe
+# las tuberias cuyos datos cambiaron y los subarboles aguas abajo. Si la
+# topologia, las tuberias iniciales o la version del estado no coinciden se
+# hace el calculo completo.
+INCREMENTAL_MODE = False
+INCREMENTAL_STATE_SUFFIX = u"perdcarga_estado"
+INCREMENTAL_STATE_VERSION = 1
+INCREMENTAL_INPUT_COLUMNS = (
+    "group_key",
+    "flow",
+    "density",
+    "delta_h",
+    "temp_fluid",
+    "length",
+    "pressure",
+)
+
 
 REQUIRED_SHARED_PARAMS = [
     {
@@ -205,47 +417,6 @@ def as_list(value):
     return [value]
 
 
-def safe_float(value, default=0.0):
-    if value is None:
-        return default
-    if isinstance(value, bool):
-        return float(value)
-    if isinstance(value, (int, float)):
-        return float(value)
-    text = None
-    try:
-        text = unicode(value)
-    except Exception:
-        try:
-            text = str(value)
-        except Exception:
-            return default
-    if text is None:
-        return default
-    text = text.strip().replace(",", ".")
-    if not text:
-        return default
-    try:
-        return float(text)
-    except Exception:
-        return default
-
-
-def safe_int(value, default=0):
-    try:
-        return int(round(safe_float(value, default)))
-    except Exception:
-        return default
-
-
-def mm_to_internal_feet(value_mm):
-    return safe_float(value_mm, 0.0) / 304.8
-
-
-def internal_feet_to_mm(value_ft):
-    return safe_float(value_ft, 0.0) * 304.8
-
-
 def to_text(value):
     if value is None:
         return u""
@@ -271,9 +442,145 @@ def is_category(elem, bic):
         return False
 
 
+def reset_run_metrics():
+    RUN_METRICS["stage"] = None
+    RUN_METRICS["stage_started"] = None
+    RUN_METRICS["order"] = []
+    RUN_METRICS["stages"] = {}
+    RUN_METRICS["peaks"] = {}
+
+
+def get_stage_metrics(name):
+    stage = RUN_METRICS["stages"].get(name)
+    if stage is None:
+        stage = {"seconds": 0.0}
+        for counter in METRIC_COUNTERS:
+            stage[counter] = 0
+        RUN_METRICS["stages"][name] = stage
+        RUN_METRICS["order"].append(name)
+    return stage
+
+
+def end_stage():
+    name = RUN_METRICS["stage"]
+    if name is not None:
+        get_stage_metrics(name)["seconds"] += time.time() - RUN_METRICS["stage_started"]
+    RUN_METRICS["stage"] = None
+    RUN_METRICS["stage_started"] = None
+
+
+def begin_stage(name):
+    end_stage()
+    get_stage_metrics(name)
+    RUN_METRICS["stage"] = name
+    RUN_METRICS["stage_started"] = time.time()
+
+
+def count_api_call(counter):
+    name = RUN_METRICS["stage"]
+    if name is not None:
+        RUN_METRICS["stages"][name][counter] += 1
+
+
+def record_peak(name, count):
+    if count > RUN_METRICS["peaks"].get(name, 0):
+        RUN_METRICS["peaks"][name] = count
+
+
+def print_run_metrics():
+    columns = [u"Etapa", u"Tiempo (s)", u"LookupParameter", u"ToDSType", u"AllRefs"]
+    rows = []
+    totals = dict((counter, 0) for counter in METRIC_COUNTERS)
+    total_seconds = 0.0
+    for name in RUN_METRICS["order"]:
+        stage = RUN_METRICS["stages"][name]
+        total_seconds += stage["seconds"]
+        for counter in METRIC_COUNTERS:
+            totals[counter] += stage[counter]
+        rows.append([name, u"{:.2f}".format(stage["seconds"])] + [
+            stage[counter] for counter in METRIC_COUNTERS
+        ])
+    rows.append([u"TOTAL", u"{:.2f}".format(total_seconds)] + [
+        totals[counter] for counter in METRIC_COUNTERS
+    ])
+
+    print("\n" + "=" * 70)
+    print("INSTRUMENTACION")
+    print("=" * 70)
+    if hasattr(output, "print_table"):
+        output.print_table(table_data=rows, columns=columns)
+    else:
+        for row in rows:
+            print("{:<28} {:>10} {:>16} {:>10} {:>10}".format(*row))
+
+    for label, cache in (
+        (u"Unit tokens", UNIT_TOKEN_CACHE),
+        (u"Tipos de sistema", SYSTEM_TYPE_CACHE),
+        (u"Uniones tipo/tamano", FITTING_LOSS_CACHE),
+    ):
+        lookups = cache["hits"] + cache["misses"]
+        print("Cache {:<22}: aciertos {} / consultas {} ({:.1f}%)".format(
+            label,
+            cache["hits"],
+            lookups,
+            100.0 * cache["hits"] / lookups if lookups else 0.0,
+        ))
+
+    if RUN_METRICS["peaks"]:
+        print("Picos de elementos:")
+        for name in sorted(RUN_METRICS["peaks"]):
+            print("    {:<28}: {}".format(name, RUN_METRICS["peaks"][name]))
+
+
+def build_run_record():
+    try:
+        model_path = doc.PathName
+    except Exception:
+        model_path = u""
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model_path,
+        "sweep_mode": CUMULATIVE_SWEEP_MODE,
+        "param_access": PARAM_ACCESS_MODE,
+        "incremental": INCREMENTAL_MODE,
+        "stages": [
+            dict(RUN_METRICS["stages"][name], name=name)
+            for name in RUN_METRICS["order"]
+        ],
+        "peaks": dict(RUN_METRICS["peaks"]),
+        "writes": dict((name, dict(stats)) for name, stats in WRITE_STATS.items()),
+        "system_type_cache": {
+            "hits": SYSTEM_TYPE_CACHE["hits"],
+            "misses": SYSTEM_TYPE_CACHE["misses"],
+        },
+        "unit_token_cache": {
+            "hits": UNIT_TOKEN_CACHE["hits"],
+            "misses": UNIT_TOKEN_CACHE["misses"],
+            "definitions": len(UNIT_TOKEN_CACHE["tokens"]),
+        },
+    }
+
+
+def save_run_record():
+    """
+    Agrega la ejecucion actual al historial JSON junto al modelo (se
+    conservan las ultimas RUN_RECORD_MAX_RUNS).
+    """
+    path = get_model_sidecar_path(RUN_RECORD_SUFFIX)
+    history = load_json_sidecar(path)
+    if not isinstance(history, dict) or not isinstance(history.get("runs"), list):
+        history = {"runs": []}
+    history["runs"].append(build_run_record())
+    history["runs"] = history["runs"][-RUN_RECORD_MAX_RUNS:]
+    if save_json_sidecar(path, history):
+        return path
+    return u""
+
+
 def get_param(elem, name):
     if elem is None:
         return None
+    count_api_call("lookup_parameter")
     try:
         return elem.LookupParameter(name)
     except Exception:
@@ -352,12 +659,13 @@ def get_linked_param_element(elem, name):
 
 
 def to_dynamo_element(elem):
-    if not DYNAMO_WRAPPERS_AVAILABLE or elem is None:
+    if PARAM_ACCESS["native"] or not DYNAMO_WRAPPERS_AVAILABLE or elem is None:
         return None
 
     if hasattr(elem, "GetParameterValueByName"):
         return elem
 
+    count_api_call("to_ds_type")
     try:
         return elem.ToDSType(True)
     except Exception:
@@ -436,7 +744,133 @@ def get_dynamo_param_value(elem, name, default=None):
         return default
 
 
+def set_param_access_mode(mode):
+    PARAM_ACCESS["native"] = mode == "nativo"
+
+
+def normalize_parity_value(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    elem = unwrap_revit_element(value)
+    try:
+        if hasattr(elem, "Id") and hasattr(elem.Id, "IntegerValue"):
+            return ("elemento", elem.Id.IntegerValue)
+    except Exception:
+        pass
+    return to_text(value)
+
+
+def parity_values_match(dynamo_value, native_value):
+    if isinstance(dynamo_value, float) and isinstance(native_value, float):
+        scale = max(1.0, abs(dynamo_value), abs(native_value))
+        return abs(dynamo_value - native_value) <= PARITY_TOLERANCE * scale
+    return dynamo_value == native_value
+
+
+def read_parity_values(pipe):
+    values = []
+    for name in PARITY_PIPE_PARAMS:
+        values.append((name, get_dynamo_param_value(pipe, name, None)))
+    system_type = resolve_pipe_system_type(pipe)
+    for name in PARITY_TYPE_PARAMS:
+        values.append((u"{} (tipo)".format(name), get_dynamo_param_value(system_type, name, None)))
+    values.append((u"clave Tramo", get_dynamo_group_key(pipe)))
+    return values
+
+
+def check_param_access_parity(pipes, sample_size):
+    """
+    Lee en una muestra repartida de tuberias los mismos parametros que usa el
+    calculo, primero con los wrappers de Dynamo y despues en modo nativo, y
+    devuelve las diferencias encontradas.
+    """
+    report = {
+        "available": DYNAMO_WRAPPERS_AVAILABLE,
+        "pipes": 0,
+        "compared": 0,
+        "mismatches": [],
+    }
+    if not DYNAMO_WRAPPERS_AVAILABLE or not pipes or sample_size <= 0:
+        return report
+
+    step = max(1, len(pipes) // sample_size)
+    sample = pipes[::step][:sample_size]
+    previous = PARAM_ACCESS["native"]
+    try:
+        for pipe in sample:
+            PARAM_ACCESS["native"] = False
+            dynamo_values = read_parity_values(pipe)
+            PARAM_ACCESS["native"] = True
+            native_values = read_parity_values(pipe)
+
+            for (name, dynamo_value), (_, native_value) in zip(dynamo_values, native_values):
+                report["compared"] += 1
+                if not parity_values_match(
+                    normalize_parity_value(dynamo_value),
+                    normalize_parity_value(native_value),
+                ):
+                    report["mismatches"].append(
+                        (pipe.Id.IntegerValue, name, to_text(dynamo_value), to_text(native_value))
+                    )
+            report["pipes"] += 1
+    finally:
+        PARAM_ACCESS["native"] = previous
+
+    return report
+
+
+def reset_unit_token_cache():
+    UNIT_TOKEN_CACHE["tokens"].clear()
+    UNIT_TOKEN_CACHE["hits"] = 0
+    UNIT_TOKEN_CACHE["misses"] = 0
+
+
+def get_param_definition_key(param):
+    """
+    Clave estable de la definicion: GUID si es compartido, si no el id del
+    parametro (negativo para los BuiltInParameter).
+    """
+    try:
+        if param.IsShared:
+            return ("guid", str(param.GUID))
+    except Exception:
+        pass
+    try:
+        return ("id", param.Id.IntegerValue)
+    except Exception:
+        pass
+    try:
+        return ("nombre", to_text(param.Definition.Name))
+    except Exception:
+        return None
+
+
 def get_param_unit_token(param):
+    """
+    Version memoizada de resolve_param_unit_token: las cuatro estrategias se
+    recorren una sola vez por definicion de parametro y ejecucion.
+    """
+    if param is None:
+        return None
+
+    key = get_param_definition_key(param)
+    if key is None:
+        return resolve_param_unit_token(param)
+
+    cache = UNIT_TOKEN_CACHE["tokens"]
+    if key in cache:
+        UNIT_TOKEN_CACHE["hits"] += 1
+        return cache[key]
+
+    UNIT_TOKEN_CACHE["misses"] += 1
+    token = resolve_param_unit_token(param)
+    cache[key] = token
+    return token
+
+
+def resolve_param_unit_token(param):
     if param is None:
         return None
 
@@ -577,6 +1011,79 @@ def set_dynamep_param_value(elem, name, value):
     return False
 
 
+def reset_write_stats():
+    WRITE_STATS.clear()
+
+
+def param_value_unchanged(param, value):
+    """
+    True si el parametro ya contiene value, comparando en unidades internas
+    con la misma conversion que usan los setters.
+    """
+    try:
+        if param.StorageType == StorageType.Double:
+            target = float(convert_to_internal_param_value(param, value))
+            current = param.AsDouble()
+            scale = max(1.0, abs(current), abs(target))
+            return abs(current - target) <= WRITE_TOLERANCE * scale
+        if param.StorageType == StorageType.String:
+            return (param.AsString() or u"") == to_text(value)
+        if param.StorageType == StorageType.Integer:
+            return param.AsInteger() == safe_int(value)
+        if param.StorageType == StorageType.ElementId and hasattr(value, "Id"):
+            return param.AsElementId().IntegerValue == value.Id.IntegerValue
+    except Exception:
+        pass
+    return False
+
+
+def write_param_if_changed(elem, name, value, setter):
+    """
+    Escribe con setter (set_dynamo_param_value / set_dynamep_param_value)
+    solo si el valor difiere del actual. Devuelve True si el parametro queda
+    con el valor pedido (escrito o sin cambios) y lleva la cuenta
+    escritos / sin cambios / fallidos por parametro en WRITE_STATS. Un
+    parametro de solo lectura cuenta como fallido aunque ya tenga el valor.
+    """
+    stats = WRITE_STATS.get(name)
+    if stats is None:
+        stats = {"written": 0, "unchanged": 0, "failed": 0}
+        WRITE_STATS[name] = stats
+
+    if WRITE_ONLY_CHANGED and value is not None:
+        param = get_param(elem, name)
+        if param is not None and param.IsReadOnly:
+            stats["failed"] += 1
+            return False
+        if param is not None and param_value_unchanged(param, value):
+            stats["unchanged"] += 1
+            return True
+
+    if setter(elem, name, value):
+        stats["written"] += 1
+        return True
+    stats["failed"] += 1
+    return False
+
+
+def print_write_stats():
+    if not WRITE_STATS:
+        return
+    rows = [
+        [name, stats["written"], stats["unchanged"], stats["failed"]]
+        for name, stats in sorted(WRITE_STATS.items())
+    ]
+    columns = [u"Parametro", u"Escritos", u"Sin cambios", u"Fallidos"]
+    print("\nEscrituras por parametro (solo si cambia: {})".format(
+        u"si" if WRITE_ONLY_CHANGED else u"no"
+    ))
+    if hasattr(output, "print_table"):
+        output.print_table(table_data=rows, columns=columns)
+    else:
+        for row in rows:
+            print("    {:<24} {:>10} {:>12} {:>10}".format(*row))
+
+
 def get_type_name(elem):
     if elem is None:
         return u""
@@ -700,44 +1207,36 @@ def get_pipe_endpoints(pipe):
         return []
 
 
-def xyz_distance(a, b):
-    if a is None or b is None:
-        return float("inf")
-    try:
-        return a.DistanceTo(b)
-    except Exception:
-        dx = safe_float(a.X, 0.0) - safe_float(b.X, 0.0)
-        dy = safe_float(a.Y, 0.0) - safe_float(b.Y, 0.0)
-        dz = safe_float(a.Z, 0.0) - safe_float(b.Z, 0.0)
-        return (dx * dx + dy * dy + dz * dz) ** 0.5
-
-
-def distance_point_to_segment(pt, a, b):
-    if pt is None or a is None or b is None:
-        return float("inf")
-
-    abx = b.X - a.X
-    aby = b.Y - a.Y
-    abz = b.Z - a.Z
-    apx = pt.X - a.X
-    apy = pt.Y - a.Y
-    apz = pt.Z - a.Z
+def point_to_tuple(point):
+    return (
+        safe_float(point.X, 0.0),
+        safe_float(point.Y, 0.0),
+        safe_float(point.Z, 0.0),
+    )
+
+
+def tuple_distance(a, b):
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    dz = a[2] - b[2]
+    return (dx * dx + dy * dy + dz * dz) ** 0.5
+
+
+def tuple_distance_to_segment(pt, a, b):
+    abx = b[0] - a[0]
+    aby = b[1] - a[1]
+    abz = b[2] - a[2]
     ab2 = abx * abx + aby * aby + abz * abz
     if ab2 <= 1e-12:
-        return xyz_distance(pt, a)
+        return tuple_distance(pt, a)
 
-    t = (apx * abx + apy * aby + apz * abz) / ab2
+    t = ((pt[0] - a[0]) * abx + (pt[1] - a[1]) * aby + (pt[2] - a[2]) * abz) / ab2
     if t < 0.0:
         t = 0.0
     elif t > 1.0:
         t = 1.0
 
-    proj = DB.XYZ(
-        a.X + abx * t,
-        a.Y + aby * t,
-        a.Z + abz * t,
-    )
-    return xyz_distance(pt, proj)
+    return tuple_distance(pt, (a[0] + abx * t, a[1] + aby * t, a[2] + abz * t))
 
 
 def get_equipment_anchor_points(equipment):
@@ -759,28 +1258,106 @@ def get_pipe_anchor_points(pipe):
     return get_pipe_endpoints(pipe)
 
 
-def get_pipe_distance_to_points(pipe, points):
-    if pipe is None or not points:
-        return float("inf")
+def get_grid_cell(value, inv_cell_size):
+    return int(math.floor(value * inv_cell_size))
 
-    best = float("inf")
-    pipe_points = get_pipe_anchor_points(pipe)
-    for point in points:
-        for pipe_point in pipe_points:
-            dist = xyz_distance(point, pipe_point)
-            if dist < best:
-                best = dist
 
-        endpoints = get_pipe_endpoints(pipe)
-        if len(endpoints) >= 2:
-            dist = distance_point_to_segment(point, endpoints[0], endpoints[1])
-            if dist < best:
-                best = dist
+def build_pipe_spatial_index(pipes, cell_size_ft):
+    """
+    Rejilla uniforme sobre las tuberias (puntos de conector + segmento del
+    eje). Cada tuberia se registra en las celdas que cubre su caja
+    envolvente. Se construye una sola vez y la reutilizan todas las pasadas
+    de tolerancia de get_initial_pipes.
+    """
+    inv_cell_size = 1.0 / cell_size_ft
+    records = []
+    cells = {}
+
+    for pipe in unique_elements_by_id(pipes):
+        anchors = [point_to_tuple(point) for point in get_pipe_anchor_points(pipe)]
+        endpoints = [point_to_tuple(point) for point in get_pipe_endpoints(pipe)]
+        coords = anchors + endpoints
+        if not coords:
+            continue
+
+        segment = (endpoints[0], endpoints[1]) if len(endpoints) >= 2 else None
+        record_index = len(records)
+        records.append((pipe, anchors, segment))
+
+        ranges = []
+        for axis in xrange(3):
+            values = [coord[axis] for coord in coords]
+            ranges.append(xrange(
+                get_grid_cell(min(values), inv_cell_size),
+                get_grid_cell(max(values), inv_cell_size) + 1,
+            ))
+        for ix in ranges[0]:
+            for iy in ranges[1]:
+                for iz in ranges[2]:
+                    cells.setdefault((ix, iy, iz), []).append(record_index)
+
+    return {
+        "inv_cell_size": inv_cell_size,
+        "records": records,
+        "cells": cells,
+    }
+
 
+def get_pipe_record_distance(record, point):
+    _, anchors, segment = record
+    best = float("inf")
+    for anchor in anchors:
+        dist = tuple_distance(point, anchor)
+        if dist < best:
+            best = dist
+    if segment is not None:
+        dist = tuple_distance_to_segment(point, segment[0], segment[1])
+        if dist < best:
+            best = dist
     return best
 
 
-def get_pipe_system_type(pipe):
+def query_pipe_spatial_index(spatial_index, points, radius_ft):
+    """
+    Devuelve [(tuberia, distancia)] con las tuberias a <= radius_ft de
+    cualquiera de los puntos, en el orden original de las tuberias. Solo se
+    miden las tuberias de las celdas vecinas.
+    """
+    inv_cell_size = spatial_index["inv_cell_size"]
+    cells = spatial_index["cells"]
+    records = spatial_index["records"]
+    best = {}
+
+    for point in points:
+        checked = set()
+        ranges = [
+            xrange(
+                get_grid_cell(point[axis] - radius_ft, inv_cell_size),
+                get_grid_cell(point[axis] + radius_ft, inv_cell_size) + 1,
+            )
+            for axis in xrange(3)
+        ]
+        for ix in ranges[0]:
+            for iy in ranges[1]:
+                for iz in ranges[2]:
+                    for record_index in cells.get((ix, iy, iz), ()):
+                        if record_index in checked:
+                            continue
+                        checked.add(record_index)
+                        dist = get_pipe_record_distance(records[record_index], point)
+                        if dist > radius_ft:
+                            continue
+                        current = best.get(record_index)
+                        if current is None or dist < current:
+                            best[record_index] = dist
+
+    return [
+        (records[record_index][0], best[record_index])
+        for record_index in sorted(best)
+    ]
+
+
+def resolve_pipe_system_type(pipe):
     if pipe is None:
         return None
 
@@ -829,12 +1406,79 @@ def get_pipe_system_type(pipe):
     return linked if hasattr(linked, "Id") else None
 
 
+def reset_system_type_cache():
+    SYSTEM_TYPE_CACHE["pipe_types"].clear()
+    SYSTEM_TYPE_CACHE["type_info"].clear()
+    SYSTEM_TYPE_CACHE["hits"] = 0
+    SYSTEM_TYPE_CACHE["misses"] = 0
+
+
+def get_system_type_key(system_type):
+    if system_type is None:
+        return None
+    try:
+        return system_type.Id.IntegerValue
+    except Exception:
+        return None
+
+
+def get_pipe_system_type(pipe):
+    """
+    Version memoizada de resolve_pipe_system_type: cada tuberia recorre las
+    cuatro estrategias de resolucion una sola vez por ejecucion.
+    """
+    if pipe is None:
+        return None
+    try:
+        pipe_id = pipe.Id.IntegerValue
+    except Exception:
+        return resolve_pipe_system_type(pipe)
+
+    cache = SYSTEM_TYPE_CACHE["pipe_types"]
+    if pipe_id in cache:
+        SYSTEM_TYPE_CACHE["hits"] += 1
+        return cache[pipe_id]
+
+    SYSTEM_TYPE_CACHE["misses"] += 1
+    system_type = resolve_pipe_system_type(pipe)
+    cache[pipe_id] = system_type
+    return system_type
+
+
+def get_system_type_info(system_type):
+    """
+    Devuelve (memoizado por id de tipo de sistema) los valores de tipo que
+    usa el calculo: nombre, densidad, diferencia_entalpia y temperatura de
+    fluido, leidos como en el Dynamo.
+    """
+    key = get_system_type_key(system_type)
+    cacheable = key is not None or system_type is None
+    cache = SYSTEM_TYPE_CACHE["type_info"]
+    if cacheable and key in cache:
+        SYSTEM_TYPE_CACHE["hits"] += 1
+        return cache[key]
+
+    SYSTEM_TYPE_CACHE["misses"] += 1
+    type_name_value = get_dynamo_param_value(system_type, PARAM_TYPE_NAME, None)
+    if type_name_value not in (None, u""):
+        name = to_text(type_name_value)
+    else:
+        name = get_type_name(system_type)
+
+    info = {
+        "type_name_value": type_name_value,
+        "name": name,
+        "density": get_dynamo_param_value(system_type, PARAM_DENSITY, 0.0),
+        "delta_h": get_dynamo_param_value(system_type, PARAM_DIF_ENTALPIA, 0.0),
+        "temp_fluid": get_dynamo_param_value(system_type, PARAM_TEMP_FLUID, None),
+    }
+    if cacheable:
+        cache[key] = info
+    return info
+
+
 def get_pipe_system_name(pipe):
-    system_type = get_pipe_system_type(pipe)
-    value = get_dynamo_param_value(system_type, PARAM_TYPE_NAME, None)
-    if value not in (None, u""):
-        return to_text(value)
-    return get_type_name(system_type)
+    return get_system_type_info(get_pipe_system_type(pipe))["name"]
 
 
 def get_pipe_group_type_name(pipe):
@@ -893,10 +1537,17 @@ def get_dynamo_group_key(pipe):
             GetParameterValueByName("Tipo de sistema") en la tuberia
     """
     tramo_value = get_dynamo_param_value(pipe, PARAM_TRAMO, u"")
-    tramo_text = to_text(tramo_value)
-
     system_obj = get_dynamo_param_value(pipe, PARAM_SYSTEM_TYPE, None)
     system_name = get_dynamo_param_value(system_obj, PARAM_TYPE_NAME, u"")
+    return compose_dynamo_group_key(pipe, tramo_value, system_obj, system_name)
+
+
+def compose_dynamo_group_key(pipe, tramo_value, system_obj, system_name):
+    """
+    Construye la clave de get_dynamo_group_key a partir de valores ya leidos.
+    Solo vuelve a consultar Revit en los fallbacks (clave incompleta).
+    """
+    tramo_text = to_text(tramo_value)
     system_text = to_text(system_name)
 
     if not system_text:
@@ -916,26 +1567,6 @@ def get_dynamo_group_key(pipe):
     return u"{}_{}".format(tramo_text, system_text)
 
 
-def get_connected_pipes_for_fitting(fitting):
-    pipes = []
-    seen = set()
-    for connector in get_connectors(fitting):
-        try:
-            refs = list(connector.AllRefs)
-        except Exception:
-            refs = []
-        for ref in refs:
-            owner = getattr(ref, "Owner", None)
-            if owner is None or owner.Id == fitting.Id:
-                continue
-            if owner.Id.IntegerValue in seen:
-                continue
-            if is_category(owner, BuiltInCategory.OST_PipeCurves):
-                pipes.append(owner)
-                seen.add(owner.Id.IntegerValue)
-    return pipes
-
-
 def get_selected_pipe_elements():
     pipes = []
     seen = set()
@@ -1046,7 +1677,7 @@ def infer_initial_pipes_from_equipment(pipe_candidates, all_equipment):
     pipe_candidates = unique_elements_by_id(pipe_candidates)
     all_equipment = unique_elements_by_id(all_equipment)
     if not pipe_candidates or not all_equipment:
-        return [], u""
+        return [], u"", None
 
     candidate_pipe_ids = set(pipe.Id.IntegerValue for pipe in pipe_candidates)
     excluded_ids = set(
@@ -1103,7 +1734,7 @@ def infer_initial_pipes_from_equipment(pipe_candidates, all_equipment):
         })
 
     if not evaluated:
-        return [], u""
+        return [], u"", None
 
     evaluated.sort(
         key=lambda item: (
@@ -1119,14 +1750,14 @@ def infer_initial_pipes_from_equipment(pipe_candidates, all_equipment):
     systems_text = u", ".join(best["selected_systems"]) if best["selected_systems"] else u"sin_sistema"
     source_label = best["label"] or u"equipo_sin_nombre"
     source = u"inferido:{} [{}]".format(source_label, systems_text)
-    return unique_elements_by_id(best["selected_pipes"]), source
+    return unique_elements_by_id(best["selected_pipes"]), source, best["equipment"]
 
 
-def infer_initial_pipes_by_proximity(pipe_candidates, all_equipment, tolerance_ft):
+def infer_initial_pipes_by_proximity(pipe_candidates, all_equipment, tolerance_ft, spatial_index=None):
     pipe_candidates = unique_elements_by_id(pipe_candidates)
     all_equipment = unique_elements_by_id(all_equipment)
     if not pipe_candidates or not all_equipment:
-        return [], u""
+        return [], u"", None
 
     excluded_ids = set(
         elem.Id.IntegerValue for elem in filter_target_equipment(all_equipment)
@@ -1135,19 +1766,20 @@ def infer_initial_pipes_by_proximity(pipe_candidates, all_equipment, tolerance_f
     if not equipment_pool:
         equipment_pool = list(all_equipment)
 
+    if spatial_index is None:
+        spatial_index = build_pipe_spatial_index(pipe_candidates, tolerance_ft)
+
     evaluated = []
     for equipment in equipment_pool:
-        anchor_points = get_equipment_anchor_points(equipment)
+        anchor_points = [
+            point_to_tuple(point) for point in get_equipment_anchor_points(equipment)
+        ]
         if not anchor_points:
             continue
 
         nearest_by_system = {}
         all_hits = []
-        for pipe in pipe_candidates:
-            dist = get_pipe_distance_to_points(pipe, anchor_points)
-            if dist > tolerance_ft:
-                continue
-
+        for pipe, dist in query_pipe_spatial_index(spatial_index, anchor_points, tolerance_ft):
             system_name = get_pipe_system_name(pipe)
             all_hits.append((dist, pipe, system_name))
             if system_name:
@@ -1204,7 +1836,7 @@ def infer_initial_pipes_by_proximity(pipe_candidates, all_equipment, tolerance_f
         })
 
     if not evaluated:
-        return [], u""
+        return [], u"", None
 
     evaluated.sort(
         key=lambda item: (
@@ -1223,10 +1855,115 @@ def infer_initial_pipes_by_proximity(pipe_candidates, all_equipment, tolerance_f
         systems_text,
         internal_feet_to_mm(tolerance_ft),
     )
-    return unique_elements_by_id(best["selected_pipes"]), source
+    return unique_elements_by_id(best["selected_pipes"]), source, best["equipment"]
 
 
-def get_initial_pipes(pipe_candidates=None, all_equipment=None):
+def get_document_key():
+    """GUID estable del proyecto (UniqueId de la informacion de proyecto)."""
+    try:
+        return to_text(doc.ProjectInformation.UniqueId)
+    except Exception:
+        return u""
+
+
+def get_element_unique_id(elem):
+    try:
+        return to_text(elem.UniqueId)
+    except Exception:
+        return u""
+
+
+def load_source_registry_entry():
+    """
+    Devuelve (ruta del registro, entrada del proyecto actual o None).
+    """
+    path = get_model_sidecar_path(SOURCE_REGISTRY_SUFFIX)
+    registry = load_json_sidecar(path)
+    if not isinstance(registry, dict) or registry.get("version") != SOURCE_REGISTRY_VERSION:
+        return path, None
+    entry = (registry.get("documents") or {}).get(get_document_key())
+    return path, entry if isinstance(entry, dict) else None
+
+
+def validate_source_registry_entry(entry):
+    """
+    Validacion barata: cada tuberia registrada debe existir, seguir siendo
+    tuberia y conservar su sistema; el equipo de origen debe existir.
+    Devuelve (tuberias, motivo); tuberias vacio si el registro no sirve.
+    """
+    records = entry.get("pipes") or []
+    if not records:
+        return [], u"registro vacio"
+
+    pipes = []
+    seen = set()
+    for record in records:
+        elem = None
+        try:
+            elem = doc.GetElement(record.get("unique_id") or u"")
+        except Exception:
+            elem = None
+        if elem is None or not is_category(elem, BuiltInCategory.OST_PipeCurves):
+            return [], u"tuberia {} no encontrada".format(record.get("id"))
+        if record.get("system") and get_pipe_system_name(elem) != record.get("system"):
+            return [], u"tuberia {} cambio de sistema".format(record.get("id"))
+        if elem.Id.IntegerValue not in seen:
+            seen.add(elem.Id.IntegerValue)
+            pipes.append(elem)
+
+    for record in entry.get("equipment") or []:
+        try:
+            equipment = doc.GetElement(record.get("unique_id") or u"")
+        except Exception:
+            equipment = None
+        if equipment is None:
+            return [], u"equipo de origen {} no encontrado".format(record.get("label"))
+
+    return pipes, u""
+
+
+def save_source_registry_entry(path, pipes, source, equipment):
+    document_key = get_document_key()
+    if not path or not document_key or not pipes:
+        return False
+
+    registry = load_json_sidecar(path)
+    if not isinstance(registry, dict) or registry.get("version") != SOURCE_REGISTRY_VERSION:
+        registry = {"version": SOURCE_REGISTRY_VERSION, "documents": {}}
+    registry.setdefault("documents", {})
+
+    try:
+        model_path = doc.PathName
+    except Exception:
+        model_path = u""
+    registry["documents"][document_key] = {
+        "path": model_path,
+        "source": to_text(source),
+        "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "pipes": [
+            {
+                "unique_id": get_element_unique_id(pipe),
+                "id": pipe.Id.IntegerValue,
+                "system": get_pipe_system_name(pipe),
+            }
+            for pipe in pipes
+        ],
+        "equipment": [
+            {
+                "unique_id": get_element_unique_id(equipment),
+                "label": get_equipment_label(equipment),
+            }
+        ] if equipment is not None else [],
+    }
+    return save_json_sidecar(path, registry)
+
+
+def resolve_initial_pipes(pipe_candidates=None, all_equipment=None):
+    """
+    Resolucion sin registro: UniqueId del Dynamo, inferencia por equipo,
+    proximidad y por ultimo la seleccion actual. Devuelve
+    (tuberias, fuente, equipo de origen o None).
+    """
     found = []
     seen = set()
 
@@ -1240,26 +1977,64 @@ def get_initial_pipes(pipe_candidates=None, all_equipment=None):
         seen.add(elem.Id.IntegerValue)
 
     if found:
-        return found, "dynamo"
+        return found, "dynamo", None
 
-    inferred, source = infer_initial_pipes_from_equipment(pipe_candidates, all_equipment)
+    inferred, source, equipment = infer_initial_pipes_from_equipment(pipe_candidates, all_equipment)
     if inferred:
-        return inferred, source
+        return inferred, source, equipment
 
+    spatial_index = build_pipe_spatial_index(
+        pipe_candidates,
+        mm_to_internal_feet(max(INITIAL_PIPE_PROXIMITY_TOLS_MM)),
+    )
     for tol_mm in INITIAL_PIPE_PROXIMITY_TOLS_MM:
-        inferred, source = infer_initial_pipes_by_proximity(
+        inferred, source, equipment = infer_initial_pipes_by_proximity(
             pipe_candidates,
             all_equipment,
             mm_to_internal_feet(tol_mm),
+            spatial_index,
         )
         if inferred:
-            return inferred, source
+            return inferred, source, equipment
 
     selected = get_selected_pipe_elements()
     if selected:
-        return selected, "seleccion_actual"
+        return selected, "seleccion_actual", None
+
+    return [], "sin_inicio", None
 
-    return [], "sin_inicio"
+
+def get_initial_pipes(pipe_candidates=None, all_equipment=None):
+    """
+    Tuberias iniciales del calculo. Con SOURCE_REGISTRY_MODE = "usar" se
+    reutiliza el registro del proyecto si sigue siendo valido, sin recorrer
+    equipos ni tuberias; si no, se resuelven con resolve_initial_pipes y el
+    resultado se guarda en el registro para las siguientes ejecuciones.
+    """
+    if SOURCE_REGISTRY_MODE == "desactivado":
+        pipes, source, _ = resolve_initial_pipes(pipe_candidates, all_equipment)
+        return pipes, source
+
+    registry_path, entry = load_source_registry_entry()
+    stale_reason = u""
+    if SOURCE_REGISTRY_MODE == "usar" and entry is not None:
+        pipes, stale_reason = validate_source_registry_entry(entry)
+        if pipes:
+            return pipes, u"registro:{}".format(to_text(entry.get("source")))
+
+    pipes = []
+    equipment = None
+    if SOURCE_REGISTRY_MODE == "regenerar":
+        pipes = get_selected_pipe_elements()
+        source = "seleccion_actual"
+    if not pipes:
+        pipes, source, equipment = resolve_initial_pipes(pipe_candidates, all_equipment)
+
+    if pipes and save_source_registry_entry(registry_path, pipes, source, equipment):
+        source = u"{} (registrado)".format(source)
+    if stale_reason:
+        source = u"{} | registro descartado: {}".format(source, stale_reason)
+    return pipes, source
 
 
 def ensure_shared_parameters():
@@ -1391,148 +2166,536 @@ def ensure_shared_parameters():
     return report
 
 
-def calculate_pot_frigorifica(flow, density, delta_h):
-    flow_value = safe_float(flow)
-    density_value = safe_float(density)
-    delta_h_value = safe_float(delta_h)
+def build_pipe_snapshot(network, pipes):
+    """
+    Lee una sola vez por tuberia todos los parametros que usan los pasos
+    [3]-[8] y los guarda en columnas paralelas indexadas por el indice de
+    tuberia de la red. Las lecturas son las mismas que hacia el Dynamo
+    (get_dynamo_param_value), de modo que los resultados no cambian.
+    """
+    count = network["pipe_count"]
+    snapshot = dict((column, [None] * count) for column in PIPE_SNAPSHOT_COLUMNS)
+    index = network["index"]
+
+    for pipe in pipes:
+        pipe_index = index.get(pipe.Id.IntegerValue)
+        if pipe_index is None or snapshot["pipe"][pipe_index] is not None:
+            continue
+
+        system_type = get_pipe_system_type(pipe)
+        system_info = get_system_type_info(system_type)
+        type_name_value = system_info["type_name_value"]
+        tramo_value = get_dynamo_param_value(pipe, PARAM_TRAMO, u"")
+
+        snapshot["pipe"][pipe_index] = pipe
+        snapshot["system_type"][pipe_index] = system_type
+        snapshot["system_name"][pipe_index] = system_info["name"]
+        snapshot["group_key"][pipe_index] = compose_dynamo_group_key(
+            pipe,
+            tramo_value,
+            system_type,
+            u"" if type_name_value is None else type_name_value,
+        )
+        snapshot["flow"][pipe_index] = get_dynamo_param_value(pipe, PARAM_FLOW, 0.0)
+        snapshot["density"][pipe_index] = system_info["density"]
+        snapshot["delta_h"][pipe_index] = system_info["delta_h"]
+        snapshot["temp_fluid"][pipe_index] = system_info["temp_fluid"]
+        snapshot["length"][pipe_index] = get_dynamo_param_value(pipe, PARAM_LONGITUD, 0.0)
+        snapshot["pressure"][pipe_index] = get_dynamo_param_value(pipe, PARAM_PCARGA, 0.0)
+        snapshot["pressure_acum"][pipe_index] = get_dynamo_param_value(pipe, PARAM_PCARGA_ACUM, None)
+        snapshot["tramo"][pipe_index] = to_text(tramo_value)
 
-    flow_m3_s = flow_value * 0.001
-    delta_h_j_kg = delta_h_value * 1000.0
-    watts = flow_m3_s * density_value * delta_h_j_kg
-    return watts / 3.600
+    return snapshot
 
 
-def feet_to_millimeters(length_in_feet):
-    return safe_float(length_in_feet) / 304.8
+def get_snapshot_index(network, snapshot, pipe):
+    pipe_index = network["index"].get(pipe.Id.IntegerValue)
+    if pipe_index is None or pipe_index >= network["pipe_count"]:
+        return None
+    if snapshot["pipe"][pipe_index] is None:
+        return None
+    return pipe_index
 
 
-def bar_to_pa(bar_value):
-    return safe_float(bar_value) * 30480.0
+def read_snapshot_system_name(network, snapshot, pipe):
+    pipe_index = get_snapshot_index(network, snapshot, pipe)
+    if pipe_index is None:
+        return get_pipe_system_name(pipe)
+    return snapshot["system_name"][pipe_index]
 
 
-def build_pipe_adjacency(pipes, fittings):
-    adjacency = {}
-    pipe_ids = set(pipe.Id.IntegerValue for pipe in pipes)
+def read_snapshot_pressure_acum(network, snapshot, pipe):
+    pipe_index = get_snapshot_index(network, snapshot, pipe)
+    if pipe_index is None:
+        return get_dynamo_param_value(pipe, PARAM_PCARGA_ACUM, None)
+    return snapshot["pressure_acum"][pipe_index]
 
-    for fitting in fittings:
-        fitting_id = fitting.Id.IntegerValue
-        connected_pipe_ids = [
-            pipe.Id.IntegerValue
-            for pipe in get_connected_pipes_for_fitting(fitting)
-            if pipe.Id.IntegerValue in pipe_ids
-        ]
-        for pipe_id in connected_pipe_ids:
-            adjacency.setdefault(fitting_id, []).append(pipe_id)
-            adjacency.setdefault(pipe_id, []).append(fitting_id)
 
-    return adjacency
+def read_native_double(elem, bip):
+    try:
+        param = elem.get_Parameter(bip)
+        if param is not None and param.HasValue:
+            return param.AsDouble()
+    except Exception:
+        pass
+    return None
 
 
-def compute_cumulative_lengths(pipes, fittings, initial_pipes):
-    pipe_ids = [pipe.Id.IntegerValue for pipe in pipes]
-    pipe_length_dict = {}
-    for pipe in pipes:
-        pipe_length_dict[pipe.Id.IntegerValue] = feet_to_millimeters(
-            get_dynamo_param_value(pipe, PARAM_LONGITUD, 0.0)
+def read_darcy_inputs(snapshot):
+    """
+    Columnas SI para compute_darcy_pressure_drops. Caudal, diametro interior
+    y longitud se leen en unidades internas (sin depender de las unidades
+    del proyecto); la temperatura es la de la instantanea (C, como el Dynamo).
+    """
+    count = len(snapshot["pipe"])
+    inputs = dict(
+        (column, [None] * count)
+        for column in ("flow", "diameter", "length", "refrigerant", "phase", "temperature")
+    )
+    for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+        system_name = snapshot["system_name"][pipe_index]
+        flow_ft3_s = read_native_double(pipe, BuiltInParameter.RBS_PIPE_FLOW_PARAM)
+        diameter_ft = read_native_double(pipe, BuiltInParameter.RBS_PIPE_INNER_DIAM_PARAM)
+        length_ft = read_native_double(pipe, BuiltInParameter.CURVE_ELEM_LENGTH)
+        if flow_ft3_s is not None:
+            inputs["flow"][pipe_index] = flow_ft3_s * CUBIC_FEET_TO_M3
+        if diameter_ft is not None:
+            inputs["diameter"][pipe_index] = diameter_ft * 0.3048
+        if length_ft is not None:
+            inputs["length"][pipe_index] = length_ft * 0.3048
+        inputs["refrigerant"][pipe_index] = DARCY_REFRIGERANT_BY_SYSTEM.get(
+            system_name, DARCY_DEFAULT_REFRIGERANT
         )
+        inputs["phase"][pipe_index] = (
+            PHASE_VAPOR if system_name in ASPIRATION_SYSTEM_NAMES else PHASE_LIQUID
+        )
+        inputs["temperature"][pipe_index] = safe_float(snapshot["temp_fluid"][pipe_index], None)
+    return inputs
 
-    adjacency = build_pipe_adjacency(pipes, fittings)
-    cumulative_lengths = {}
-    pipe_paths = {}
-    visited = set()
-
-    def bfs(start_pipe_id):
-        queue = [(start_pipe_id, pipe_length_dict.get(start_pipe_id, 0.0), [start_pipe_id])]
-        visited.add(start_pipe_id)
-        cumulative_lengths[start_pipe_id] = pipe_length_dict.get(start_pipe_id, 0.0)
-        pipe_paths[start_pipe_id] = [start_pipe_id]
-
-        while queue:
-            current_elem, cum_length, path = queue.pop(0)
-            for neighbor in adjacency.get(current_elem, []):
-                if neighbor in visited:
-                    continue
-                visited.add(neighbor)
-                if neighbor in pipe_ids:
-                    new_length = cum_length + pipe_length_dict.get(neighbor, 0.0)
-                    cumulative_lengths[neighbor] = new_length
-                    pipe_paths[neighbor] = path + [neighbor]
-                    queue.append((neighbor, new_length, path + [neighbor]))
-                else:
-                    queue.append((neighbor, cum_length, path))
 
-    for start_pipe in initial_pipes:
-        start_id = start_pipe.Id.IntegerValue
-        if start_id in pipe_ids and start_id not in visited:
-            bfs(start_id)
+def get_display_factor(snapshot, name, default):
+    """
+    Factor unidades internas -> unidades del parametro de tuberia name tal
+    como las lee get_dynamo_param_value. Sin token se usa default.
+    """
+    for _, pipe in iter_snapshot_pipes(snapshot):
+        param = get_param(pipe, name)
+        if param is None:
+            continue
+        token = get_param_unit_token(param)
+        if token is None:
+            break
+        try:
+            return DB.UnitUtils.ConvertFromInternalUnits(1.0, token)
+        except Exception:
+            break
+    return default
 
-    output = {}
-    for pipe in pipes:
-        output[pipe.Id.IntegerValue] = cumulative_lengths.get(pipe.Id.IntegerValue, 0.0)
 
-    return output, pipe_paths
+def compute_darcy_pressures(snapshot):
+    """
+    Perdida de carga Darcy-Weisbach por indice de tuberia, en las mismas
+    unidades que la columna "pressure" de la instantanea (None sin datos).
+    """
+    drops_pa = compute_darcy_pressure_drops(
+        read_darcy_inputs(snapshot), DARCY_ROUGHNESS_MM / 1000.0
+    )
+    # Sin token se asume bar, como el Dynamo (bar_to_pa).
+    factor = get_display_factor(snapshot, PARAM_PCARGA, 1.0 / bar_to_pa(1.0))
+    factor *= INTERNAL_PRESSURE_PER_PA
+    return [None if value is None else value * factor for value in drops_pa]
 
 
-def compute_cumulative_pressure_drop(pipes, fittings, initial_pipes):
-    pipe_ids = [pipe.Id.IntegerValue for pipe in pipes]
-    pipe_pressure_drop = {}
-    for pipe in pipes:
-        pipe_pressure_drop[pipe.Id.IntegerValue] = bar_to_pa(
-            get_dynamo_param_value(pipe, PARAM_PCARGA, 0.0)
-        )
+def compare_darcy_pressures(snapshot, darcy_values):
+    report = {
+        "compared": 0,
+        "missing": 0,
+        "over_tolerance": 0,
+        "mean_relative": 0.0,
+        "max_relative": 0.0,
+        "worst": [],
+    }
+    total_relative = 0.0
+    for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+        darcy_value = darcy_values[pipe_index]
+        if darcy_value is None:
+            report["missing"] += 1
+            continue
+        revit_value = safe_float(snapshot["pressure"][pipe_index], 0.0)
+        reference = max(abs(revit_value), abs(darcy_value))
+        relative = abs(darcy_value - revit_value) / reference if reference > 0.0 else 0.0
+        report["compared"] += 1
+        total_relative += relative
+        if relative > report["max_relative"]:
+            report["max_relative"] = relative
+        if relative > DARCY_COMPARE_TOLERANCE:
+            report["over_tolerance"] += 1
+            report["worst"].append((
+                relative,
+                pipe.Id.IntegerValue,
+                snapshot["system_name"][pipe_index],
+                revit_value,
+                darcy_value,
+            ))
+    if report["compared"]:
+        report["mean_relative"] = total_relative / report["compared"]
+    report["worst"].sort(reverse=True)
+    del report["worst"][DARCY_MAX_REPORTED:]
+    return report
 
-    initial_pipe_ids = [pipe.Id.IntegerValue for pipe in initial_pipes]
-    initial_pipe_set = set(initial_pipe_ids)
-    adjacency = build_pipe_adjacency(pipes, fittings)
-    cumulative = {}
-    pipe_paths = {}
 
-    for start_pipe_id in initial_pipe_ids:
-        if start_pipe_id not in pipe_ids:
+def apply_darcy_pressures(snapshot, darcy_values):
+    """Sustituye la columna "pressure"; sin dato Darcy se conserva la de Revit."""
+    replaced = 0
+    kept = 0
+    for pipe_index, _ in iter_snapshot_pipes(snapshot):
+        if darcy_values[pipe_index] is None:
+            kept += 1
             continue
+        snapshot["pressure"][pipe_index] = darcy_values[pipe_index]
+        replaced += 1
+    return replaced, kept
 
-        cumulative[start_pipe_id] = pipe_pressure_drop.get(start_pipe_id, 0.0)
-        pipe_paths[start_pipe_id] = [str(start_pipe_id)]
 
-        queue = [(start_pipe_id, pipe_pressure_drop.get(start_pipe_id, 0.0), [start_pipe_id])]
-        visited_fittings_local = set()
-        visited_pipes_local = set([start_pipe_id])
+def reset_fitting_loss_cache():
+    FITTING_LOSS_CACHE["by_key"].clear()
+    FITTING_LOSS_CACHE["hits"] = 0
+    FITTING_LOSS_CACHE["misses"] = 0
 
-        while queue:
-            current_elem, cum_pressure_drop, path = queue.pop(0)
 
-            if current_elem not in pipe_ids:
-                if current_elem in visited_fittings_local:
-                    continue
-                visited_fittings_local.add(current_elem)
+def get_fitting_part_type(fitting):
+    try:
+        return to_text(fitting.MEPModel.PartType)
+    except Exception:
+        return u""
+
+
+def get_fitting_nominal_diameter_ft(fitting):
+    diameter = 0.0
+    for connector in get_connectors(fitting):
+        try:
+            diameter = max(diameter, 2.0 * connector.Radius)
+        except Exception:
+            continue
+    return diameter
+
+
+def get_fitting_size_key(fitting):
+    try:
+        type_id = fitting.GetTypeId().IntegerValue
+    except Exception:
+        return None
+    size_text = u""
+    try:
+        param = fitting.get_Parameter(BuiltInParameter.RBS_CALCULATED_SIZE)
+        if param is not None:
+            size_text = to_text(param.AsString())
+    except Exception:
+        pass
+    return (type_id, size_text)
+
+
+def get_fitting_equivalent_length_ft(fitting):
+    """
+    Longitud equivalente (pies) de la union, memoizada por tipo + tamano:
+    PartType y conectores solo se leen para la primera union de cada clave.
+    """
+    key = get_fitting_size_key(fitting)
+    cache = FITTING_LOSS_CACHE["by_key"]
+    if key is not None and key in cache:
+        FITTING_LOSS_CACHE["hits"] += 1
+        return cache[key]
+
+    FITTING_LOSS_CACHE["misses"] += 1
+    ratio = FITTING_EQUIVALENT_DIAMETERS.get(get_fitting_part_type(fitting), 0.0)
+    length_ft = ratio * get_fitting_nominal_diameter_ft(fitting) if ratio else 0.0
+    if key is not None:
+        cache[key] = length_ft
+    return length_ft
+
+
+def build_fitting_losses(network, snapshot, fittings):
+    """
+    Perdidas de las uniones de la red para compute_cumulative_sweeps, con
+    la longitud equivalente en las unidades de "Longitud" de la instantanea.
+    """
+    length_factor = get_display_factor(snapshot, PARAM_LONGITUD, internal_feet_to_mm(1.0))
+    index = network["index"]
+    pipe_count = network["pipe_count"]
+    equivalent_lengths = [0.0] * len(network["node_ids"])
+    for fitting in fittings:
+        node = index.get(fitting.Id.IntegerValue)
+        if node is None or node < pipe_count:
+            continue
+        equivalent_lengths[node] = get_fitting_equivalent_length_ft(fitting) * length_factor
+    return compute_fitting_losses(network, snapshot, equivalent_lengths)
+
+
+def build_pipe_network(pipes, fittings):
+    """
+    Construye una sola vez por ejecucion la red tuberia/union que comparten
+    todos los recorridos.
+
+    Los ElementId se mapean a indices densos: primero las tuberias (en el
+    orden de la coleccion) y despues las uniones. La adyacencia se guarda en
+    formato CSR: los vecinos del nodo i son
+    targets[offsets[i]:offsets[i + 1]], en el mismo orden en que el Dynamo
+    recorre los conectores de cada union.
+
+    Con la misma lectura de AllRefs se guarda en network["fitting_owners"]
+    el indice conector-propietario de cada union (ver
+    get_fitting_owner_records), que usa el paso [8].
+    """
+    node_ids = []
+    index = {}
+    for pipe in pipes:
+        pipe_id = pipe.Id.IntegerValue
+        if pipe_id in index:
+            continue
+        index[pipe_id] = len(node_ids)
+        node_ids.append(pipe_id)
+    pipe_count = len(node_ids)
 
-            for neighbor in adjacency.get(current_elem, []):
-                if neighbor in initial_pipe_set and neighbor != start_pipe_id:
+    unique_fittings = []
+    for fitting in fittings:
+        fitting_id = fitting.Id.IntegerValue
+        if fitting_id in index:
+            continue
+        index[fitting_id] = len(node_ids)
+        node_ids.append(fitting_id)
+        unique_fittings.append(fitting)
+
+    fitting_links = []
+    fitting_owners = {}
+    for fitting in unique_fittings:
+        fitting_id = fitting.Id.IntegerValue
+        fitting_index = index[fitting_id]
+        owner_records = []
+        owner_seen = set()
+        linked = []
+        seen = set()
+        for connector in get_connectors(fitting):
+            try:
+                count_api_call("all_refs")
+                refs = list(connector.AllRefs)
+            except Exception:
+                refs = []
+            for ref in refs:
+                owner = getattr(ref, "Owner", None)
+                if owner is None:
+                    continue
+                owner_id = owner.Id.IntegerValue
+                if owner_id not in owner_seen:
+                    owner_seen.add(owner_id)
+                    owner_records.append(
+                        (owner_id, classify_owner_node(index, pipe_count, owner), owner)
+                    )
+                owner_index = index.get(owner_id)
+                if owner_index is None or owner_index >= pipe_count:
                     continue
-                if neighbor in visited_pipes_local:
+                if owner_index in seen:
                     continue
+                seen.add(owner_index)
+                linked.append(owner_index)
+        fitting_owners[fitting_id] = owner_records
+        if linked:
+            fitting_links.append((fitting_index, linked))
+
+    network = build_network_from_links(node_ids, pipe_count, fitting_links)
+    network["fitting_owners"] = fitting_owners
+    return network
+
+
+def classify_owner_node(index, pipe_count, owner):
+    """Tipo del propietario de un conector: OWNER_PIPE, OWNER_FITTING u OWNER_OTHER."""
+    node = index.get(owner.Id.IntegerValue)
+    if node is not None:
+        return OWNER_PIPE if node < pipe_count else OWNER_FITTING
+    if is_category(owner, BuiltInCategory.OST_PipeCurves):
+        return OWNER_PIPE
+    if is_category(owner, BuiltInCategory.OST_PipeFitting):
+        return OWNER_FITTING
+    return OWNER_OTHER
+
+
+def get_network_pipe_indexes(network, elements):
+    index = network["index"]
+    pipe_count = network["pipe_count"]
+    result = []
+    for elem in elements:
+        node = index.get(elem.Id.IntegerValue)
+        if node is not None and node < pipe_count:
+            result.append(node)
+    return result
 
-                if neighbor in pipe_ids:
-                    neighbor_drop = pipe_pressure_drop.get(neighbor, 0.0)
-                    new_cumulative = cum_pressure_drop + neighbor_drop
-                    new_path = path + [neighbor]
-                    if (
-                        neighbor not in cumulative
-                        or new_cumulative > cumulative[neighbor]
-                    ):
-                        cumulative[neighbor] = new_cumulative
-                        pipe_paths[neighbor] = [str(pid) for pid in new_path]
-                        queue.append((neighbor, new_cumulative, new_path))
-                        visited_pipes_local.add(neighbor)
-                else:
-                    if neighbor not in visited_fittings_local:
-                        queue.append((neighbor, cum_pressure_drop, path))
 
-    output = {}
-    for pipe in pipes:
-        output[pipe.Id.IntegerValue] = cumulative.get(pipe.Id.IntegerValue, 0.0)
+def get_model_sidecar_path(suffix, extension=u".json"):
+    """
+    Ruta de un archivo auxiliar junto al modelo: "<modelo>_<suffix>.json".
+    Devuelve "" si el modelo no esta guardado.
+    """
+    try:
+        path = doc.PathName
+    except Exception:
+        path = u""
+    if not path or not path.strip():
+        return u""
+    return u"{}_{}{}".format(os.path.splitext(path)[0], suffix, extension)
+
+
+def load_json_sidecar(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with codecs.open(path, "r", "utf-8") as sidecar_file:
+            return json.load(sidecar_file)
+    except Exception as exc:
+        logger.debug("No se pudo leer {}: {}".format(path, exc))
+        return None
+
+
+def save_json_sidecar(path, data):
+    if not path:
+        return False
+    try:
+        with codecs.open(path, "w", "utf-8") as sidecar_file:
+            sidecar_file.write(json.dumps(data, ensure_ascii=False, indent=2))
+        return True
+    except Exception as exc:
+        logger.debug("No se pudo guardar {}: {}".format(path, exc))
+        return False
+
+
+def serialize_snapshot_value(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    return to_text(value)
+
+
+def get_pipe_input_row(snapshot, pipe_index):
+    return [
+        serialize_snapshot_value(snapshot[column][pipe_index])
+        for column in INCREMENTAL_INPUT_COLUMNS
+    ]
+
+
+def get_pressure_model(mode):
+    model = "dag" if mode == "dag" else "relajacion"
+    if PRESSURE_DROP_SOURCE == "darcy":
+        model = "{}+darcy".format(model)
+    if FITTING_LOSSES_ENABLED:
+        model = "{}+uniones".format(model)
+    return model
+
+
+def build_incremental_state(network, snapshot, start_indexes, sweeps):
+    return {
+        "version": INCREMENTAL_STATE_VERSION,
+        "pressure_model": get_pressure_model(CUMULATIVE_SWEEP_MODE),
+        "signature": get_network_signature(network, start_indexes),
+        "inputs": [
+            get_pipe_input_row(snapshot, pipe_index)
+            for pipe_index in xrange(network["pipe_count"])
+        ],
+        "lengths": list(sweeps["lengths"]),
+        "length_parents": list(sweeps["length_parents"]),
+        "pressure": list(sweeps["pressure"]),
+        "pressure_parents": list(sweeps["pressure_parents"]),
+        "contested": sweeps["contested"],
+    }
 
-    return output, pipe_paths
+
+def plan_incremental_update(previous, network, snapshot, start_indexes):
+    """
+    Compara el estado guardado con la red y la instantanea actuales.
+    Devuelve (plan, motivo). plan es None cuando hay que calcular todo.
+
+    Solo se admite el recalculo parcial si la ejecucion anterior no tuvo
+    disputas en la perdida de carga: en ese caso, con la misma topologia,
+    los arboles de padres de ambos recorridos no dependen de los pesos.
+    """
+    if FITTING_LOSSES_ENABLED:
+        # Los padres apuntan a tuberias: no guardan la union intermedia.
+        return None, "perdidas en uniones activas"
+    if not previous:
+        return None, "sin estado previo"
+    if previous.get("version") != INCREMENTAL_STATE_VERSION:
+        return None, "version de estado distinta"
+    if previous.get("pressure_model") != get_pressure_model(CUMULATIVE_SWEEP_MODE):
+        return None, "modelo de perdida de carga distinto"
+    if previous.get("signature") != get_network_signature(network, start_indexes):
+        return None, "topologia o tuberias iniciales distintas"
+    if previous.get("contested"):
+        return None, "recorrido con disputas ({})".format(previous.get("contested"))
+
+    pipe_count = network["pipe_count"]
+    previous_inputs = previous.get("inputs") or []
+    if len(previous_inputs) != pipe_count:
+        return None, "estado incompleto"
+
+    length_column = INCREMENTAL_INPUT_COLUMNS.index("length")
+    pressure_column = INCREMENTAL_INPUT_COLUMNS.index("pressure")
+    group_column = INCREMENTAL_INPUT_COLUMNS.index("group_key")
+
+    changed = set()
+    length_roots = []
+    pressure_roots = []
+    group_keys = set()
+    for pipe_index in xrange(pipe_count):
+        old_row = previous_inputs[pipe_index]
+        new_row = get_pipe_input_row(snapshot, pipe_index)
+        if old_row == new_row:
+            continue
+        changed.add(pipe_index)
+        if old_row[length_column] != new_row[length_column]:
+            length_roots.append(pipe_index)
+        if old_row[pressure_column] != new_row[pressure_column]:
+            pressure_roots.append(pipe_index)
+        if (
+            old_row[length_column] != new_row[length_column]
+            or old_row[pressure_column] != new_row[pressure_column]
+            or old_row[group_column] != new_row[group_column]
+        ):
+            group_keys.add(old_row[group_column])
+            group_keys.add(new_row[group_column])
+
+    lengths = [float(value) for value in previous["lengths"]]
+    pressure = [float(value) for value in previous["pressure"]]
+    length_parents = array("i", previous["length_parents"])
+    pressure_parents = array("i", previous["pressure_parents"])
+
+    length_affected = recompute_subtrees(
+        length_parents,
+        lengths,
+        read_pipe_weights(snapshot, "length", feet_to_millimeters),
+        length_roots,
+    )
+    pressure_affected = recompute_subtrees(
+        pressure_parents,
+        pressure,
+        read_pipe_weights(snapshot, "pressure", bar_to_pa),
+        pressure_roots,
+    )
+
+    plan = {
+        "changed": changed,
+        "group_keys": group_keys,
+        "length_affected": length_affected,
+        "pressure_affected": pressure_affected,
+        "sweeps": {
+            "mode": "incremental",
+            "mismatches": None,
+            "lengths": lengths,
+            "length_parents": length_parents,
+            "pressure": pressure,
+            "pressure_parents": pressure_parents,
+            "contested": 0,
+            "loops": [],
+        },
+    }
+    return plan, "{} tuberias con cambios".format(len(changed))
 
 
 def filter_mechanical_equipment_with_pot(all_equipment):
@@ -1590,6 +2753,7 @@ def filter_dynamo_pressure_equipment(all_equipment):
 def find_pipe_through_fittings(element, previous_id, visited_ids):
     for connector in get_connectors(element):
         try:
+            count_api_call("all_refs")
             refs = list(connector.AllRefs)
         except Exception:
             refs = []
@@ -1615,6 +2779,7 @@ def get_equipment_pipe_lists(equipment):
     for connector in get_connectors(equipment):
         pipe_found = None
         try:
+            count_api_call("all_refs")
             refs = list(connector.AllRefs)
         except Exception:
             refs = []
@@ -1636,22 +2801,232 @@ def get_equipment_pipe_lists(equipment):
     return result
 
 
-def get_first_direct_pipe(equipment):
+def find_indexed_pipe_through_fittings(network, fitting, previous_id, visited_ids):
+    """
+    Igual que find_pipe_through_fittings, pero recorre el indice
+    conector-propietario de la red en lugar de volver a leer AllRefs. Las
+    uniones que no estan en la red se resuelven con la version de la API.
+    """
+    fitting_id = fitting.Id.IntegerValue
+    owner_records = network.get("fitting_owners", {}).get(fitting_id)
+    if owner_records is None:
+        return find_pipe_through_fittings(fitting, previous_id, visited_ids)
+
+    for owner_id, kind, owner in owner_records:
+        if owner_id == previous_id or owner_id in visited_ids:
+            continue
+        visited_ids.add(owner_id)
+        if kind == OWNER_PIPE:
+            return owner
+        if kind == OWNER_FITTING:
+            pipe = find_indexed_pipe_through_fittings(network, owner, fitting_id, visited_ids)
+            if pipe is not None:
+                return pipe
+    return None
+
+
+def trace_equipment_connectors(equipment, network):
+    """
+    Una sola lectura de AllRefs por conector del equipo. Devuelve
+    (primera tuberia por conector a traves de uniones, o None;
+    primera tuberia conectada directamente a cualquier conector), con el
+    mismo orden y las mismas reglas que get_equipment_pipe_lists.
+    """
+    index = network["index"]
+    pipe_count = network["pipe_count"]
+    equipment_id = equipment.Id.IntegerValue
+    pipe_list = []
+    direct_pipe = None
+
     for connector in get_connectors(equipment):
         try:
+            count_api_call("all_refs")
             refs = list(connector.AllRefs)
         except Exception:
             refs = []
+
+        owners = []
         for ref in refs:
             owner = getattr(ref, "Owner", None)
-            if owner is None or owner.Id == equipment.Id:
+            if owner is None or owner.Id.IntegerValue == equipment_id:
                 continue
-            if is_category(owner, BuiltInCategory.OST_PipeCurves):
-                return owner
-    return None
+            owners.append((owner, classify_owner_node(index, pipe_count, owner)))
+
+        if direct_pipe is None:
+            for owner, kind in owners:
+                if kind == OWNER_PIPE:
+                    direct_pipe = owner
+                    break
+
+        pipe_found = None
+        visited_ids = set([equipment_id])
+        for owner, kind in owners:
+            visited_ids.add(owner.Id.IntegerValue)
+            if kind == OWNER_PIPE:
+                pipe_found = owner
+            elif kind == OWNER_FITTING:
+                pipe_found = find_indexed_pipe_through_fittings(
+                    network, owner, equipment_id, visited_ids
+                )
+            if pipe_found is not None:
+                break
+        pipe_list.append(pipe_found)
+
+    return pipe_list, direct_pipe
+
+
+def build_equipment_connector_index(target_equipment, network):
+    """
+    Indice equipo -> (tuberias trazadas, tuberia directa) construido una
+    vez por ejecucion sobre la red compartida.
+    """
+    connector_index = {}
+    for equipment in target_equipment:
+        equipment_id = equipment.Id.IntegerValue
+        if equipment_id in connector_index:
+            continue
+        connector_index[equipment_id] = trace_equipment_connectors(equipment, network)
+    return connector_index
 
 
-def update_equipment_pressures(target_equipment):
+def get_equipment_line_pipes(network, snapshot, pipe_list, direct_pipe):
+    """
+    Tuberia de aspiracion y de liquido de un equipo con las reglas de
+    update_equipment_pressures: primera trazada de cada linea y, si falta,
+    la directa segun su sistema.
+    """
+    lines = {"asp": None, "liq": None}
+    for pipe in pipe_list:
+        if pipe is None:
+            continue
+        system_name = read_snapshot_system_name(network, snapshot, pipe)
+        line = "asp" if system_name in ASPIRATION_SYSTEM_NAMES else "liq"
+        if lines[line] is None:
+            lines[line] = pipe
+    if direct_pipe is not None:
+        system_name = read_snapshot_system_name(network, snapshot, direct_pipe)
+        if lines["asp"] is None and system_name in DIRECT_ASP_SYSTEM_NAMES:
+            lines["asp"] = direct_pipe
+        elif lines["liq"] is None and system_name in DIRECT_LIQ_SYSTEM_NAMES:
+            lines["liq"] = direct_pipe
+    return lines
+
+
+def iter_critical_path_rows(target_equipment, connector_index, network, snapshot, sweeps):
+    """
+    Genera las filas (CRITICAL_PATH_COLUMNS) de la ruta critica de cada
+    equipo y linea. Solo hay en memoria la ruta del equipo en curso.
+
+    El acumulado del recorrido esta en unidades internas y puede incluir las
+    uniones; se pasa a bar y pcarga_uniones_bar es lo que suma el tramo
+    ademas de la propia tuberia (uniones entre la anterior y esta).
+    """
+    parents = sweeps["pressure_parents"]
+    cumulative_pressure = sweeps["pressure"]
+    node_ids = network["node_ids"]
+    loop_pipes = set(
+        member
+        for members in sweeps["loops"]
+        for member in members
+        if member < network["pipe_count"]
+    )
+    for equipment in target_equipment:
+        pipe_list, direct_pipe = connector_index[equipment.Id.IntegerValue]
+        lines = get_equipment_line_pipes(network, snapshot, pipe_list, direct_pipe)
+        label = get_equipment_label(equipment)
+        for line in ("asp", "liq"):
+            pipe = lines[line]
+            if pipe is None:
+                continue
+            pipe_index = get_snapshot_index(network, snapshot, pipe)
+            if pipe_index is None:
+                continue
+            path_length = 0.0
+            previous_cumulative = 0.0
+            in_loop = False
+            for order, node in enumerate(get_pipe_path_indexes(parents, pipe_index)):
+                in_loop = in_loop or node in loop_pipes
+                length = safe_float(snapshot["length"][node], 0.0)
+                path_length += length
+                pressure = safe_float(snapshot["pressure"][node], 0.0)
+                node_cumulative = pa_to_bar(cumulative_pressure[node])
+                yield (
+                    equipment.Id.IntegerValue,
+                    label,
+                    line,
+                    order,
+                    node_ids[node],
+                    snapshot["tramo"][node],
+                    snapshot["system_name"][node],
+                    length,
+                    path_length,
+                    pressure,
+                    node_cumulative - previous_cumulative - pressure,
+                    node_cumulative,
+                    1 if in_loop else 0,
+                )
+                previous_cumulative = node_cumulative
+
+
+def format_csv_cell(value):
+    if not isinstance(value, basestring):
+        return to_text(value)
+    text = to_text(value)
+    if (
+        CRITICAL_PATH_CSV_DELIMITER in text
+        or u'"' in text
+        or u"\n" in text
+        or u"\r" in text
+    ):
+        text = u'"{}"'.format(text.replace(u'"', u'""'))
+    return text
+
+
+def export_critical_paths(path, export_format, rows):
+    """
+    Escribe las filas en streaming (CSV o array JSON, UTF-8). Devuelve el
+    numero de filas escritas, o None si no se pudo escribir.
+    """
+    written = 0
+    try:
+        with codecs.open(path, "w", "utf-8") as export_file:
+            if export_format == "json":
+                export_file.write(u"[")
+                for row in rows:
+                    export_file.write(u",\n" if written else u"\n")
+                    export_file.write(json.dumps(
+                        dict(zip(CRITICAL_PATH_COLUMNS, row)), ensure_ascii=False
+                    ))
+                    written += 1
+                export_file.write(u"\n]\n")
+            else:
+                export_file.write(CRITICAL_PATH_CSV_DELIMITER.join(CRITICAL_PATH_COLUMNS) + u"\n")
+                for row in rows:
+                    export_file.write(
+                        CRITICAL_PATH_CSV_DELIMITER.join(format_csv_cell(value) for value in row) + u"\n"
+                    )
+                    written += 1
+    except Exception as exc:
+        logger.debug("No se pudo exportar {}: {}".format(path, exc))
+        return None
+    return written
+
+
+def update_equipment_pressures(
+    target_equipment,
+    network,
+    snapshot,
+    affected_pipe_ids=None,
+    connector_index=None,
+):
+    """
+    Escribe p.carga.acum_asp/liq en los equipos objetivo. Con
+    affected_pipe_ids (modo incremental) se omiten los equipos cuyas
+    tuberias trazadas no cambiaron de acumulado.
+
+    Las tuberias de cada equipo salen del indice conector-propietario
+    (build_equipment_connector_index) y el sistema de la instantanea.
+    """
     stats = {
         "equipments": len(target_equipment),
         "recursive_asp": 0,
@@ -1659,73 +3034,111 @@ def update_equipment_pressures(target_equipment):
         "fallback_asp": 0,
         "fallback_liq": 0,
         "missing_clean_lists": 0,
+        "unchanged": 0,
     }
 
+    if connector_index is None:
+        connector_index = build_equipment_connector_index(target_equipment, network)
+
     for equipment in target_equipment:
-        pipe_candidates = [pipe for pipe in get_equipment_pipe_lists(equipment) if pipe is not None]
+        pipe_list, direct_pipe = connector_index[equipment.Id.IntegerValue]
+        pipe_candidates = [pipe for pipe in pipe_list if pipe is not None]
         if not pipe_candidates:
             stats["missing_clean_lists"] += 1
-            pipe_candidates = []
+
+        if affected_pipe_ids is not None:
+            traced = pipe_candidates + ([direct_pipe] if direct_pipe is not None else [])
+            if not any(pipe.Id.IntegerValue in affected_pipe_ids for pipe in traced):
+                stats["unchanged"] += 1
+                continue
 
         wrote_asp = False
         wrote_liq = False
         asp_pipes = []
         liq_pipes = []
         for pipe in pipe_candidates:
-            system_name = get_pipe_system_name(pipe)
+            system_name = read_snapshot_system_name(network, snapshot, pipe)
             if system_name in ASPIRATION_SYSTEM_NAMES:
                 asp_pipes.append(pipe)
             else:
                 liq_pipes.append(pipe)
 
         if asp_pipes:
-            asp_value = get_dynamo_param_value(asp_pipes[0], PARAM_PCARGA_ACUM, None)
+            asp_value = read_snapshot_pressure_acum(network, snapshot, asp_pipes[0])
             converted = safe_float(asp_value, None)
             if converted is not None:
                 converted = converted / 0.0689476 * 10000.0 * 2.0
-                if set_dynamep_param_value(equipment, PARAM_PCARGA_ASP, converted):
+                if write_param_if_changed(
+                    equipment,
+                    PARAM_PCARGA_ASP,
+                    converted,
+                    set_dynamep_param_value,
+                ):
                     stats["recursive_asp"] += 1
                     wrote_asp = True
 
         if liq_pipes:
-            liq_value = get_dynamo_param_value(liq_pipes[0], PARAM_PCARGA_ACUM, None)
+            liq_value = read_snapshot_pressure_acum(network, snapshot, liq_pipes[0])
             converted = safe_float(liq_value, None)
             if converted is not None:
                 converted = converted / 0.0689476 * 10000.0 * 2.0
-                if set_dynamep_param_value(equipment, PARAM_PCARGA_LIQ, converted):
+                if write_param_if_changed(
+                    equipment,
+                    PARAM_PCARGA_LIQ,
+                    converted,
+                    set_dynamep_param_value,
+                ):
                     stats["recursive_liq"] += 1
                     wrote_liq = True
 
-        direct_pipe = get_first_direct_pipe(equipment)
         if direct_pipe is None:
             continue
 
-        direct_value = get_dynamo_param_value(direct_pipe, PARAM_PCARGA_ACUM, None)
+        direct_value = read_snapshot_pressure_acum(network, snapshot, direct_pipe)
         if direct_value is None:
             continue
 
-        system_name = get_pipe_system_name(direct_pipe)
+        system_name = read_snapshot_system_name(network, snapshot, direct_pipe)
         if system_name in DIRECT_ASP_SYSTEM_NAMES and not wrote_asp:
             converted = safe_float(direct_value, None)
             if converted is not None:
                 converted = converted / 0.0689476 * 10000.0 * 2.0
-                if set_dynamep_param_value(equipment, PARAM_PCARGA_ASP, converted):
+                if write_param_if_changed(
+                    equipment,
+                    PARAM_PCARGA_ASP,
+                    converted,
+                    set_dynamep_param_value,
+                ):
                     stats["fallback_asp"] += 1
         elif system_name in DIRECT_LIQ_SYSTEM_NAMES and not wrote_liq:
             converted = safe_float(direct_value, None)
             if converted is not None:
                 converted = converted / 0.0689476 * 10000.0 * 2.0
-                if set_dynamep_param_value(equipment, PARAM_PCARGA_LIQ, converted):
+                if write_param_if_changed(
+                    equipment,
+                    PARAM_PCARGA_LIQ,
+                    converted,
+                    set_dynamep_param_value,
+                ):
                     stats["fallback_liq"] += 1
 
     return stats
 
 
 def main():
+    reset_system_type_cache()
+    reset_write_stats()
+    reset_unit_token_cache()
+    reset_fitting_loss_cache()
+    reset_run_metrics()
+    set_param_access_mode(PARAM_ACCESS_MODE)
+
     print("=" * 70)
     print("PERDIDA CARGA POR TRAMO")
     print("=" * 70)
+    print("Acceso a parametros: {}".format(PARAM_ACCESS_MODE))
 
+    begin_stage(u"[0] Parametros compartidos")
     print("\n[0] Parametros compartidos...")
     shared_report = ensure_shared_parameters()
     if shared_report["errors"]:
@@ -1744,6 +3157,7 @@ def main():
             ", ".join(shared_report["missing_in_file"])
         ))
 
+    begin_stage(u"[1] Colecciones base")
     pipes = list(
         FilteredElementCollector(doc)
         .OfCategory(BuiltInCategory.OST_PipeCurves)
@@ -1767,12 +3181,18 @@ def main():
     print("    Tuberias: {}".format(len(pipes)))
     print("    Uniones : {}".format(len(fittings)))
     print("    Equipos : {}".format(len(all_equipment)))
+    record_peak(u"tuberias", len(pipes))
+    record_peak(u"uniones", len(fittings))
+    record_peak(u"equipos", len(all_equipment))
 
+    begin_stage(u"[2] Tuberias iniciales")
     initial_pipes, initial_source = get_initial_pipes(pipes, all_equipment)
     print("\n[2] Tuberias iniciales...")
     print("    Fuente: {}".format(initial_source))
     print("    Cantidad: {}".format(len(initial_pipes)))
 
+    record_peak(u"tuberias iniciales", len(initial_pipes))
+
     if not pipes:
         print("\nNo hay tuberias en el modelo. Fin.")
         return
@@ -1782,22 +3202,97 @@ def main():
         print("Selecciona manualmente las tuberias de arranque o revisa los UniqueId embebidos en el script.")
         return
 
+    if PARAM_ACCESS_MODE == "verificacion":
+        begin_stage(u"Paridad dynamo/nativo")
+        print("\n[2b] Paridad acceso Dynamo / nativo...")
+        parity = check_param_access_parity(pipes, PARITY_SAMPLE_SIZE)
+        if not parity["available"]:
+            print("    Wrappers de Dynamo no disponibles: solo se puede usar el modo nativo.")
+        else:
+            print("    Tuberias: {} | lecturas comparadas: {} | diferencias: {}".format(
+                parity["pipes"], parity["compared"], len(parity["mismatches"])
+            ))
+            for pipe_id, name, dynamo_value, native_value in parity["mismatches"][:PARITY_MAX_REPORTED]:
+                print("      - {} | {}: dynamo={} | nativo={}".format(
+                    pipe_id, name, dynamo_value, native_value
+                ))
+
+    begin_stage(u"Red e instantanea")
     target_equipment = filter_target_equipment(all_equipment)
     all_pot_equipment = filter_mechanical_equipment_with_pot(all_equipment)
 
+    network = build_pipe_network(pipes, fittings)
+    snapshot = build_pipe_snapshot(network, pipes)
+    print("    Red: {} nodos | {} enlaces".format(
+        len(network["node_ids"]), len(network["targets"]) // 2
+    ))
+    record_peak(u"nodos de red", len(network["node_ids"]))
+    record_peak(u"enlaces de red", len(network["targets"]) // 2)
+    record_peak(u"equipos objetivo", len(target_equipment))
+    print("    Instantanea de parametros: {} tuberias".format(network["pipe_count"]))
+    print("    Tipos de sistema: {} distintos | aciertos cache: {} | resoluciones: {}".format(
+        len(SYSTEM_TYPE_CACHE["type_info"]),
+        SYSTEM_TYPE_CACHE["hits"],
+        SYSTEM_TYPE_CACHE["misses"],
+    ))
+
+    if PRESSURE_DROP_SOURCE in ("darcy", "comparar"):
+        begin_stage(u"Perdida de carga Darcy-Weisbach")
+        print("\n[2c] Perdida de carga Darcy-Weisbach ({})...".format(PRESSURE_DROP_SOURCE))
+        darcy_values = compute_darcy_pressures(snapshot)
+        if PRESSURE_DROP_SOURCE == "darcy":
+            replaced, kept = apply_darcy_pressures(snapshot, darcy_values)
+            print("    Calculadas: {} | sin datos (se mantiene Revit): {}".format(replaced, kept))
+        else:
+            comparison = compare_darcy_pressures(snapshot, darcy_values)
+            print("    Comparadas: {} | sin datos: {} | fuera de tolerancia ({:.0%}): {}".format(
+                comparison["compared"],
+                comparison["missing"],
+                DARCY_COMPARE_TOLERANCE,
+                comparison["over_tolerance"],
+            ))
+            print("    Desviacion relativa media/max: {:.1%} / {:.1%}".format(
+                comparison["mean_relative"], comparison["max_relative"]
+            ))
+            for relative, pipe_id, system_name, revit_value, darcy_value in comparison["worst"]:
+                print("      - {} [{}] revit={:.6g} | darcy={:.6g} ({:.0%})".format(
+                    pipe_id, system_name, revit_value, darcy_value, relative
+                ))
+
+    start_indexes = get_network_pipe_indexes(network, initial_pipes)
+    state_path = u""
+    plan = None
+    if INCREMENTAL_MODE:
+        state_path = get_model_sidecar_path(INCREMENTAL_STATE_SUFFIX)
+        plan, reason = plan_incremental_update(
+            load_json_sidecar(state_path), network, snapshot, start_indexes
+        )
+        if plan is None:
+            print("    Modo incremental: calculo completo ({})".format(reason))
+        else:
+            print("    Modo incremental: {} | grupos: {} | subarbol long/pcarga: {}/{}".format(
+                reason,
+                len(plan["group_keys"]),
+                len(plan["length_affected"]),
+                len(plan["pressure_affected"]),
+            ))
+
     trans = Transaction(doc, "PERDIDA CARGA POR TRAMO")
     trans.Start()
     try:
+        begin_stage(u"[3] Pot.Frigorifica")
         print("\n[3] Pot.Frigorifica en tuberias...")
         pot_written = 0
         pot_missing = 0
-        for pipe in pipes:
-            system_type = get_pipe_system_type(pipe)
-            flow = get_dynamo_param_value(pipe, PARAM_FLOW, 0.0)
-            density = get_dynamo_param_value(system_type, PARAM_DENSITY, 0.0)
-            delta_h = get_dynamo_param_value(system_type, PARAM_DIF_ENTALPIA, 0.0)
-            pot_value = calculate_pot_frigorifica(flow, density, delta_h)
-            if set_dynamo_param_value(pipe, PARAM_POT_FRIGO, pot_value):
+        for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+            if plan is not None and pipe_index not in plan["changed"]:
+                continue
+            pot_value = calculate_pot_frigorifica(
+                snapshot["flow"][pipe_index],
+                snapshot["density"][pipe_index],
+                snapshot["delta_h"][pipe_index],
+            )
+            if write_param_if_changed(pipe, PARAM_POT_FRIGO, pot_value, set_dynamo_param_value):
                 pot_written += 1
             else:
                 pot_missing += 1
@@ -1805,86 +3300,119 @@ def main():
             pot_written, pot_missing
         ))
 
+        begin_stage(u"[4] Temperatura de fluido")
         print("\n[4] Temperatura de fluido desde tipo de sistema...")
         temp_written = 0
-        for pipe in pipes:
-            system_type = get_pipe_system_type(pipe)
-            temp_value = get_dynamo_param_value(system_type, PARAM_TEMP_FLUID, None)
+        for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+            if plan is not None and pipe_index not in plan["changed"]:
+                continue
+            temp_value = snapshot["temp_fluid"][pipe_index]
             if temp_value is None:
                 continue
-            if set_dynamo_param_value(pipe, PARAM_TEMP_FLUID, temp_value):
+            if write_param_if_changed(pipe, PARAM_TEMP_FLUID, temp_value, set_dynamo_param_value):
                 temp_written += 1
         print("    Escritas: {}".format(temp_written))
 
+        begin_stage(u"[5] Agrupacion por Tramo")
         print("\n[5] Agrupacion por Tramo + Nombre de tipo...")
-        pressure_by_key = {}
-        length_by_key = {}
-        pipe_key_map = {}
-        grouped = {}
-
-        for pipe in pipes:
-            key = get_dynamo_group_key(pipe)
-            pipe_key_map[pipe.Id.IntegerValue] = key
-            grouped.setdefault(key, []).append(pipe)
-
-        for key, group_pipes in grouped.items():
-            pressure_values = [
-                safe_float(get_dynamo_param_value(pipe, PARAM_PCARGA, 0.0), 0.0)
-                for pipe in group_pipes
-            ]
-            pressure_by_key[key] = sum(pressure_values) if pressure_values else 0.0
-            length_by_key[key] = sum(
-                safe_float(get_dynamo_param_value(pipe, PARAM_LONGITUD, 0.0), 0.0)
-                for pipe in group_pipes
-            )
+        counts_by_key, pressure_by_key, length_by_key = aggregate_tramo_totals(snapshot)
 
-        multi_groups = [group_pipes for group_pipes in grouped.values() if len(group_pipes) > 1]
-        multi_group_pipe_count = sum(len(group_pipes) for group_pipes in multi_groups)
+        multi_groups = [count for count in counts_by_key.values() if count > 1]
+        multi_group_pipe_count = sum(multi_groups)
 
         tramo_pressure_written = 0
         tramo_length_written = 0
-        for pipe in pipes:
-            key = pipe_key_map.get(pipe.Id.IntegerValue, u"")
-            if set_dynamo_param_value(pipe, PARAM_PCARGA_TRAMO, pressure_by_key.get(key, 0.0)):
+        for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+            key = snapshot["group_key"][pipe_index]
+            if plan is not None and key not in plan["group_keys"]:
+                continue
+            if write_param_if_changed(
+                pipe,
+                PARAM_PCARGA_TRAMO,
+                pressure_by_key.get(key, 0.0),
+                set_dynamo_param_value,
+            ):
                 tramo_pressure_written += 1
-            if set_dynamo_param_value(pipe, PARAM_LONGTRAMO, length_by_key.get(key, 0.0)):
+            if write_param_if_changed(
+                pipe,
+                PARAM_LONGTRAMO,
+                length_by_key.get(key, 0.0),
+                set_dynamo_param_value,
+            ):
                 tramo_length_written += 1
 
-        print("    Grupos: {}".format(len(grouped)))
+        record_peak(u"grupos Tramo", len(counts_by_key))
+        print("    Grupos: {}".format(len(counts_by_key)))
         print("    Grupos multi-tuberia: {} | tuberias agrupadas: {}".format(
             len(multi_groups), multi_group_pipe_count
         ))
         print("    P.Carga_Tramo escritas: {}".format(tramo_pressure_written))
         print("    LongTramo escritos    : {}".format(tramo_length_written))
 
+        begin_stage(u"[6] Longitud acumulada")
         print("\n[6] Longitud acumulada...")
-        cumulative_lengths, length_paths = compute_cumulative_lengths(
-            pipes, fittings, initial_pipes
-        )
+        if plan is None:
+            fitting_losses = None
+            if FITTING_LOSSES_ENABLED:
+                fitting_losses = build_fitting_losses(network, snapshot, fittings)
+                print("    Uniones con perdida: {} | tipos/tamanos distintos: {}".format(
+                    sum(1 for value in fitting_losses["length"] if value),
+                    len(FITTING_LOSS_CACHE["by_key"]),
+                ))
+            sweeps = compute_cumulative_sweeps(
+                network, snapshot, start_indexes, CUMULATIVE_SWEEP_MODE, fitting_losses
+            )
+        else:
+            sweeps = plan["sweeps"]
+        print("    Modo de recorrido: {}".format(sweeps["mode"]))
+        if sweeps["mismatches"] is not None:
+            print("    Diferencias fusionado/separado: {}".format(sweeps["mismatches"]))
+        cumulative_lengths = sweeps["lengths"]
         long_acum_written = 0
-        for pipe in pipes:
-            value = cumulative_lengths.get(pipe.Id.IntegerValue, 0.0)
-            if set_dynamep_param_value(pipe, PARAM_LONG_ACUM, value):
+        for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+            if plan is not None and pipe_index not in plan["length_affected"]:
+                continue
+            value = cumulative_lengths[pipe_index]
+            if write_param_if_changed(pipe, PARAM_LONG_ACUM, value, set_dynamep_param_value):
                 long_acum_written += 1
         print("    Escritas: {}".format(long_acum_written))
-        print("    Rutas calculadas: {}".format(len(length_paths)))
+        print("    Rutas calculadas: {}".format(count_reached_pipes(sweeps["length_parents"])))
 
+        begin_stage(u"[7] Perdida de carga acumulada")
         print("\n[7] Perdida de carga acumulada...")
-        cumulative_pressure, pressure_paths = compute_cumulative_pressure_drop(
-            pipes, fittings, initial_pipes
-        )
+        cumulative_pressure = sweeps["pressure"]
         pcarga_acum_written = 0
-        for pipe in pipes:
-            value = cumulative_pressure.get(pipe.Id.IntegerValue, 0.0)
-            if set_dynamep_param_value(pipe, PARAM_PCARGA_ACUM, value):
+        for pipe_index, pipe in iter_snapshot_pipes(snapshot):
+            if plan is not None and pipe_index not in plan["pressure_affected"]:
+                continue
+            value = cumulative_pressure[pipe_index]
+            if write_param_if_changed(pipe, PARAM_PCARGA_ACUM, value, set_dynamep_param_value):
+                snapshot["pressure_acum"][pipe_index] = value
                 pcarga_acum_written += 1
         print("    Escritas: {}".format(pcarga_acum_written))
-        print("    Rutas calculadas: {}".format(len(pressure_paths)))
-
+        print("    Rutas calculadas: {}".format(count_reached_pipes(sweeps["pressure_parents"])))
+        if sweeps["loops"]:
+            print("    Lazos colapsados: {}".format(len(sweeps["loops"])))
+            node_ids = network["node_ids"]
+            for members in sweeps["loops"][:MAX_REPORTED_LOOPS]:
+                print("      - {} elementos: {}".format(
+                    len(members),
+                    ", ".join(str(node_ids[member]) for member in members),
+                ))
+
+        begin_stage(u"[8] Equipos mecanicos")
         print("\n[8] Equipos mecanicos...")
         print("    Con Pot.Frigorifica != 0: {}".format(len(all_pot_equipment)))
         print("    Objetivo evap/mueble    : {}".format(len(target_equipment)))
-        equipment_stats = update_equipment_pressures(target_equipment)
+        affected_pipe_ids = None
+        if plan is not None:
+            affected_pipe_ids = set(
+                network["node_ids"][pipe_index] for pipe_index in plan["pressure_affected"]
+            )
+        connector_index = build_equipment_connector_index(target_equipment, network)
+        equipment_stats = update_equipment_pressures(
+            target_equipment, network, snapshot, affected_pipe_ids, connector_index
+        )
         print(
             "    Recursivo asp/liquido   : {}/{}".format(
                 equipment_stats["recursive_asp"],
@@ -1901,8 +3429,41 @@ def main():
             print("    Equipos sin tuberias trazables: {}".format(
                 equipment_stats["missing_clean_lists"]
             ))
+        if affected_pipe_ids is not None:
+            print("    Sin cambios (omitidos)  : {}".format(equipment_stats["unchanged"]))
 
+        begin_stage(u"Commit")
         trans.Commit()
+        end_stage()
+
+        if CRITICAL_PATH_EXPORT:
+            begin_stage(u"Exportacion rutas criticas")
+            export_path = get_model_sidecar_path(
+                CRITICAL_PATH_SUFFIX, u".{}".format(CRITICAL_PATH_EXPORT)
+            )
+            exported = None
+            if export_path:
+                exported = export_critical_paths(
+                    export_path,
+                    CRITICAL_PATH_EXPORT,
+                    iter_critical_path_rows(
+                        target_equipment, connector_index, network, snapshot, sweeps
+                    ),
+                )
+            if exported is None:
+                print("\nRutas criticas no exportadas (modelo sin guardar o sin permisos).")
+            else:
+                print("\nRutas criticas exportadas: {} filas -> {}".format(exported, export_path))
+            end_stage()
+
+        if INCREMENTAL_MODE:
+            begin_stage(u"Estado incremental")
+            state = build_incremental_state(network, snapshot, start_indexes, sweeps)
+            if save_json_sidecar(state_path, state):
+                print("\nEstado incremental guardado: {}".format(state_path))
+            else:
+                print("\nEstado incremental no guardado (modelo sin guardar o sin permisos).")
+            end_stage()
 
         print("\n" + "=" * 70)
         print("RESUMEN")
@@ -1915,6 +3476,7 @@ def main():
         print("P.Carga_Acumulada escrita       : {}".format(pcarga_acum_written))
         print("Equipos objetivo procesados     : {}".format(len(target_equipment)))
         print("=" * 70)
+        print_write_stats()
 
     except Exception as exc:
         try:
@@ -1924,6 +3486,15 @@ def main():
         print("\nERROR FATAL: {}".format(exc))
         traceback.print_exc()
 
+    end_stage()
+    print_run_metrics()
+    if WRITE_RUN_RECORD:
+        record_path = save_run_record()
+        if record_path:
+            print("Registro de ejecucion guardado: {}".format(record_path))
+        else:
+            print("Registro de ejecucion no guardado (modelo sin guardar o sin permisos).")
+
 
 if __name__ == "__main__":
     main()